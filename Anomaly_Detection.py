@@ -1,11 +1,20 @@
-from data_utils import healthy_drinkable_water_ranges
+from data_utils import healthy_drinkable_water_ranges, slice_by_time
+from devices import DEFAULT_DEVICE, get_device, model_group
+from metrics import metrics
+from streaming_detectors import DETECTOR
 from datetime import datetime, timedelta
-from sklearn.ensemble import IsolationForest
-import streamlit as st
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
 
 #Anamolies/alerts
 #define a function to detect differences compared to drinkable water (Simple statistical method)
-def detect_anomalies(df, time_window=5): # time in minutes
+def detect_anomalies(df, time_window=5, now=None): # time in minutes, now = end of the window (default the clock, replays pass the recorded time)
     # check the last value
     #last_value = df.iloc[-1]
 
@@ -14,9 +23,9 @@ def detect_anomalies(df, time_window=5): # time in minutes
     # we will look at the average of the data for last 5 min and compare it to our mai
 
     # Define the detection time window
-    threshold = datetime.now() - timedelta(minutes=time_window)
+    threshold = (datetime.now() if now is None else now) - timedelta(minutes=time_window)
     # read the data for this time window
-    time_window_data = df[df['timestamp'] >= threshold]
+    time_window_data = slice_by_time(df, threshold)
 
     alert = []
 
@@ -43,54 +52,389 @@ def detect_anomalies(df, time_window=5): # time in minutes
           #                'Alert': 'High' if last_value[parameter] > max_ else 'Low'})
     return alert
 
+# Vectorized range check, one pass over all rows and parameters against the drinkable ranges
+def range_violations(df, ranges=None):
+    '''returns (parameters, boolean matrix rows x parameters that is True where the value is out of range)'''
+    ranges = healthy_drinkable_water_ranges() if ranges is None else ranges
+    parameters = [p for p in ranges if p in df]
+    values = df[parameters].to_numpy()
+    min_ = np.array([ranges[p][0] for p in parameters])
+    max_ = np.array([ranges[p][1] for p in parameters])
+    return parameters, (values < min_) | (values > max_)
+
+
+def anomaly_incidents(anomalies, max_gap=timedelta(minutes=1)):
+    '''group anomalous rows (sorted by time) that are out of range into incidents
+         rows less than max_gap apart belong to the same incident, newest incident first '''
+
+    parameters, violations = range_violations(anomalies)
+    # only rows with at least one parameter out of range are reported (like the alert list did)
+    rows = violations.any(axis=1)
+    anomalies, violations = anomalies[rows], violations[rows]
+    if anomalies.empty:
+        return pd.DataFrame(columns=['start', 'end', 'samples', 'violations'] + parameters)
+
+    timestamps = anomalies['timestamp'].to_numpy()
+    starts = np.flatnonzero(np.r_[True, np.diff(timestamps) > np.timedelta64(max_gap)])
+    ends = np.r_[starts[1:], len(anomalies)]
+
+    values = anomalies[parameters].to_numpy()
+    means = np.add.reduceat(values, starts, axis=0) / (ends - starts)[:, None]
+    violated = np.logical_or.reduceat(violations, starts, axis=0)
+
+    incidents = pd.DataFrame(means, columns=parameters)
+    incidents.insert(0, 'start', timestamps[starts])
+    incidents.insert(1, 'end', timestamps[ends - 1])
+    incidents.insert(2, 'samples', ends - starts)
+    names = np.array(parameters)
+    incidents.insert(3, 'violations', [', '.join(names[v]) for v in violated])
+    return incidents.iloc[::-1].reset_index(drop=True)
+
+
 # AI Method
 #Sensor malfunctions or spikes (e.g., extreme pH, TDS).
 #Filter performance issues (e.g., gradual increase in turbidity or TDS).
 #Pressure or flow abnormalities that might indicate clogs or leaks.
 
-last_trained = None
-isolation_model = None
+# the isolation forest settings, tuning.py searches for better ones and writes them to MODEL_CONFIG_FILE
+DEFAULT_MODEL_CONFIG = {"params": {"contamination": 0.03}, "features": ['pH', 'TDS', 'turbidity', 'flow', 'temperature']}
+MODEL_CONFIG_FILE = "isolation_forest_params.json"
+
+
+def model_config(model_dir=None):
+    '''{"params": IsolationForest arguments, "features": [...], "tuned_at": ...} from the tuned configuration
+         in the model group's folder, else the one in MODEL_DIR, else the defaults '''
+    for folder in [model_dir, MODEL_DIR]:
+        path = os.path.join(folder, MODEL_CONFIG_FILE) if folder else None
+        if path and os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+    return DEFAULT_MODEL_CONFIG
+
 
-def train_isolation_forest(df):
+def train_isolation_forest(df, config=None):
     '''This function is to detect anomalies using AI model isolation forest
          the idea is to train the model on historical clean data to help it detect changes
          to keep the model up to date, it will retrain every 24 hours
-         this way anomalies for each parameter will be easily cross checked with "normal" clean data of the system '''
+         this way anomalies for each parameter will be easily cross checked with "normal" clean data of the system
+         config = parameters and features to use (default: model_config()) '''
 
+    # sklearn takes longer to import than the rest of the dashboard, only load it once a model is needed
+    from sklearn.ensemble import IsolationForest
 
-    global isolation_model, last_trained
-    #st.write("Training Isolation Forest model...")
+    config = model_config() if config is None else config
 
-    features = ['pH', 'TDS', 'turbidity', 'flow', 'temperature']
-
-    X = df[features]
+    X = df[config["features"]]
 
-    model = IsolationForest(contamination=0.03, random_state=42)
+    model = IsolationForest(random_state=42, **config["params"])
 
     model.fit(X)
 
-    st.session_state['isolation_model'] = model
-    st.session_state['last_trained'] = datetime.now()
-
-def isolation_forest_detection(df):
-    global isolation_model, last_trained
+    return model
 
-    if 'isolation_model' not in st.session_state or 'last_trained' not in st.session_state or \
-            datetime.now() - st.session_state['last_trained'] > timedelta(hours=24):
-        train_isolation_forest(df)
 
-    model = st.session_state['isolation_model']
+def train_isolation_forest_from_archive(start, end, device_id=DEFAULT_DEVICE):
+    # train on any archived range of clean water (e.g. the last week) instead of the 24 hr kept in memory,
+    # only the feature columns of that range are read from disk
     features = ['pH', 'TDS', 'turbidity', 'flow', 'temperature']
-    df['anomaly'] = model.predict(df[features])
-    return df
+    return train_isolation_forest(get_device(device_id).clean_archive.read(start, end, columns=features))
+
+
+# the trained models are shared by every session and saved to disk so restarts do not retrain
+MODEL_DIR = os.environ.get("WATER_MODEL_DIR", "models")
+
+# fits of all devices share a couple of background threads
+training_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="model-train")
+# a failed fit is retried after 1 min, doubling up to 1 hr while it keeps failing
+RETRY_BACKOFF = (60, 3600)
+
+log = logging.getLogger(__name__)
+
+
+class ModelManager:
+    '''Owns the isolation forest model of one device (or cluster of devices) in the server process
+         training runs in a background thread, sessions keep using the current model meanwhile
+         and the new one is swapped in (together with its metadata) once the fit is done '''
+
+    def __init__(self, model_dir=MODEL_DIR, max_age=timedelta(hours=24), min_samples=10):
+        self.model_dir = model_dir
+        self.model_path = os.path.join(model_dir, "isolation_forest.joblib")
+        self.max_age = max_age
+        self.min_samples = min_samples
+
+        # (model, metadata) is replaced as one tuple so readers never see a half swapped state
+        self._current = (None, None)
+        self._training = None
+        self.frozen = False
+        # consecutive failed fits, no new fit is started before retry_at (time.monotonic)
+        self.failures = 0
+        self.last_error = None
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+        self.load()
+
+    @property
+    def model(self):
+        return self._current[0]
+
+    @property
+    def metadata(self):
+        return self._current[1]
+
+    @property
+    def training(self):
+        return self._training is not None and not self._training.done()
+
+    def load(self):
+        # pick up the model saved by a previous run (if any), a file that can not be used is retrained
+        # (needs_training sees no model) and overwritten by the next save
+        if not os.path.exists(self.model_path):
+            return
+        import joblib
+        import sklearn
+        try:
+            model, metadata = joblib.load(self.model_path)
+        except Exception:
+            log.warning("could not load the model %s, training a new one", self.model_path, exc_info=True)
+            return
+        version = metadata.get("sklearn_version") if isinstance(metadata, dict) else None
+        if version != sklearn.__version__:
+            log.warning("model %s was saved by scikit-learn %s (running %s), training a new one", self.model_path,
+                        version, sklearn.__version__)
+            return
+        self._current = (model, metadata)
+
+    def save(self, model, metadata):
+        # write to a temp file and rename so a crash never leaves a broken model file behind
+        import joblib
+
+        os.makedirs(os.path.dirname(self.model_path) or ".", exist_ok=True)
+        tmp_path = self.model_path + ".tmp"
+        joblib.dump((model, metadata), tmp_path)
+        os.replace(tmp_path, self.model_path)
+
+        # human readable copy of the metadata next to the model
+        with open(self.model_path.replace(".joblib", ".json"), "w") as f:
+            json.dump(metadata, f, indent=2, default=str)
+
+    def freeze(self, model, metadata):
+        '''use this model from now on and never retrain (replays: the results must not depend on timing)'''
+        self._current = (model, metadata)
+        self.frozen = True
+
+    def needs_training(self, n_samples):
+        if self.frozen or n_samples < self.min_samples:
+            return False
+        model, metadata = self._current
+        if model is None:
+            return True
+        trained_at = datetime.fromisoformat(metadata["trained_at"])
+        # retrain every 24 hr, and also while the data window is still filling up (first day)
+        if datetime.now() - trained_at > self.max_age or n_samples >= 2 * metadata["n_samples"]:
+            return True
+        # and as soon as tuning.py wrote a new configuration
+        return model_config(self.model_dir).get("tuned_at") != metadata.get("tuned_at")
+
+    def request_training(self, df):
+        '''start a background fit on a copy of df unless one is already running (never blocks)'''
+        with self._lock:
+            if self.training or time.monotonic() < self._retry_at:
+                return
+            self._training = training_pool.submit(self._train, df.copy())
+        self._training.add_done_callback(self._training_done)
+
+    def _training_done(self, future):
+        # nothing else waits on the future, a failed fit would otherwise go unnoticed and be restarted every refresh
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            self.failures, self.last_error = 0, None
+            return
+        self.failures += 1
+        self.last_error = error
+        delay = min(RETRY_BACKOFF[0] * 2 ** (self.failures - 1), RETRY_BACKOFF[1])
+        self._retry_at = time.monotonic() + delay
+        log.error("training %s failed (%d in a row), retrying in %d s", self.model_path, self.failures, delay,
+                  exc_info=error)
+
+    def _train(self, df):
+        import sklearn
+        config = model_config(self.model_dir)
+        with metrics.timer("model_training_seconds", model=os.path.basename(os.path.dirname(self.model_path))):
+            model = train_isolation_forest(df, config)
+        previous = self.metadata or {}
+        metadata = {
+            "version": previous.get("version", 0) + 1,
+            "trained_at": datetime.now().isoformat(),
+            "n_samples": len(df),
+            "data_start": str(df["timestamp"].min()),
+            "data_end": str(df["timestamp"].max()),
+            "params": model.get_params(),
+            "features": config["features"],
+            "tuned_at": config.get("tuned_at"),
+            "sklearn_version": sklearn.__version__,
+        }
+        # swap in first, a model that could not be written to disk is still used (and saved again on the next fit)
+        self._current = (model, metadata)
+        try:
+            self.save(model, metadata)
+        except Exception:
+            log.exception("could not save the model to %s, keeping it in memory only", self.model_path)
+        return metadata
+
+    def ensure_fresh(self, df):
+        if self.needs_training(len(df)):
+            self.request_training(df)
+
+
+model_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_model_manager(device_id=DEFAULT_DEVICE):
+    # one model per device, or per cluster when the device belongs to one (devices.MODEL_GROUPS)
+    group = model_group(device_id)
+    with _managers_lock:
+        if group not in model_managers:
+            model_managers[group] = ModelManager(os.path.join(MODEL_DIR, group))
+        return model_managers[group]
+
+
+class ScoreCache:
+    '''Keeps the isolation forest results per sample timestamp so every sample is only scored once
+         the cache belongs to one model, when the model is retrained all cached scores are dropped '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, model):
+        self.model = model
+        self.timestamps = np.empty(0, dtype=np.int64)
+        self.scores = np.empty(0, dtype=np.float64)
+        self.labels = np.empty(0, dtype=np.int64)
+
+    def score(self, model, df):
+        # sessions share the cache, one update at a time
+        with self.lock:
+            return self._score(model, df)
+
+    def _score(self, model, df):
+        if model is not self.model:
+            # new model -> old scores are not comparable anymore
+            self._reset(model)
+
+        # the features the model was fit on (a tuned configuration can leave some out)
+        features = list(model.feature_names_in_)
+        timestamps = df['timestamp'].to_numpy(dtype='datetime64[ns]').view(np.int64)
+        pos, hit = self._find(timestamps)
+
+        scores = np.empty(len(df), dtype=np.float64)
+        scores[hit] = self.scores[pos[hit]]
+
+        # only the rows we have not seen yet go through the model
+        new = ~hit
+        if new.any():
+            scores[new] = model.score_samples(df.loc[new, features])
+
+        labels = self._labels(model, scores)
+
+        # the cache only keeps the samples of the current window (older ones were evicted from the store)
+        order = np.argsort(timestamps, kind='stable')
+        self.timestamps, self.scores, self.labels = timestamps[order], scores[order], labels[order]
+
+        return labels, scores
+
+    def _find(self, timestamps):
+        # look up every timestamp in the (sorted) cache -> (position, found)
+        pos = np.minimum(np.searchsorted(self.timestamps, timestamps), max(len(self.timestamps) - 1, 0))
+        hit = self.timestamps[pos] == timestamps if len(self.timestamps) else np.zeros(len(timestamps), dtype=bool)
+        return pos, hit
+
+    @staticmethod
+    def _labels(model, scores):
+        # same rule as model.predict: anomaly when the decision function (score - offset) is negative
+        return np.where(scores - model.offset_ < 0, -1, 1)
+
+    def lookup(self, model, timestamps):
+        '''(found, labels of the found samples) for int64 ns timestamps, nothing is found for another model'''
+        with self.lock:
+            if model is not self.model:
+                return np.zeros(len(timestamps), dtype=bool), np.empty(0, dtype=np.int64)
+            pos, hit = self._find(timestamps)
+            return hit, self.labels[pos[hit]]
+
+    def add(self, model, timestamps, scores, oldest=None):
+        '''merge scores computed elsewhere (the fleet overview) into the cache, keeps what sessions cached
+             and drops the samples before `oldest` (evicted from the store) '''
+        with self.lock:
+            if model is not self.model:
+                self._reset(model)
+            keep = slice(None) if oldest is None else self.timestamps >= oldest
+            timestamps = np.concatenate([self.timestamps[keep], timestamps])
+            scores = np.concatenate([self.scores[keep], scores])
+            # a session may have scored some of them in the meantime
+            timestamps, first = np.unique(timestamps, return_index=True)
+            self.timestamps, self.scores = timestamps, scores[first]
+            self.labels = self._labels(model, self.scores)
+
+
+# one cache per device (devices of a cluster share a model but not their samples)
+score_caches = {}
+
+
+def isolation_forest_detection(df, device_id=DEFAULT_DEVICE):
+    manager = get_model_manager(device_id)
+    # kick off a background (re)train when needed, the page never waits for it
+    manager.ensure_fresh(df)
+
+    model = manager.model
+    if model is None:
+        # first model is still training, treat every sample as normal until it is ready
+        return df.assign(anomaly=1, anomaly_score=np.nan)
+
+    labels, scores = score_caches.setdefault(device_id, ScoreCache()).score(model, df)
+    # return a new frame instead of writing into the one we were given
+    return df.assign(anomaly=labels, anomaly_score=scores)
+
+
+def streaming_detection(df, device_id=DEFAULT_DEVICE):
+    # scores kept by the device's streaming detector (streaming_detectors.py), the columns are the same as above:
+    # anomaly -1 / 1 and anomaly_score lower = more anomalous (the detector score negated, like score_samples)
+    labels, scores = get_device(device_id).detector.score_frame(df)
+    return df.assign(anomaly=labels, anomaly_score=-scores)
+
+
+def detection_status(device_id=DEFAULT_DEVICE):
+    '''None when the AI detector is scoring samples, otherwise a short note of why it is not (yet)'''
+    if DETECTOR != "isolation_forest":
+        detector = get_device(device_id).detector.detector
+        return None if detector.ready else f"Collecting the first {detector.warmup} samples for the AI detector..."
+    manager = get_model_manager(device_id)
+    if manager.model is not None:
+        return None
+    if manager.last_error is not None and not manager.training:
+        return f"AI model training failed ({manager.last_error!r}), retrying..."
+    return "AI model is training, anomalies are shown once it is ready..."
+
+
+def anomaly_detection(df, device_id=DEFAULT_DEVICE):
+    '''AI anomaly flags of the detector this deployment uses (WATER_DETECTOR), the isolation forest by default'''
+    if DETECTOR == "isolation_forest":
+        return isolation_forest_detection(df, device_id)
+    return streaming_detection(df, device_id)
 
 
 def isolation_forest_detection_(df):
 
-    # initialize isolation forest model , parameters can be tuned (gridsearch)
-    iso_forest = IsolationForest(contamination=0.05, random_state=42)
+    # initialize isolation forest model, the parameters come from the tuned configuration (tuning.py) if there is one
+    from sklearn.ensemble import IsolationForest
+    config = model_config()
+    iso_forest = IsolationForest(random_state=42, **config["params"])
 
-    features = ['pH', 'TDS', 'turbidity', 'flow', 'temperature']
+    features = config["features"]
 
     if len(df) < 10:
         return df.assign(anomaly=0)  # Not enough data to train
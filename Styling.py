@@ -1,8 +1,6 @@
 import streamlit as st
 from data_utils import healthy_drinkable_water_ranges
-import matplotlib.pyplot as plt
-import base64
-from io import BytesIO
+from sparklines import sparkline_data_uri
 
 # create function to help style the average metrics when needed
 # this will help us indicate an alert when values are above drinkable ranges
@@ -24,25 +22,15 @@ def metric_style(label, value, unit, color):
     st.markdown(html, unsafe_allow_html=True)
 
 
-def metric_style_(label, value, unit, color, trend_data):
+def metric_style_(label, value, unit, color, trend_data, cache_key=None):
 
-    # Create sparkline as a base64 image
-    fig, ax = plt.subplots(figsize=(2, 0.6), dpi=100)
-    ax.plot(trend_data, color=color, linewidth=2)
-    ax.axis("off")
-    fig.patch.set_alpha(0)  # transparent background
-    ax.set_facecolor("white")  # background white
-
-    buffer = BytesIO()
-    plt.savefig(buffer, format="png", bbox_inches="tight", pad_inches=0, transparent=True)
-    buffer.seek(0)
-    img_base64 = base64.b64encode(buffer.read()).decode()
-    plt.close(fig)
+    # sparkline as an svg background, cache_key = (channel, window, last sample) reuses the last one built
+    img_uri = sparkline_data_uri(trend_data, color, cache_key=cache_key)
 
     html = f"""
             <div style="background-color: white; border: 1px solid black; border-radius: 8px;
                         padding: 1rem; margin-bottom: 0.8rem; text-align: center;
-                        background-image: url('data:image/png;base64,{img_base64}');
+                        background-image: url('{img_uri}');
                         background-repeat: no-repeat;
                         background-position: center bottom;
                         background-size: 90% 40px;">
@@ -0,0 +1,196 @@
+import itertools
+import threading
+from collections import deque
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+
+
+# Streaming alert engine for the drinkable ranges (replaces rescanning the last 5 min on every refresh)
+# it listens to a store, keeps the running mean of every channel over the last `window` as samples arrive
+# and turns it into alerts with a lifecycle:
+#   pending      mean out of range, but not for min_duration yet (not shown)
+#   open         out of range for at least min_duration
+#   acknowledged someone saw it (still active until it clears)
+#   cleared      mean back inside the range by the hysteresis margin for clear_after, moved to the history
+# the times are the sample timestamps, so a backfill or a replay gives the same alerts as live data
+
+NS = 1_000_000_000
+
+
+class RunningWindow:
+    '''sum and count per channel of the samples in the last `window_ns`, O(1) amortized per sample
+         samples sit in a ring in arrival order, new ones are added to the sums and expired ones subtracted '''
+
+    def __init__(self, window_ns, n_channels, size=1024):
+        self.window_ns = window_ns
+        self._ts = np.empty(size, dtype=np.int64)
+        self._values = np.empty((size, n_channels))
+        self._head = 0
+        self._tail = 0
+        self.sum = np.zeros(n_channels)
+        self.newest = None
+
+    def __len__(self):
+        return self._tail - self._head
+
+    def add(self, timestamps, values):
+        '''timestamps sorted int64 ns, values (samples x channels)'''
+        if self.newest is not None:
+            # a late sample counts as if it arrived with the newest one (keeps the ring sorted),
+            # unless it is already older than the window
+            keep = timestamps >= self.newest - self.window_ns
+            timestamps, values = np.maximum(timestamps[keep], self.newest), values[keep]
+        n = len(timestamps)
+        if n == 0:
+            return
+
+        if self._tail + n > len(self._ts):
+            self._compact(n)
+        self._ts[self._tail:self._tail + n] = timestamps
+        self._values[self._tail:self._tail + n] = values
+        self._tail += n
+        self.sum += values.sum(axis=0)
+        self.newest = int(self._ts[self._tail - 1])
+
+        # drop everything that left the window
+        expired = int(np.searchsorted(self._ts[self._head:self._tail], self.newest - self.window_ns, side='left'))
+        if expired:
+            self.sum -= self._values[self._head:self._head + expired].sum(axis=0)
+            self._head += expired
+
+    def _compact(self, extra):
+        live = self._tail - self._head
+        size = len(self._ts)
+        while size < 2 * (live + extra):
+            size *= 2
+        ts, values = np.empty(size, dtype=np.int64), np.empty((size, self._values.shape[1]))
+        ts[:live] = self._ts[self._head:self._tail]
+        values[:live] = self._values[self._head:self._tail]
+        self._ts, self._values, self._head, self._tail = ts, values, 0, live
+        # start again from an exact sum so adding and subtracting never drifts
+        self.sum = values[:live].sum(axis=0)
+
+    def mean(self):
+        return self.sum / len(self) if len(self) else np.full(len(self.sum), np.nan)
+
+
+class AlertEngine:
+    '''Store listener turning the running window means into alerts (see the lifecycle above)
+         the dashboard reads active_alerts() / cleared_alerts(), nothing is rescanned '''
+
+    def __init__(self, ranges=None, window=timedelta(minutes=5), min_duration=timedelta(seconds=30),
+                 clear_after=timedelta(seconds=30), hysteresis=0.05, history=50):
+        self.window = window
+        self.min_duration_ns = int(min_duration.total_seconds() * NS)
+        self.clear_after_ns = int(clear_after.total_seconds() * NS)
+        self.hysteresis = hysteresis
+        self.ranges = None
+        if ranges is not None:
+            self._set_ranges(ranges)
+
+        self._pending_since = {}   # parameter -> first time out of range
+        self._clearing_since = {}  # parameter -> first time back in range (while its alert is active)
+        self._active = {}          # parameter -> alert
+        self._cleared = deque(maxlen=history)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _set_ranges(self, ranges):
+        self.ranges = dict(ranges)
+        self.parameters = list(self.ranges)
+        low = np.array([self.ranges[p][0] for p in self.parameters], dtype=np.float64)
+        high = np.array([self.ranges[p][1] for p in self.parameters], dtype=np.float64)
+        # an alert only clears once the mean is back inside the range by `hysteresis` of the range width
+        margin = self.hysteresis * (high - low)
+        self._enter = (low, high)
+        self._exit = (low + margin, high - margin)
+        self._window = RunningWindow(int(self.window.total_seconds() * NS), len(self.parameters))
+
+    def update(self, timestamps, columns):
+        '''store listener, timestamps in int64 ns'''
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        if len(timestamps) == 0:
+            return
+        if len(timestamps) > 1 and np.any(timestamps[1:] < timestamps[:-1]):
+            order = np.argsort(timestamps, kind='stable')
+            timestamps, columns = timestamps[order], {c: np.asarray(v)[order] for c, v in columns.items()}
+
+        with self._lock:
+            if self.ranges is None:
+                # the drinkable ranges by default, looked up with the first samples and not when the device is created
+                # (data_utils creates the default device while it is imported)
+                from data_utils import healthy_drinkable_water_ranges
+                self._set_ranges(healthy_drinkable_water_ranges())
+            values = np.column_stack([np.asarray(columns[p], dtype=np.float64) for p in self.parameters])
+            self._window.add(timestamps, values)
+            self._evaluate(self._window.newest, self._window.mean())
+
+    def _evaluate(self, now, means):
+        low, high = self._enter
+        exit_low, exit_high = self._exit
+        for k, parameter in enumerate(self.parameters):
+            mean = means[k]
+            out = mean < low[k] or mean > high[k]
+            back_in = exit_low[k] <= mean <= exit_high[k]
+            alert = self._active.get(parameter)
+
+            if alert is None:
+                if not out:
+                    self._pending_since.pop(parameter, None)
+                    continue
+                since = self._pending_since.setdefault(parameter, now)
+                if now - since >= self.min_duration_ns:
+                    del self._pending_since[parameter]
+                    self._active[parameter] = self._open(parameter, since, mean)
+                continue
+
+            alert['value'] = round(float(mean), 2)
+            if out:
+                alert['status'] = 'High' if mean > high[k] else 'Low'
+            if not back_in:
+                # still out of range, or inside but within the hysteresis margin
+                self._clearing_since.pop(parameter, None)
+                continue
+            since = self._clearing_since.setdefault(parameter, now)
+            if now - since >= self.clear_after_ns:
+                del self._clearing_since[parameter]
+                alert['state'] = 'cleared'
+                alert['cleared_at'] = pd.Timestamp(now)
+                self._cleared.appendleft(self._active.pop(parameter))
+
+    def _open(self, parameter, since, mean):
+        min_, max_ = self.ranges[parameter]
+        return {
+            'id': next(self._ids),
+            'parameter': parameter,
+            'value': round(float(mean), 2),
+            'status': 'High' if mean > max_ else 'Low',
+            'range': f"{min_} - {max_}",
+            'time_window': f"Last {int(self.window.total_seconds() // 60)} minutes (Average)",
+            'state': 'open',
+            'opened_at': pd.Timestamp(since),
+            'acknowledged_at': None,
+            'cleared_at': None,
+        }
+
+    def acknowledge(self, alert_id):
+        with self._lock:
+            for alert in self._active.values():
+                if alert['id'] == alert_id and alert['state'] == 'open':
+                    alert['state'] = 'acknowledged'
+                    alert['acknowledged_at'] = pd.Timestamp.now()
+
+    def active_alerts(self):
+        '''open and acknowledged alerts, oldest first (copies, safe to use from any session)'''
+        with self._lock:
+            return sorted((dict(alert) for alert in self._active.values()), key=lambda a: a['id'])
+
+    def cleared_alerts(self):
+        '''most recently cleared first'''
+        with self._lock:
+            return [dict(alert) for alert in self._cleared]
+
+    def window_means(self):
+        with self._lock:
+            return {} if self.ranges is None else dict(zip(self.parameters, self._window.mean()))
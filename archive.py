@@ -0,0 +1,279 @@
+import os
+import threading
+import time
+import numpy as np
+
+
+# Append-only on-disk archive of the sensor data (beyond the 24 hr kept in memory)
+# (pyarrow is imported on the first write / read, most dashboard processes only write from the flush thread)
+#   <root>/raw/hour=YYYY-MM-DDTHH/part-*.parquet   every sample, one folder per hour
+#   <root>/1min/day=YYYY-MM-DD/part-*.parquet       count / sum / min / max per channel and minute
+#   <root>/1h/month=YYYY-MM/part-*.parquet          count / sum / min / max per channel and hour
+# every flush adds one file per partition it touches. Once a partition is closed (a later hour / day / month was
+# written), or an open one collected COMPACT_FILES files (the day / month partitions stay open for long), its files
+# are compacted into one compacted-<ns>.parquet that stands for every part up to part-<ns>, the parts it covers are
+# deleted after it is in place and readers skip them in the meantime, so a range read opens a few files per partition. Range reads only list the partition folders of the range and push the timestamp
+# filter down to the parquet row groups, and files are memory mapped
+
+ARCHIVE_DIR = os.environ.get("WATER_ARCHIVE_DIR", "archive")
+
+# tier -> (bin size in ns or None for raw samples, partition key, numpy datetime unit of the partition value)
+TIERS = {
+    "raw": (None, "hour", "h"),
+    "1min": (60 * 10**9, "day", "D"),
+    "1h": (3600 * 10**9, "month", "M"),
+}
+
+
+# an open partition is compacted once it has this many files
+COMPACT_FILES = 32
+
+
+def _partition_values(timestamps, unit):
+    # "2026-10-18T04" / "2026-10-18" / "2026-10" strings sort the same way as the time they stand for
+    return np.datetime_as_string(timestamps.astype("datetime64[ns]").astype(f"datetime64[{unit}]"))
+
+
+def _write_file(table, path):
+    import pyarrow.parquet as pq
+    # write + rename so readers never pick up a half written file (not a .parquet name until it is complete)
+    pq.write_table(table, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def _part_ns(path):
+    # part-<ns>.parquet / compacted-<ns>.parquet -> ns, 0 for other names
+    stem = os.path.basename(path)[:-len(".parquet")]
+    number = stem.rpartition("-")[2]
+    return int(number) if number.isdigit() else 0
+
+
+def _live_files(folder):
+    '''parquet files of a partition folder without the parts the newest compacted file already holds'''
+    files = sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.endswith(".parquet"))
+    compacted = [f for f in files if os.path.basename(f).startswith("compacted-")]
+    if not compacted:
+        return files
+    newest = max(compacted, key=_part_ns)
+    covered = _part_ns(newest)
+    return [newest] + [f for f in files if f != newest and f not in compacted and _part_ns(f) > covered]
+
+
+class SensorArchive:
+    '''Buffers new samples (store listener) and writes them to parquet from a background thread
+         every flush_seconds or as soon as flush_rows samples are waiting '''
+
+    def __init__(self, root, channels, flush_rows=5000, flush_seconds=60):
+        self.root = root
+        self.channels = list(channels)
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+
+        self._pending = []
+        self._pending_rows = 0
+        self._lock = threading.Lock()
+        # one flush (and compaction) at a time
+        self._flush_lock = threading.Lock()
+        # tier -> {partition value: folder} written to and not compacted yet, None until the first flush
+        # looked for leftovers of a previous run
+        self._uncompacted = None
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._filesystem = None
+
+    # --- writing ---
+
+    def add(self, timestamps, columns):
+        '''store listener: only copies the batch, the disk write happens in the flush thread'''
+        with self._lock:
+            self._pending.append((np.array(timestamps, dtype=np.int64),
+                                  {c: np.array(columns[c]) for c in self.channels}))
+            self._pending_rows += len(timestamps)
+            if self._pending_rows >= self.flush_rows:
+                self._wakeup.set()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._flush_loop, name="archive-flush", daemon=True)
+            self._thread.start()
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending, self._pending_rows = self._pending, [], 0
+        if not pending:
+            return
+
+        timestamps = np.concatenate([ts for ts, _ in pending])
+        columns = {c: np.concatenate([cols[c] for _, cols in pending]) for c in self.channels}
+        order = np.argsort(timestamps, kind="stable")
+        timestamps = timestamps[order]
+        columns = {c: values[order] for c, values in columns.items()}
+
+        if self._uncompacted is None:
+            self._uncompacted = {tier: self._find_uncompacted(tier) for tier in TIERS}
+        self._write("raw", timestamps, columns)
+        for tier in ["1min", "1h"]:
+            self._write(tier, *self._aggregate(TIERS[tier][0], timestamps, columns))
+
+        # partitions before the newest one written are closed (late samples reopen them until the next flush)
+        for tier, (_, _, unit) in TIERS.items():
+            newest = _partition_values(timestamps[-1:], unit)[0]
+            for value, folder in sorted(self._uncompacted[tier].items()):
+                if value < newest:
+                    self._compact(tier, self._uncompacted[tier].pop(value))
+                elif len(_live_files(folder)) >= COMPACT_FILES:
+                    self._compact(tier, folder)
+
+    def _aggregate(self, bin_ns, timestamps, columns):
+        # count / sum / min / max per bin (the same bin can show up again in a later flush, _merge combines them)
+        bins, inverse = np.unique(timestamps // bin_ns, return_inverse=True)
+        aggregated = {"count": np.bincount(inverse).astype(np.int64)}
+        for c in self.channels:
+            values = columns[c]
+            aggregated[f"{c}_sum"] = np.bincount(inverse, weights=values)
+            aggregated[f"{c}_min"] = np.full(len(bins), np.inf)
+            aggregated[f"{c}_max"] = np.full(len(bins), -np.inf)
+            np.minimum.at(aggregated[f"{c}_min"], inverse, values)
+            np.maximum.at(aggregated[f"{c}_max"], inverse, values)
+        return bins * bin_ns, aggregated
+
+    def _write(self, tier, timestamps, columns):
+        import pyarrow as pa
+
+        _, key, unit = TIERS[tier]
+        partitions = _partition_values(timestamps, unit)
+        # timestamps are sorted so every partition is one contiguous slice
+        values, starts = np.unique(partitions, return_index=True)
+        ends = np.append(starts[1:], len(timestamps))
+
+        for value, lo, hi in zip(values, starts, ends):
+            folder = os.path.join(self.root, tier, f"{key}={value}")
+            os.makedirs(folder, exist_ok=True)
+            table = pa.table({"timestamp": pa.array(timestamps[lo:hi].view("datetime64[ns]")),
+                              **{name: col[lo:hi] for name, col in columns.items()}})
+            _write_file(table, os.path.join(folder, f"part-{time.time_ns()}.parquet"))
+            self._uncompacted[tier][str(value)] = folder
+
+    def _find_uncompacted(self, tier):
+        # partitions a previous run left with more than one file
+        path = os.path.join(self.root, tier)
+        if not os.path.isdir(path):
+            return {}
+        folders = {name.partition("=")[2]: os.path.join(path, name) for name in os.listdir(path)}
+        return {value: folder for value, folder in folders.items() if len(_live_files(folder)) > 1}
+
+    def _compact(self, tier, folder):
+        '''merge the files of a closed partition into one (bins of the same minute / hour are combined)'''
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        files = _live_files(folder)
+        if len(files) < 2:
+            return
+        table = pa.concat_tables([pq.ParquetFile(f).read() for f in files], promote_options="permissive")
+        covers = max(_part_ns(f) for f in files)
+        path = os.path.join(folder, f"compacted-{covers}.parquet")
+        _write_file(self._merge(tier, table), path)
+        # readers already skip the covered files (and older compacted ones), they can go
+        for name in os.listdir(folder):
+            f = os.path.join(folder, name)
+            if f != path and name.endswith(".parquet") and _part_ns(f) <= covers:
+                os.remove(f)
+
+    def _merge(self, tier, table):
+        if tier == "raw":
+            return table.sort_by("timestamp")
+        import pyarrow as pa
+        # bins written by different flushes are combined into one row
+        aggs = [(name, "sum" if name == "count" or name.endswith("_sum") else name.rsplit("_", 1)[1])
+                for name in table.column_names if name != "timestamp"]
+        grouped = table.group_by("timestamp").aggregate(aggs)
+        return pa.table({"timestamp": grouped["timestamp"],
+                         **{name: grouped[f"{name}_{how}"] for name, how in aggs}}).sort_by("timestamp")
+
+    # --- reading ---
+
+    def _dataset(self, tier, start, end):
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        from pyarrow import fs
+
+        # only the partition folders of the range are listed, the cost of a read does not grow with the archive
+        _, key, unit = TIERS[tier]
+        first, last = _partition_values(np.array([np.datetime64(start, "ns"), np.datetime64(end, "ns")]), unit)
+        path = os.path.join(self.root, tier)
+        if not os.path.isdir(path):
+            return None
+        files = []
+        for name in sorted(os.listdir(path)):
+            prefix, _, value = name.partition("=")
+            if prefix == key and first <= value <= last:
+                files += _live_files(os.path.join(path, name))
+        if not files:
+            return None
+
+        if self._filesystem is None:
+            self._filesystem = fs.LocalFileSystem(use_mmap=True)
+        partitioning = ds.partitioning(pa.schema([(key, pa.string())]), flavor="hive")
+        return ds.dataset(files, format="parquet", partitioning=partitioning, partition_base_dir=path,
+                          filesystem=self._filesystem)
+
+    def _filter(self, tier, start, end):
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+
+        _, key, unit = TIERS[tier]
+        start_ns, end_ns = np.datetime64(start, "ns"), np.datetime64(end, "ns")
+        first, last = _partition_values(np.array([start_ns, end_ns]), unit)
+        return ((ds.field(key) >= first) & (ds.field(key) <= last) &
+                (ds.field("timestamp") >= pa.scalar(start_ns)) & (ds.field("timestamp") < pa.scalar(end_ns)))
+
+    def scan(self, start, end, columns=None, tier="raw"):
+        '''record batches for start <= timestamp < end, for ranges that should not be loaded at once'''
+        dataset = self._dataset(tier, start, end)
+        if dataset is None:
+            return iter(())
+        names = None if columns is None else ["timestamp"] + list(columns)
+        return dataset.to_batches(columns=names, filter=self._filter(tier, start, end))
+
+    def read_table(self, start, end, columns=None, tier="raw"):
+        dataset = self._dataset(tier, start, end)
+        names = None if columns is None else ["timestamp"] + list(columns)
+        if dataset is None:
+            import pyarrow as pa
+            return pa.table({name: [] for name in names or ["timestamp"]})
+        try:
+            return dataset.to_table(columns=names, filter=self._filter(tier, start, end))
+        except FileNotFoundError:
+            # a partition of the range was compacted while we read it, listing it again finds the new file
+            return self.read_table(start, end, columns, tier)
+
+    def read(self, start, end, columns=None, tier="raw"):
+        '''DataFrame for start <= timestamp < end
+             raw: timestamp + channels, tiers: timestamp (bin start) + mean / min / max per channel '''
+
+        channels = self.channels if columns is None else list(columns)
+        if tier == "raw":
+            df = self.read_table(start, end, channels, tier).to_pandas()
+            return df.sort_values("timestamp", ignore_index=True)
+
+        names = ["count"] + [f"{c}_{stat}" for c in channels for stat in ["sum", "min", "max"]]
+        df = self.read_table(start, end, names, tier).to_pandas()
+        # merge the partial bins written by different flushes (compacted partitions hold one row per bin)
+        agg = {"count": "sum"}
+        for c in channels:
+            agg.update({f"{c}_sum": "sum", f"{c}_min": "min", f"{c}_max": "max"})
+        df = df.groupby("timestamp", as_index=False, sort=True).agg(agg)
+        for c in channels:
+            df[c] = df.pop(f"{c}_sum") / df["count"]
+        return df
@@ -0,0 +1,121 @@
+'''Many dashboard sessions reading one device while the ingest path keeps writing to it
+
+    python benchmarks/concurrent_sessions.py --sessions 1,10,50 --duration 5
+
+every session thread repeats what a Home refresh reads (snapshot, window stats, AI scoring, chart, sparkline)
+and checks that its snapshot is consistent and does not change under it, prints one JSON line per session count '''
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("WATER_MODEL_DIR", tempfile.mkdtemp(prefix="water-bench-models-"))
+os.environ.setdefault("WATER_ARCHIVE_DIR", tempfile.mkdtemp(prefix="water-bench-archive-"))
+
+import numpy as np
+import pandas as pd
+
+from Anomaly_Detection import get_model_manager, isolation_forest_detection, train_isolation_forest
+from charts import time_series_figure
+from data_utils import generate_bulk_data, slice_by_time, water_clean_data
+from devices import get_device
+from sensor_store import to_ns
+from sparklines import sparkline_data_uri
+
+DEVICE = "bench-sessions"
+FEATURES = ['pH', 'TDS', 'turbidity', 'flow', 'temperature']
+
+
+def refresh(device):
+    '''one Home refresh worth of reads, returns the frame it worked on'''
+    df = water_clean_data(DEVICE)
+    last = df["timestamp"].iloc[-1]
+    window = slice_by_time(df, last - pd.Timedelta(hours=1))
+    device.clean_rollups.stats(to_ns(last - pd.Timedelta(hours=1)), to_ns(last) + 1)
+    isolation_forest_detection(df, DEVICE)
+    time_series_figure(df, "turbidity", "Turbidity (NTU)", "mediumorchid", key=(DEVICE, "turbidity"))
+    sparkline_data_uri(window["pH"].to_numpy(), "green", cache_key=(DEVICE, "pH", last, len(window)))
+    return df
+
+
+def check(df):
+    # one snapshot: sorted timestamps and every column as long as the timestamps
+    ts = df["timestamp"].to_numpy()
+    return bool(np.all(ts[1:] >= ts[:-1])) and all(len(df[c]) == len(ts) for c in FEATURES)
+
+
+def run(n_sessions, duration, write_interval, seed):
+    device = get_device(DEVICE)
+    store = device.clean_store
+
+    stop = threading.Event()
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def writer():
+        # one sample every write_interval, like a fast ESP32
+        rng = np.random.default_rng(seed)
+        while not stop.is_set():
+            store.append(pd.Timestamp.now(), {c: float(v) for c, v in zip(FEATURES, rng.normal([7.2, 50, 0.5, 1, 25], 0.1))})
+            time.sleep(write_interval)
+
+    def session():
+        mine = []
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                df = refresh(device)
+                checksum = float(df["pH"].sum())
+                ok = check(df)
+                # the snapshot must not change while the writer keeps going
+                time.sleep(0)
+                ok = ok and float(df["pH"].sum()) == checksum
+                if not ok:
+                    errors.append("inconsistent snapshot")
+            except Exception as e:
+                errors.append(repr(e))
+            mine.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=writer)] + [threading.Thread(target=session) for _ in range(n_sessions)]
+    cpu = time.process_time()
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    cpu = time.process_time() - cpu
+
+    latencies = np.array(latencies) * 1000
+    return {"sessions": n_sessions, "refreshes": len(latencies), "refreshes_per_s": round(len(latencies) / duration, 1),
+            "cpu_ms_per_refresh": round(cpu * 1000 / max(len(latencies), 1), 3),
+            "p50_ms": round(float(np.percentile(latencies, 50)), 3), "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+            "p99_ms": round(float(np.percentile(latencies, 99)), 3), "errors": len(errors), "first_error": errors[0] if errors else None}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", default="1,10,50", help="session counts to run, comma separated")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per session count")
+    parser.add_argument("--hours", type=float, default=24, help="history in the store before the run")
+    parser.add_argument("--write-interval", type=float, default=0.005, help="seconds between written samples")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    # backfill and train once, every session count reads the same device
+    n = int(timedelta(hours=args.hours) / timedelta(seconds=5))
+    history = generate_bulk_data(n, seed=args.seed)
+    get_device(DEVICE).clean_store.extend(history["timestamp"].to_numpy(), history)
+    manager = get_model_manager(DEVICE)
+    manager._current = (train_isolation_forest(history), {"trained_at": pd.Timestamp.now().isoformat(), "n_samples": 10 * n})
+
+    for n_sessions in [int(s) for s in args.sessions.split(",")]:
+        print(json.dumps(run(n_sessions, args.duration, args.write_interval, args.seed)))
@@ -0,0 +1,134 @@
+'''Precision, recall and per sample cost of the streaming detectors against the isolation forest
+
+    python benchmarks/detectors.py --hours 24 --interval 5
+    python benchmarks/detectors.py --profiles bursts,drift --detectors ewma,hst
+
+every profile is seeded synthetic clean water with labelled anomalies (data_utils):
+  points            single false readings from the dirty water profile (generate_bulk_data anomaly_rate)
+  bursts            runs of 6-60 readings from BURST_PROFILE, the distribution inject_anomalies() draws from
+  inject_anomalies  clean history with inject_anomalies() in the last 5 minutes (what the dashboard demo does)
+  drift             points on top of a clogging filter (slow drift that is not an anomaly)
+the forest is trained on the first --train samples like replay.py and scored through isolation_forest_detection(),
+the streaming detectors see the same samples in order. Only the samples after --train are counted.
+bulk = scoring the whole profile at once (us per sample), live = one new sample arriving and the window's labels
+being looked up, what a dashboard refresh pays (ms per tick) '''
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("WATER_MODEL_DIR", tempfile.mkdtemp(prefix="water-bench-models-"))
+
+import numpy as np
+import pandas as pd
+
+from Anomaly_Detection import get_model_manager, isolation_forest_detection, score_caches, train_isolation_forest
+from data_utils import generate_bulk_data, inject_anomalies
+from sensor_store import CHANNELS
+from streaming_detectors import DETECTORS, DetectorScores, make_detector
+
+PROFILES = ["points", "bursts", "inject_anomalies", "drift"]
+# new samples timed one by one for the live numbers
+TICKS = 50
+
+
+def make_profile(name, n, interval, seed):
+    '''(frame, is_anomaly) of a profile, sorted by time'''
+    if name == "points":
+        df = generate_bulk_data(n, interval=interval, seed=seed)
+    elif name == "bursts":
+        df = generate_bulk_data(n, interval=interval, anomaly_rate=0, burst_rate=1e-3, seed=seed)
+    elif name == "inject_anomalies":
+        np.random.seed(seed)
+        df = inject_anomalies(generate_bulk_data(n, interval=interval, anomaly_rate=0, seed=seed), 20)
+    else:
+        df = generate_bulk_data(n, interval=interval, drift="clogging", seed=seed)
+    # rows added by inject_anomalies have no label yet
+    labels = df["is_anomaly"].astype("boolean").fillna(True).to_numpy(dtype=bool)
+    return df.drop(columns="is_anomaly"), labels
+
+
+def quality(predicted, actual):
+    tp = int((predicted & actual).sum())
+    fp = int((predicted & ~actual).sum())
+    fn = int((~predicted & actual).sum())
+    return {"precision": round(tp / (tp + fp), 4) if tp + fp else None,
+            "recall": round(tp / (tp + fn), 4) if tp + fn else None, "tp": tp, "fp": fp, "fn": fn}
+
+
+def forest(df, labels, train, profile):
+    device_id = f"bench-{profile}"
+    model = train_isolation_forest(df.iloc[:train])
+    get_model_manager(device_id).freeze(model, {"trained_at": pd.Timestamp.now().isoformat(), "n_samples": train})
+
+    score_caches.pop(device_id, None)
+    start = time.perf_counter()
+    scored = isolation_forest_detection(df.iloc[:-TICKS], device_id)
+    bulk = (time.perf_counter() - start) / (len(df) - TICKS)
+
+    # the cache knows everything but the last TICKS samples, each refresh scores one new sample
+    start = time.perf_counter()
+    for i in range(TICKS, 0, -1):
+        scored = isolation_forest_detection(df.iloc[:len(df) - i + 1], device_id)
+    live = (time.perf_counter() - start) / TICKS
+
+    predicted = scored["anomaly"].to_numpy() == -1
+    return {"bulk_us_per_sample": round(bulk * 1e6, 2), "live_ms_per_tick": round(live * 1000, 3),
+            **quality(predicted[train:], labels[train:])}
+
+
+def streaming(name, df, labels, train):
+    X = df[CHANNELS].to_numpy()
+    detector = make_detector(name)
+    start = time.perf_counter()
+    detector.fit_score(X)
+    bulk = (time.perf_counter() - start) / len(X)
+
+    # same samples through the store listener, the last TICKS one at a time with a lookup of the window after each
+    listener = DetectorScores(make_detector(name), capacity=len(df) + 1, retention=timedelta(days=365))
+    timestamps = df["timestamp"].to_numpy().view(np.int64)
+    listener.update(timestamps[:-TICKS], {c: X[:-TICKS, k] for k, c in enumerate(CHANNELS)})
+    start = time.perf_counter()
+    for i in range(len(df) - TICKS, len(df)):
+        listener.update(timestamps[i:i + 1], {c: X[i:i + 1, k] for k, c in enumerate(CHANNELS)})
+        predicted, _ = listener.score_frame(df.iloc[:i + 1])
+    live = (time.perf_counter() - start) / TICKS
+
+    predicted = predicted == -1
+    return {"bulk_us_per_sample": round(bulk * 1e6, 2), "live_ms_per_tick": round(live * 1000, 3),
+            **quality(predicted[train:], labels[train:])}
+
+
+def run(profiles, detectors, n, interval, train, seed):
+    report = {"samples": n, "train": train, "profiles": {}}
+    for profile in profiles:
+        df, labels = make_profile(profile, n, interval, seed)
+        print(f"running {profile} ({len(df)} rows, {labels[train:].sum()} anomalies counted)", file=sys.stderr)
+        rows = {"isolation_forest": forest(df, labels, train, profile)}
+        for name in detectors:
+            rows[name] = streaming(name, df, labels, train)
+        report["profiles"][profile] = rows
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--profiles", default=",".join(PROFILES))
+    parser.add_argument("--detectors", default=",".join(DETECTORS))
+    parser.add_argument("--hours", type=float, default=24)
+    parser.add_argument("--interval", type=float, default=5, help="seconds between samples")
+    parser.add_argument("--train", type=int, default=720, help="samples the forest is trained on (not counted)")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    interval = timedelta(seconds=args.interval)
+    report = run(args.profiles.split(","), args.detectors.split(","), int(timedelta(hours=args.hours) / interval),
+                 interval, args.train, args.seed)
+    print(json.dumps(report, indent=2))
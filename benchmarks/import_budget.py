@@ -0,0 +1,116 @@
+'''Cold start import time of the dashboard and the heavy modules every view loads
+
+    python benchmarks/import_budget.py                      # exits with 1 when over the budget
+    python benchmarks/import_budget.py --budget 1.5 --views "Dirty Water,System Maintenance"
+
+cold start: a fresh interpreter imports what streamlit_dashboard.py imports at the top (like a new server worker),
+the wall time is checked against the budget (--budget or WATER_IMPORT_BUDGET_S) and the slowest modules are listed
+from `python -X importtime`. Then every view is opened alone in a fresh interpreter (streamlit AppTest) to check it
+does not load a heavy dependency it does not use (NOT_NEEDED) '''
+
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DASHBOARD = os.path.join(ROOT, "streamlit_dashboard.py")
+
+# seconds, measured at about 1.2 s with sklearn / plotly / pyarrow loaded lazily (2.8 s before)
+BUDGET = float(os.environ.get("WATER_IMPORT_BUDGET_S", 1.5))
+# streamlit already imports plotly.graph_objects and pandas the pyarrow core, these are the parts on top of that
+HEAVY = ["sklearn", "joblib", "plotly.express", "pyarrow.dataset", "pyarrow.parquet", "streamlit_extras"]
+VIEWS = ['Home', 'Clean Water', 'Dirty Water', 'System Maintenance', 'Fleet Overview']
+# view -> heavy modules it must not load
+NOT_NEEDED = {
+    "Dirty Water": ["sklearn", "joblib", "pyarrow.dataset", "pyarrow.parquet"],
+    "System Maintenance": ["sklearn", "joblib", "plotly.express", "pyarrow.dataset", "pyarrow.parquet", "streamlit_extras"],
+}
+
+
+def dashboard_imports():
+    '''modules imported at the top of the dashboard script'''
+    with open(DASHBOARD) as f:
+        tree = ast.parse(f.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            modules.append(node.module)
+    return list(dict.fromkeys(modules))
+
+
+def child_env():
+    # a fresh model / archive folder so nothing is loaded from an earlier run, and no simulated devices
+    env = dict(os.environ, WATER_SIMULATOR="0", PYTHONPATH=ROOT)
+    env.setdefault("WATER_MODEL_DIR", tempfile.mkdtemp(prefix="water-import-models-"))
+    env.setdefault("WATER_ARCHIVE_DIR", tempfile.mkdtemp(prefix="water-import-archive-"))
+    return env
+
+
+def cold_start():
+    '''(seconds, [(module, ms)] slowest top level imports, heavy modules loaded)'''
+    code = ("import sys, time, json\n"
+            "start = time.perf_counter()\n"
+            f"import {', '.join(dashboard_imports())}\n"
+            "seconds = time.perf_counter() - start\n"
+            f"print(json.dumps([seconds, [m for m in {HEAVY!r} if m in sys.modules]]))")
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=ROOT, env=child_env(),
+                         capture_output=True, text=True, check=True)
+    seconds, loaded = json.loads(out.stdout.strip().splitlines()[-1])
+
+    # "import time: self [us] | cumulative | name", top level imports have a single space before the name
+    modules = []
+    for line in out.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line.split("|")
+            if cumulative.strip().isdigit() and len(name) - len(name.lstrip()) == 1:
+                modules.append((name.strip(), int(cumulative) / 1000))
+    return seconds, sorted(modules, key=lambda m: -m[1])[:10], loaded
+
+
+def open_view(view):
+    '''heavy modules loaded after opening one view in a fresh interpreter'''
+    code = ("import sys, time, json, logging\n"
+            "logging.disable(logging.WARNING)\n"
+            "from streamlit.testing.v1 import AppTest\n"
+            f"at = AppTest.from_file({DASHBOARD!r}, default_timeout=120)\n"
+            f"at.session_state['view'] = {view!r}\n"
+            "start = time.perf_counter()\n"
+            "at.run()\n"
+            "seconds = time.perf_counter() - start\n"
+            f"print(json.dumps([seconds, [e.value for e in at.exception], [m for m in {HEAVY!r} if m in sys.modules]]))")
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=child_env(), capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget", type=float, default=BUDGET, help="cold start budget in seconds")
+    parser.add_argument("--views", default=",".join(VIEWS), help="views to open, comma separated (empty = none)")
+    args = parser.parse_args()
+
+    failures = []
+    seconds, slowest, loaded = cold_start()
+    print(f"cold start: {seconds:.3f} s (budget {args.budget:.3f} s), heavy modules loaded: {', '.join(loaded) or 'none'}")
+    for name, ms in slowest:
+        print(f"    {name:<40} {ms:>8.1f} ms")
+    if seconds > args.budget:
+        failures.append(f"cold start {seconds:.3f} s is over the {args.budget:.3f} s budget")
+
+    for view in [v for v in args.views.split(",") if v]:
+        view_seconds, exceptions, loaded = open_view(view)
+        print(f"{view:<20} first run {view_seconds:.3f} s, heavy modules loaded: {', '.join(loaded) or 'none'}")
+        if exceptions:
+            failures.append(f"{view}: {exceptions[0]}")
+        extra = [m for m in NOT_NEEDED.get(view, []) if m in loaded]
+        if extra:
+            failures.append(f"{view} loads {', '.join(extra)} without using it")
+
+    for failure in failures:
+        print("FAIL", failure)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,129 @@
+'''Memory of the default (float64) and the compact (float32, WATER_COMPACT_SCHEMA=1) sample layout
+
+    python benchmarks/memory_layout.py --devices 4 --hours 24 --interval 1
+
+fills the stores of N devices in both layouts and reports the bytes held by the stores, the size of a fleet wide frame
+(strings + datetime64[ns] + float64 vs devices.fleet_frame) and, for the consumers of one device frame, the time,
+the peak memory (tracemalloc) and the dtype they hand back, a float64 result from float32 input means an upcast '''
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("WATER_MODEL_DIR", tempfile.mkdtemp(prefix="water-bench-models-"))
+
+import numpy as np
+import pandas as pd
+
+from Anomaly_Detection import (detect_anomalies, get_model_manager, isolation_forest_detection, score_caches,
+                               train_isolation_forest)
+from charts import time_series_figure
+from data_utils import calculate_wqi_array, create_trend_background, generate_bulk_data, slice_by_time
+import devices
+from devices import fleet_frame, get_device, model_group
+
+LAYOUTS = {"float64": np.float64, "compact": np.float32}
+
+
+def store_bytes(store):
+    # allocated (the arrays are up to twice the capacity) and live bytes of a store
+    allocated = store._ts.nbytes + sum(values.nbytes for values in store._cols.values())
+    live = len(store) * (store._ts.itemsize + len(store.columns) * store.dtype.itemsize)
+    return allocated, live
+
+
+def measure(fn):
+    '''(ms, peak MB, result) of fn()'''
+    fn()
+    start = time.perf_counter()
+    fn()
+    ms = (time.perf_counter() - start) * 1000
+    tracemalloc.start()
+    result = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return round(ms, 3), round(peak / 2**20, 3), result
+
+
+def fill(layout, n_devices, n, interval, seed):
+    # devices pick their dtype when they are created, so switch it while creating this layout's devices
+    devices.SAMPLE_DTYPE = LAYOUTS[layout]
+    ids = [f"{layout}-{i}" for i in range(n_devices)]
+    for i, device_id in enumerate(ids):
+        history = generate_bulk_data(n, interval=interval, seed=seed + i)
+        get_device(device_id).clean_store.extend(history["timestamp"].to_numpy(), history)
+    return ids
+
+
+def consumers(df, device_id, model):
+    get_model_manager(device_id)._current = (model, {"trained_at": pd.Timestamp.now().isoformat(), "n_samples": len(df)})
+    last = df["timestamp"].iloc[-1]
+
+    def score_all():
+        # every sample through the model (no cached scores)
+        score_caches.pop(device_id, None)
+        return isolation_forest_detection(df, device_id)["anomaly_score"]
+
+    cases = {
+        "calculate_wqi_array": lambda: calculate_wqi_array(df["pH"], df["TDS"], df["turbidity"]),
+        "slice_by_time": lambda: slice_by_time(df, last - pd.Timedelta(hours=1)),
+        "detect_anomalies": lambda: detect_anomalies(df),
+        "isolation_forest_detection": score_all,
+        "time_series_figure": lambda: time_series_figure(df, "turbidity", "Turbidity (NTU)", "mediumorchid"),
+        "create_trend_background": lambda: create_trend_background(df, "pH") and None,
+    }
+    rows = {}
+    for name, fn in cases.items():
+        ms, peak, result = measure(fn)
+        dtype = str(result.dtype) if hasattr(result, "dtype") else None
+        rows[name] = {"ms": ms, "peak_mb": peak, "result_dtype": dtype}
+    return rows
+
+
+def run(n_devices, hours, interval, seed):
+    n = int(timedelta(hours=hours) / interval)
+    report = {"devices": n_devices, "samples_per_device": n, "layouts": {}}
+    model = None
+    for layout in LAYOUTS:
+        ids = fill(layout, n_devices, n, interval, seed)
+        allocated, live = np.sum([store_bytes(get_device(d).clean_store) for d in ids], axis=0)
+
+        if layout == "float64":
+            # what a fleet wide frame looks like without the compact schema
+            fleet = pd.concat([get_device(d).clean_store.to_frame().assign(device=d, site=model_group(d)) for d in ids],
+                              ignore_index=True)
+        else:
+            fleet = fleet_frame(devices=ids)
+
+        df = get_device(ids[0]).clean_store.to_frame()
+        model = model or train_isolation_forest(df)
+        report["layouts"][layout] = {
+            "store_allocated_mb": round(allocated / 2**20, 2), "store_live_mb": round(live / 2**20, 2),
+            "fleet_frame_mb": round(fleet.memory_usage(deep=True).sum() / 2**20, 2),
+            "fleet_frame_dtypes": {c: str(t) for c, t in fleet.dtypes.items()},
+            "consumers": consumers(df, ids[0], model),
+        }
+
+    default, compact = report["layouts"]["float64"], report["layouts"]["compact"]
+    report["reduction"] = {key: f"{1 - compact[key] / default[key]:.0%}"
+                           for key in ["store_allocated_mb", "store_live_mb", "fleet_frame_mb"]}
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--hours", type=float, default=24)
+    parser.add_argument("--interval", type=float, default=1, help="seconds between samples")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    print(json.dumps(run(args.devices, args.hours, timedelta(seconds=args.interval), args.seed), indent=2))
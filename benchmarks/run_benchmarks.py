@@ -0,0 +1,257 @@
+'''Benchmarks for the data, detection and rendering hot paths (headless, no browser needed)
+
+    python benchmarks/run_benchmarks.py --output bench.json
+    python benchmarks/run_benchmarks.py --sizes 1h,24h --intervals 5 --repeat 3
+    python benchmarks/run_benchmarks.py --compare old.json new.json
+
+every case runs on seeded synthetic data sized to 1 hour / 24 hours / 7 days at 5 and 1 second sampling,
+timings are in milliseconds (min and median of --repeat runs) and peak memory comes from tracemalloc '''
+
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import timedelta
+from itertools import count
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# keep the benchmark model away from the dashboard's models/ folder
+os.environ.setdefault("WATER_MODEL_DIR", tempfile.mkdtemp(prefix="water-bench-models-"))
+
+import numpy as np
+import pandas as pd
+import sklearn
+
+from alerts import AlertEngine
+from charts import gauge_figure, time_series_figure
+from Anomaly_Detection import ScoreCache, detect_anomalies, isolation_forest_detection, get_model_manager, train_isolation_forest
+from data_utils import calculate_wqi, calculate_wqi_array, create_trend_background, generate_bulk_data
+from devices import _wqi_channel
+from maintenance import MaintenanceEngine
+from downsampling import downsample_indices
+from rollups import RollupSet
+from sensor_store import SensorStore
+import sparklines
+from streaming_detectors import DETECTORS, DetectorScores, make_detector
+from Styling import metric_style_
+
+SIZES = {"1h": timedelta(hours=1), "24h": timedelta(hours=24), "7d": timedelta(days=7)}
+FEATURES = ['pH', 'TDS', 'turbidity', 'flow', 'temperature']
+# single appends timed on top of a full store (one dashboard tick each)
+TICKS = 200
+
+
+def measure(fn, repeat):
+    '''(min ms, median ms, peak MB) of fn()'''
+    fn()  # warm up (imports, caches of the first call)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"min_ms": round(min(times), 4), "median_ms": round(statistics.median(times), 4),
+            "peak_mb": round(peak / 2**20, 3)}
+
+
+def make_store(df, retention):
+    # same setup as a device store: derived wqi channel + rollups
+    store = SensorStore(capacity=len(df) + TICKS + 1, retention=retention + timedelta(minutes=5),
+                        derived={"wqi": _wqi_channel})
+    rollups = RollupSet(store, retention_seconds=int(retention.total_seconds()))
+    store.extend(df["timestamp"].to_numpy(), df)
+    return store, rollups
+
+
+def run_cases(df, retention, repeat):
+    store, rollups = make_store(df, retention)
+    frame = store.to_frame()
+    last = df["timestamp"].iloc[-1]
+    row = {c: float(df[c].iloc[-1]) for c in FEATURES}
+    model = train_isolation_forest(frame)
+    # new samples 1 ms apart after the generated data, so every append takes the in order path
+    clock = count(1)
+
+    def tick():
+        # what water_clean_data() does per refresh once a sample arrived: append, evict, snapshot
+        for _ in range(TICKS):
+            now = last + pd.Timedelta(milliseconds=next(clock))
+            store.append(now, row)
+            store.evict(now=now)
+            store.to_frame()
+
+    # alert engine fed the whole history, then timed per new sample (what replaced detect_anomalies)
+    engine = AlertEngine()
+    ts_ns_all = df["timestamp"].to_numpy().view(np.int64)
+    engine.update(ts_ns_all, df)
+
+    def alert_tick():
+        for _ in range(TICKS):
+            now = ts_ns_all[-1] + next(clock) * 1_000_000
+            engine.update(np.array([now]), {c: [v] for c, v in row.items()})
+
+    # same for the maintenance estimators
+    maintenance = MaintenanceEngine()
+    maintenance.update(ts_ns_all, df)
+
+    def maintenance_tick():
+        for _ in range(TICKS):
+            now = ts_ns_all[-1] + next(clock) * 1_000_000
+            maintenance.update(np.array([now]), {c: [v] for c, v in row.items()})
+
+    # streaming detectors (store listeners as well) fed the history, then one sample at a time
+    detectors = {}
+    for name in DETECTORS:
+        detectors[name] = DetectorScores(make_detector(name), store.capacity, store.retention)
+        detectors[name].update(ts_ns_all, df)
+
+    def detector_tick(listener):
+        def run():
+            for _ in range(TICKS):
+                now = ts_ns_all[-1] + next(clock) * 1_000_000
+                listener.update(np.array([now]), {c: [v] for c, v in row.items()})
+        return run
+
+    def trend_background_cold():
+        sparklines._cache.clear()
+        create_trend_background(frame, "pH")
+
+    def predict_full():
+        ScoreCache().score(model, frame)
+
+    warm = ScoreCache()
+    warm.score(model, frame.iloc[:-1])
+
+    def predict_incremental():
+        # one new sample since the last refresh
+        warm.score(model, frame.iloc[1:])
+        warm.score(model, frame.iloc[:-1])
+
+    manager = get_model_manager("benchmark")
+    manager._current = (model, {"trained_at": pd.Timestamp.now().isoformat(), "n_samples": len(frame)})
+
+    def plotly_json(fig):
+        # what st.plotly_chart does with a figure (plotly.io picks orjson when it is installed)
+        import plotly.io
+        return lambda: plotly.io.to_json(fig.to_dict(), validate=False)
+
+    chart = time_series_figure(frame, "turbidity", "Turbidity (NTU)", "mediumorchid")
+
+    means = {c: frame[c].mean() for c in ["pH", "TDS", "turbidity"]}
+    ts_ns = frame["timestamp"].to_numpy().view(np.int64)
+    color = "green"
+
+    cases = {
+        "water_clean_data.append_evict_tick": (tick, TICKS),
+        "rollups.window_stats": (lambda: rollups.stats(ts_ns[0], ts_ns[-1] + 1), 1),
+        "detect_anomalies": (lambda: detect_anomalies(frame), 1),
+        "alerts.update_per_sample": (alert_tick, TICKS),
+        "alerts.active_alerts": (engine.active_alerts, 1),
+        "maintenance.update_per_sample": (maintenance_tick, TICKS),
+        "maintenance.status": (maintenance.status, 1),
+        **{f"detector.{name}.update_per_sample": (detector_tick(listener), TICKS) for name, listener in detectors.items()},
+        "isolation_forest.train": (lambda: train_isolation_forest(frame), 1),
+        "isolation_forest.predict_full": (predict_full, 1),
+        "isolation_forest.predict_incremental": (predict_incremental, 2),
+        "isolation_forest_detection": (lambda: isolation_forest_detection(frame, "benchmark"), 1),
+        "calculate_wqi.scalar": (lambda: calculate_wqi(means["pH"], means["TDS"], means["turbidity"]), 1),
+        "calculate_wqi.array": (lambda: calculate_wqi_array(frame["pH"], frame["TDS"], frame["turbidity"]), 1),
+        "create_trend_background.cold": (trend_background_cold, 1),
+        "create_trend_background.cached": (lambda: create_trend_background(frame, "pH"), 1),
+        "metric_style_.sparkline_cold": (lambda: metric_style_("Average pH", 7.2, "", color, frame["pH"].to_numpy()), 1),
+        "metric_style_.sparkline_cached": (lambda: metric_style_("Average pH", 7.2, "", color, frame["pH"].to_numpy(),
+                                                                 cache_key=("pH", ts_ns[-1])), 1),
+        "charts.gauge_figure": (lambda: gauge_figure("temperature", row["temperature"]), 1),
+        "charts.gauge_json": (plotly_json(gauge_figure("pH", row["pH"])), 1),
+        # new data, no figure cache: downsampling + the figure from its template
+        "charts.time_series_figure": (lambda: time_series_figure(frame, "turbidity", "Turbidity (NTU)", "mediumorchid"), 1),
+        "charts.time_series_json": (plotly_json(chart), 1),
+        "downsample.lttb_1200px": (lambda: downsample_indices(ts_ns, frame["TDS"].to_numpy(), 1200), 1),
+    }
+
+    results = []
+    for name, (fn, calls) in cases.items():
+        result = measure(fn, repeat)
+        # per call numbers for cases that loop
+        if calls > 1:
+            result["min_ms"] = round(result["min_ms"] / calls, 4)
+            result["median_ms"] = round(result["median_ms"] / calls, 4)
+        results.append({"case": name, **result})
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def run(sizes, intervals, repeat, seed):
+    report = {
+        "meta": {"commit": git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+                 "numpy": np.__version__, "pandas": pd.__version__, "sklearn": sklearn.__version__,
+                 "seed": seed, "repeat": repeat},
+        "results": [],
+    }
+    for size in sizes:
+        for interval in intervals:
+            n = int(SIZES[size] / timedelta(seconds=interval))
+            df = generate_bulk_data(n, interval=timedelta(seconds=interval), burst_rate=1e-4, seed=seed)
+            dataset = f"{size}@{interval}s"
+            print(f"running {dataset} ({n} rows)", file=sys.stderr)
+            for result in run_cases(df, SIZES[size], repeat):
+                report["results"].append({"dataset": dataset, "rows": n, **result})
+    return report
+
+
+def compare(old_path, new_path, threshold=1.2):
+    '''print old vs new median per case, cases slower by more than `threshold` are flagged'''
+    with open(old_path) as f:
+        old = {(r["dataset"], r["case"]): r for r in json.load(f)["results"]}
+    with open(new_path) as f:
+        new = {(r["dataset"], r["case"]): r for r in json.load(f)["results"]}
+
+    regressions = 0
+    print(f"{'dataset':<10} {'case':<40} {'old ms':>10} {'new ms':>10} {'ratio':>7}")
+    for key in sorted(old.keys() & new.keys()):
+        ratio = new[key]["median_ms"] / old[key]["median_ms"] if old[key]["median_ms"] else float("inf")
+        flag = "  <-- slower" if ratio > threshold else ""
+        regressions += ratio > threshold
+        print(f"{key[0]:<10} {key[1]:<40} {old[key]['median_ms']:>10.3f} {new[key]['median_ms']:>10.3f} {ratio:>7.2f}{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1h,24h,7d", help="comma separated, from " + ",".join(SIZES))
+    parser.add_argument("--intervals", default="5,1", help="sampling intervals in seconds, comma separated")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two JSON reports")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare) else 0)
+
+    # metric_style_ writes to streamlit, outside of `streamlit run` that only logs a warning per call
+    logging.disable(logging.WARNING)
+    report = run(args.sizes.split(","), [float(i) for i in args.intervals.split(",")], args.repeat, args.seed)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,139 @@
+import threading
+from collections import OrderedDict
+from data_utils import healthy_drinkable_water_ranges
+from downsampling import downsample_frame
+
+
+# charts are about this wide in the wide layout, we never send more points than pixels
+CHART_WIDTH_PX = 1200
+# above this many points (e.g. lots of kept anomalies) the chart is drawn with WebGL instead of SVG
+WEBGL_THRESHOLD = 5000
+
+# figures by (key, chart settings, data shown), shared by all sessions, only rebuilt when the data changed
+_figures = OrderedDict()
+CACHE_SIZE = 64
+_figures_lock = threading.Lock()
+
+# figure templates: the layout and trace styling of every kind of figure are built (and validated) once with plotly,
+# a refresh only puts the new values into a copy of them, go.Figure(..., _validate=False) does not check them again.
+# st.plotly_chart then serializes with plotly.io.to_json, which uses orjson when it is installed (requirements.txt)
+_templates = {}
+_templates_lock = threading.Lock()
+
+# gauges of the stream views, the temperature gauge marks the current value with its threshold line
+GAUGES = {
+    "pH": {
+        "title": "Ph Level",
+        "margin": dict(t=5, b=5, l=20, r=25),
+        "gauge": {'axis': {'range': [0, 14], 'tickmode': 'linear', 'tick0': 0, 'dtick': 2, 'tickfont': {'size': 14}},
+                  'bar': {'color': 'blue'},
+                  'steps': [{'range': [0, 6.5], 'color': "red"},
+                            {'range': [6.5, 9.5], 'color': "green"},
+                            {'range': [9.5, 14], 'color': "orange"}]},
+    },
+    "temperature": {
+        "title": "Temperature (°C)",
+        "margin": dict(t=5, b=5, l=20, r=20),
+        "gauge": {'axis': {'range': [0, 60], 'tickmode': 'linear', 'tick0': 0, 'dtick': 10, 'tickwidth': 1,
+                           'tickcolor': 'darkgray'},
+                  'bar': {'color': 'blue'},
+                  'steps': [{'range': [0, 30], 'color': "#81D4FA"},
+                            {'range': [30, 60], 'color': "#FFB74D"}],
+                  'threshold': {'line': {'color': "black", 'width': 4}, 'thickness': 0.75, 'value': 0}},
+    },
+}
+
+
+def _template(key, build, fields):
+    '''(trace dict without `fields`, layout dict) of the one trace figure build() returns, built once per key'''
+    with _templates_lock:
+        if key not in _templates:
+            fig = build().to_dict()
+            trace = {k: v for k, v in fig["data"][0].items() if k not in fields}
+            _templates[key] = (trace, fig["layout"])
+        return _templates[key]
+
+
+def _from_template(template, values):
+    # new figure on top of the template, the template itself is never modified
+    import plotly.graph_objects as go
+    trace, layout = template
+    return go.Figure({"data": [{**trace, **values}], "layout": layout}, _validate=False)
+
+
+def gauge_figure(channel, value):
+    '''gauge of the latest value of a channel in GAUGES'''
+    def build():
+        import plotly.graph_objects as go
+        spec = GAUGES[channel]
+        fig = go.Figure(go.Indicator(mode="gauge+number", value=value, domain={'x': [0, 1], 'y': [0, 1]},
+                                     title={'text': spec["title"]}, gauge=spec["gauge"]))
+        fig.update_layout(height=400, margin=spec["margin"])
+        return fig
+
+    template = _template(("gauge", channel), build, ["value"])
+    values = {"value": value}
+    gauge = template[0]["gauge"]
+    if "threshold" in gauge:
+        values["gauge"] = {**gauge, "threshold": {**gauge["threshold"], "value": value}}
+    return _from_template(template, values)
+
+
+def time_series_figure(df, y, title, color, area=False, key=None, width=CHART_WIDTH_PX):
+    '''line (or area) chart of df[y] over time, downsampled to the chart width
+         points outside the drinkable range (when y has one) are always kept so spikes stay visible
+         with a key the figure is reused until the data changes (callers must not modify it) '''
+
+    if key is None or df.empty:
+        return _build_figure(df, y, title, color, area, key, width)
+
+    timestamps = df["timestamp"].to_numpy()
+    cache_key = (key, y, title, color, area, width, timestamps[0], timestamps[-1], len(df))
+    # built under the lock: when new data arrives every open session asks for the same figure at once,
+    # one of them builds it and the others get it from the cache
+    with _figures_lock:
+        fig = _figures.get(cache_key)
+        if fig is not None:
+            _figures.move_to_end(cache_key)
+            return fig
+
+        fig = _build_figure(df, y, title, color, area, key, width)
+        _figures[cache_key] = fig
+        if len(_figures) > CACHE_SIZE:
+            _figures.popitem(last=False)
+        return fig
+
+
+def _build_figure(df, y, title, color, area, key, width):
+    keep = None
+    if y in healthy_drinkable_water_ranges():
+        min_, max_ = healthy_drinkable_water_ranges()[y]
+        values = df[y].to_numpy()
+        keep = (values < min_) | (values > max_)
+    # an area chart is mostly about peaks -> min/max per pixel, lines look best with LTTB
+    plot_df = downsample_frame(df, y, width, method="minmax" if area else "lttb", keep=keep, key=key)
+
+    webgl = len(plot_df) > WEBGL_THRESHOLD
+    template = _template(("series", y, title, color, area, webgl),
+                         lambda: _style_figure(plot_df, y, title, color, area, webgl), ["x", "y"])
+    return _from_template(template, {"x": plot_df["timestamp"].to_numpy(), "y": plot_df[y].to_numpy()})
+
+
+def _style_figure(plot_df, y, title, color, area, webgl):
+    # the first figure of a kind of chart, only its styling is kept (see _template)
+    # plotly (express especially) is only imported by the views that draw a chart
+    import plotly.express as px
+    import plotly.graph_objects as go
+
+    if webgl:
+        fig = go.Figure(go.Scattergl(x=plot_df["timestamp"], y=plot_df[y], mode="lines",
+                                     fill="tozeroy" if area else None, line=dict(color=color)))
+        fig.update_layout(title=title, xaxis_title="timestamp", yaxis_title=y)
+        return fig
+
+    if area:
+        fig = px.area(plot_df, x="timestamp", y=y, title=title)
+    else:
+        fig = px.line(plot_df, x="timestamp", y=y, title=title)
+    fig.update_traces(line=dict(color=color))
+    return fig
@@ -2,20 +2,26 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import random
-import matplotlib.pyplot as plt
-import streamlit as st
-from io import BytesIO
-import base64
+from sensor_store import to_ns
+from sparklines import sparkline_data_uri
+from devices import DEFAULT_DEVICE, get_device
 
 
-clean_df = pd.DataFrame()
-dirty_df = pd.DataFrame()
+# every purifier unit has its own ring buffers (last 24 hr), rollups and archive, see devices.py
+# the names below are the default unit, the dashboard passes a device_id for the others
+default_device = get_device(DEFAULT_DEVICE)
+clean_store, dirty_store = default_device.clean_store, default_device.dirty_store
+clean_rollups, dirty_rollups = default_device.clean_rollups, default_device.dirty_rollups
+clean_archive, dirty_archive = default_device.clean_archive, default_device.dirty_archive
 
 
 # Functions to generate synthetic data, this should be replaced to real-time sensors data
-# we receive from the system thru the ESP32 & some API (Flask?)
+# we receive from the system thru the ESP32 & the ingestion service (ingest_service.py)
 
 def generate_realtime_data(clean=True):
+    return pd.DataFrame([generate_realtime_point(clean)])
+
+def generate_realtime_point(clean=True):
     # introduce random anomaly 3% of the time of generating data
     timestamp = datetime.now()
 
@@ -35,42 +41,44 @@ def generate_realtime_data(clean=True):
         #"pressure": np.random.normal(1.5, 0.1),
         "temperature": np.random.normal(25, 1)
     }
-    return pd.DataFrame([data_point])
-
-def water_clean_data():
-    global clean_df
-    new_row = generate_realtime_data(clean=True)
-    #clean_df.loc[len(clean_df)] = new_row
-    clean_df = pd.concat([clean_df, new_row], ignore_index=True)
+    return data_point
 
+# samples are written by the ingestion service (ingest_service.py), the dashboard only reads them
+def water_clean_data(device_id=DEFAULT_DEVICE):
+    store = get_device(device_id).clean_store
     # keep only last 24 hr to avoid memory bloating
-    timestamp = datetime.now() - timedelta(hours=24)
-    clean_df = clean_df[clean_df["timestamp"] >= timestamp]
-
-    return clean_df.reset_index(drop=True)
+    store.evict()
 
-def water_dirty_data():
-    global dirty_df
-    new_row = generate_realtime_data(clean=False)
-
-    dirty_df = pd.concat([dirty_df, new_row], ignore_index=True)
+    return store.to_frame()
 
+def water_dirty_data(device_id=DEFAULT_DEVICE):
+    store = get_device(device_id).dirty_store
     # keep only last 24 hr to avoid memory bloating
-    timestamp = datetime.now() - timedelta(hours=24)
-    dirty_df = dirty_df[dirty_df["timestamp"] >= timestamp]
+    store.evict()
+
+    return store.to_frame()
 
-    return dirty_df.reset_index(drop=True)
 
+# frames from the stores are sorted by timestamp, so a time window is a binary search + a slice (no copy)
+def slice_by_time(df, start, end=None):
+    timestamps = df['timestamp'].to_numpy()
+    # bounds in the unit of the column (ns for the stores, ms for compact frames) so the column is not converted
+    unit = timestamps.dtype
+    lo = np.searchsorted(timestamps, np.datetime64(start, 'ns').astype(unit), side='left')
+    hi = len(df) if end is None else np.searchsorted(timestamps, np.datetime64(end, 'ns').astype(unit), side='left')
+    return df.iloc[lo:hi]
 
 #function to filter data by hour if needed by user
 def filter_by_duration(df, hours=1):
-    latest_time = df['timestamp'].max()
+    if df.empty:
+        return df
+    latest_time = df['timestamp'].iloc[-1]
     start_time = latest_time - pd.Timedelta(hours=hours)
-    return df[df['timestamp'] >= start_time]
+    return slice_by_time(df, start_time)
 
 # deg=fine drinkable water parameters
 def healthy_drinkable_water_ranges():
-    healthy_data = healthy_ranges = {
+    healthy_data = {
     "pH": (6.5, 8.5),
     "TDS": (0, 1000),
     "turbidity": (0, 1),
@@ -85,52 +93,132 @@ def healthy_drinkable_water_ranges():
 # Trying to simulate injection of anomalies into the dataset to simulate the alerting system
 
 def inject_anomalies(df, num_anomalies=20):
-    for _ in range(num_anomalies):
-        # inject within the last 5 minutes
-        timestamp = datetime.now() - timedelta(minutes=np.random.uniform(0, 5))
-
-        anomaly_data = {
-            "timestamp": timestamp,
-            "pH": np.random.normal(8.5, 0.1),
-            "TDS": np.random.normal(900, 50),
-            "turbidity": np.random.normal(35, 5),
-            #"conductivity": np.random.normal(950, 20),
-            "flow": np.random.normal(6, 0.05),
-            #"pressure": np.random.normal(3.5, 0.1),
-            "temperature": np.random.normal(29, 1)
-        }
+    # inject within the last 5 minutes, all anomalies are drawn at once and concatenated once
+    minutes_ago = np.random.uniform(0, 5, num_anomalies)
+
+    anomaly_data = {
+        "timestamp": (pd.Timestamp(datetime.now()) - pd.to_timedelta(minutes_ago, unit="m")).as_unit("ns"),
+        "pH": np.random.normal(8.5, 0.1, num_anomalies),
+        "TDS": np.random.normal(900, 50, num_anomalies),
+        "turbidity": np.random.normal(35, 5, num_anomalies),
+        #"conductivity": np.random.normal(950, 20, num_anomalies),
+        "flow": np.random.normal(6, 0.05, num_anomalies),
+        #"pressure": np.random.normal(3.5, 0.1, num_anomalies),
+        "temperature": np.random.normal(29, 1, num_anomalies)
+    }
 
-        df = pd.concat([df, pd.DataFrame([anomaly_data])], ignore_index=True)
-    return df
+    if "wqi" in df:
+        # frames from the stores carry the per sample WQI
+        anomaly_data["wqi"] = calculate_wqi_array(anomaly_data["pH"], anomaly_data["TDS"], anomaly_data["turbidity"])
+
+    # keep the frame sorted by time like everything coming out of the stores
+    df = pd.concat([df, pd.DataFrame(anomaly_data)], ignore_index=True)
+    return df.sort_values("timestamp", kind="stable", ignore_index=True)
+
+
+# Bulk synthetic data for load tests and for backfilling the stores
+# (mean, std) per channel, same distributions as generate_realtime_data() and inject_anomalies()
+CLEAN_PROFILE = {"pH": (7.2, 0.1), "TDS": (50, 10), "turbidity": (0.5, 0.2), "flow": (1.0, 0.1), "temperature": (25, 1)}
+DIRTY_PROFILE = {"pH": (5.5, 0.3), "TDS": (800, 100), "turbidity": (30, 10), "flow": (1.0, 0.1), "temperature": (25, 1)}
+BURST_PROFILE = {"pH": (8.5, 0.1), "TDS": (900, 50), "turbidity": (35, 5), "flow": (6, 0.05), "temperature": (29, 1)}
+
+# slow changes over time, each profile adds an offset per channel given the elapsed seconds
+DRIFT_PROFILES = {
+    "none": lambda t: {},
+    # filter clogging: turbidity and TDS creep up and flow drops a little every day
+    "clogging": lambda t: {"turbidity": 0.3 * t / 86400, "TDS": 40 * t / 86400, "flow": -0.15 * t / 86400},
+    # day / night temperature cycle
+    "daily": lambda t: {"temperature": 1.5 * np.sin(2 * np.pi * t / 86400)},
+}
+
+
+def generate_bulk_data(n, end=None, interval=timedelta(seconds=5), clean=True, anomaly_rate=0.03,
+                       burst_rate=0.0, burst_length=(6, 60), drift="none", seed=None):
+    '''Generate n samples for all channels in one shot (vectorized)
+         samples are spaced by `interval` and end at `end` (default now)
+         anomaly_rate = share of single readings drawn from the dirty profile (like generate_realtime_data)
+         burst_rate = chance per sample that a burst of injected anomalies starts, lasting burst_length samples
+         drift = name (or list of names) from DRIFT_PROFILES
+         the is_anomaly column flags every sample that was made anomalous '''
+
+    rng = np.random.default_rng(seed)
+    end = datetime.now() if end is None else end
+    step = int(interval.total_seconds() * 1e9)
+    timestamps = to_ns(end) - step * np.arange(n - 1, -1, -1, dtype=np.int64)
+
+    profile = CLEAN_PROFILE if clean else DIRTY_PROFILE
+    columns = {c: rng.normal(mean, std, n) for c, (mean, std) in profile.items()}
+
+    # single false readings
+    point = rng.random(n) < anomaly_rate if clean else np.zeros(n, dtype=bool)
+    for c, (mean, std) in DIRTY_PROFILE.items():
+        columns[c][point] = rng.normal(mean, std, point.sum())
+
+    # bursts: +1 where a burst starts and -1 where it ends, the running sum marks the samples inside one
+    starts = np.flatnonzero(rng.random(n) < burst_rate)
+    lengths = rng.integers(burst_length[0], burst_length[1] + 1, len(starts))
+    edges = np.zeros(n + 1, dtype=np.int64)
+    np.add.at(edges, starts, 1)
+    np.add.at(edges, np.minimum(starts + lengths, n), -1)
+    burst = np.cumsum(edges[:-1]) > 0
+    for c, (mean, std) in BURST_PROFILE.items():
+        columns[c][burst] = rng.normal(mean, std, burst.sum())
+
+    elapsed = (timestamps - timestamps[0]) / 1e9
+    for name in [drift] if isinstance(drift, str) else drift:
+        for c, offset in DRIFT_PROFILES[name](elapsed).items():
+            columns[c] += offset
+
+    data = {"timestamp": timestamps.view("datetime64[ns]")}
+    data.update(columns)
+    data["is_anomaly"] = point | burst
+    return pd.DataFrame(data, copy=False)
+
+
+def backfill_stores(hours=None, interval=timedelta(seconds=5), seed=None, devices=(DEFAULT_DEVICE,), **kwargs):
+    '''Pre-populate the clean and dirty stores of the given devices with synthetic history ending now
+         by default the full retention window of each store (24 hr) '''
+
+    i = 0
+    for device_id in devices:
+        device = get_device(device_id)
+        for store, clean in [(device.clean_store, True), (device.dirty_store, False)]:
+            window = timedelta(hours=hours) if hours is not None else store.retention
+            n = int(window / interval)
+            df = generate_bulk_data(n, interval=interval, clean=clean,
+                                    seed=None if seed is None else seed + i, **kwargs)
+            store.extend(df["timestamp"].to_numpy(), df)
+            store.evict()
+            i += 1
 
 
 def calculate_wqi(pH, tds, turbidity):
-    # Normalize parameters to 0–100 scale
+    # scalar version (e.g. for window averages), same sub-indices as calculate_wqi_array
+    return round(float(calculate_wqi_array(pH, tds, turbidity)), 2)
+
+
+def calculate_wqi_array(pH, tds, turbidity):
+    # Normalize parameters to 0–100 scale, works on whole numpy arrays (one WQI per sample)
+    # float32 inputs stay float32 (compact schema), anything else is computed in float64
+    dtype = np.result_type(np.asarray(pH).dtype, np.asarray(tds).dtype, np.asarray(turbidity).dtype, np.float32)
+    pH, tds, turbidity = np.asarray(pH, dtype=dtype), np.asarray(tds, dtype=dtype), np.asarray(turbidity, dtype=dtype)
 
-    pH_index = 100 if 6.5 <= pH <= 8.5 else max(0, 100 - min(abs(pH - 7), abs(pH - 7.5)) * 30)
-    pH_index = min(pH_index, 100)
+    pH_index = np.where((pH >= 6.5) & (pH <= 8.5), 100, np.maximum(0, 100 - np.minimum(np.abs(pH - 7), np.abs(pH - 7.5)) * 30))
+    pH_index = np.minimum(pH_index, 100)
 
-    tds_index = 100 if tds < 300 else max(0, 100 - tds * 0.1)
-    tds_index = min(tds_index, 100)
+    tds_index = np.where(tds < 300, 100, np.maximum(0, 100 - tds * 0.1))
+    tds_index = np.minimum(tds_index, 100)
 
-    turbidity_index = 100 if turbidity < 1 else max(0, 100 - (turbidity - 5) * 10)
-    turbidity_index = min(turbidity_index, 100)
+    turbidity_index = np.where(turbidity < 1, 100, np.maximum(0, 100 - (turbidity - 5) * 10))
+    turbidity_index = np.minimum(turbidity_index, 100)
 
     wqi = (pH_index + tds_index + turbidity_index) / 3
 
-    return round(min(wqi, 100), 2)
+    return np.minimum(wqi, 100)
 
 # Function to create parameter plots-trends for selected user duration to view as a background for the avg cards in the summary page
-def create_trend_background(df, column):
-    fig, ax = plt.subplots(figsize=(3, 1.5))
-    ax.plot(df["timestamp"], df[column], color='#2196F3', linewidth=2)
-    ax.axis('off')
-    fig.patch.set_alpha(0)  # transparent figure background
-    ax.patch.set_alpha(0)   # transparent axis background
-
-    buf = BytesIO()
-    plt.savefig(buf, format="png", bbox_inches='tight', transparent=True)
-    buf.seek(0)
-    encoded = base64.b64encode(buf.read()).decode()
-    plt.close(fig)
-    return f"data:image/png;base64,{encoded}"
+def create_trend_background(df, column, color='#2196F3'):
+    # svg sparkline (see sparklines.py), cached on the column and the window shown
+    timestamps = df["timestamp"].to_numpy()
+    cache_key = (column, timestamps[0], timestamps[-1], len(df)) if len(df) else None
+    return sparkline_data_uri(df[column].to_numpy(), color, cache_key=cache_key)
@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from alerts import AlertEngine
+from archive import SensorArchive, ARCHIVE_DIR
+from maintenance import MaintenanceEngine
+from rollups import RollupSet
+from sensor_store import SensorStore, compact_frame
+from streaming_detectors import DETECTOR, DetectorScores, make_detector
+
+
+# One set of stores per purifier unit, created the first time a device sends data (or is asked for)
+
+DEFAULT_DEVICE = os.environ.get("WATER_DEFAULT_DEVICE", "purifier-1")
+
+# optional {"device id": "cluster name"} so similar units share one model, e.g. '{"purifier-2": "plant-a"}'
+MODEL_GROUPS = json.loads(os.environ.get("WATER_MODEL_GROUPS", "{}"))
+
+# WATER_COMPACT_SCHEMA=1 keeps the channels as float32 (half the memory per sample, plenty for these sensors)
+COMPACT_SCHEMA = os.environ.get("WATER_COMPACT_SCHEMA", "0") == "1"
+SAMPLE_DTYPE = np.float32 if COMPACT_SCHEMA else np.float64
+
+
+def _wqi_channel(columns):
+    # WQI of every sample, stored next to the sensor channels (imported here to avoid a circular import)
+    from data_utils import calculate_wqi_array
+    return calculate_wqi_array(columns["pH"], columns["TDS"], columns["turbidity"])
+
+
+class Device:
+    '''clean and dirty water stores of one unit, with their rollups, archives, the clean water alerts,
+         the filter / membrane wear forecasts and the streaming anomaly detector (if any)'''
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.clean_store = SensorStore(derived={"wqi": _wqi_channel}, dtype=SAMPLE_DTYPE)
+        self.dirty_store = SensorStore(derived={"wqi": _wqi_channel}, dtype=SAMPLE_DTYPE)
+        self.clean_rollups = RollupSet(self.clean_store)
+        self.dirty_rollups = RollupSet(self.dirty_store)
+        # drinkable range alerts, only for the clean water (the dirty side is out of range by definition)
+        self.alerts = AlertEngine()
+        self.clean_store.subscribe(self.alerts.update)
+        self.maintenance = MaintenanceEngine()
+        self.clean_store.subscribe(self.maintenance.update)
+        # streaming anomaly detector when the deployment uses one instead of the isolation forest (WATER_DETECTOR)
+        self.detector = None
+        if DETECTOR != "isolation_forest":
+            self.detector = DetectorScores(make_detector(DETECTOR), self.clean_store.capacity, self.clean_store.retention)
+            self.clean_store.subscribe(self.detector.update)
+        self.clean_archive = SensorArchive(os.path.join(ARCHIVE_DIR, device_id, "clean"), self.clean_store.columns)
+        self.dirty_archive = SensorArchive(os.path.join(ARCHIVE_DIR, device_id, "dirty"), self.dirty_store.columns)
+
+    def store(self, stream):
+        return self.clean_store if stream == "clean" else self.dirty_store
+
+    def start_archiving(self):
+        for store, archive in [(self.clean_store, self.clean_archive), (self.dirty_store, self.dirty_archive)]:
+            store.subscribe(archive.add)
+            archive.start()
+
+
+_devices = {}
+_lock = threading.Lock()
+_archiving = False
+
+
+def get_device(device_id=DEFAULT_DEVICE, max_devices=None):
+    # max_devices: refuse to create a new device once that many exist (ids sent by clients, see ingest_service.py)
+    with _lock:
+        if device_id not in _devices:
+            if max_devices is not None and len(_devices) >= max_devices:
+                raise ValueError(f"unknown device {device_id}, already {len(_devices)} devices")
+            device = Device(device_id)
+            if _archiving:
+                device.start_archiving()
+            _devices[device_id] = device
+        return _devices[device_id]
+
+
+def device_ids():
+    return sorted(_devices)
+
+
+def start_archiving():
+    # every sample written from now on (for current and future devices) is also flushed to the archive
+    global _archiving
+    with _lock:
+        if _archiving:
+            return
+        _archiving = True
+        for device in _devices.values():
+            device.start_archiving()
+
+
+def model_group(device_id):
+    # devices without a cluster get their own model
+    return MODEL_GROUPS.get(device_id, device_id)
+
+
+def fleet_frame(stream="clean", start=None, end=None, devices=None):
+    '''samples of many devices in one compact frame (see compact_frame) with categorical device and site columns
+         (site = the model group), e.g. for exports or fleet wide analysis '''
+    frames = [compact_frame(get_device(device_id).store(stream).to_frame(start, end),
+                            device=device_id, site=model_group(device_id))
+              for device_id in (device_ids() if devices is None else devices)]
+    if not frames:
+        return compact_frame(SensorStore(derived={"wqi": _wqi_channel}, dtype=SAMPLE_DTYPE).to_frame(), device=[], site=[])
+    df = pd.concat(frames, ignore_index=True)
+    # concat turns categoricals with different categories back into strings, merge them instead
+    for c in ["device", "site"]:
+        df[c] = union_categoricals([frame[c] for frame in frames])
+    return df
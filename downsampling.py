@@ -0,0 +1,125 @@
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+# Server side downsampling for the time series charts
+# a chart can not show more points than it has pixels, so we only send about one (LTTB) or two (min/max)
+# points per pixel column to the browser and always keep the flagged points (anomalies / out of range)
+
+def minmax_indices(y, n_buckets):
+    '''index of the min and the max of every bucket (equal sized buckets, fully vectorized)'''
+    n = len(y)
+    if n <= 2 * n_buckets:
+        return np.arange(n)
+
+    size = -(-n // n_buckets)  # ceil
+    # float32 data stays float32 (no full size float64 copy)
+    padded = np.full(n_buckets * size, np.nan, dtype=np.result_type(y.dtype, np.float32))
+    padded[:n] = y
+    buckets = padded.reshape(n_buckets, size)
+    offsets = np.arange(n_buckets) * size
+
+    # the last bucket can be all padding when n is not a multiple of size
+    valid = offsets < n
+    lo = (np.nanargmin(buckets[valid], axis=1) + offsets[valid])
+    hi = (np.nanargmax(buckets[valid], axis=1) + offsets[valid])
+    return np.unique(np.concatenate([lo, hi]))
+
+
+def lttb_indices(x, y, n_out):
+    '''Largest Triangle Three Buckets: keeps the point of every bucket that makes the biggest triangle
+         with the point kept in the previous bucket and the average of the next bucket'''
+    n = len(y)
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # bucket edges for the points between the first and the last one (those two are always kept)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    # the averages of all buckets at once
+    sum_x = np.add.reduceat(x[:-1], edges[:-1])
+    sum_y = np.add.reduceat(y[:-1], edges[:-1])
+    counts = np.diff(edges)
+    avg_x = np.append(sum_x / counts, x[-1])
+    avg_y = np.append(sum_y / counts, y[-1])
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # twice the triangle area for every candidate of this bucket
+        area = np.abs((x[a] - avg_x[i + 1]) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y[i + 1] - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def flagged_extremes(y, flagged, width):
+    '''min and max of the flagged rows (sorted indices into y) in each of `width` equal sized buckets of y'''
+    size = -(-len(y) // width)
+    bucket = flagged // size
+    # sorted by bucket, then value: the first row of a bucket is its min, the last its max
+    order = np.lexsort((y[flagged], bucket))
+    bucket = bucket[order]
+    first = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    last = np.r_[first[1:] - 1, len(bucket) - 1]
+    return np.unique(flagged[order[np.concatenate([first, last])]])
+
+
+def downsample_indices(x, y, width, method="lttb", keep=None):
+    '''row indices to plot for a chart `width` pixels wide
+         method = "lttb" (one point per pixel, pre-reduced with min/max) or "minmax" (two points per pixel)
+         keep = optional boolean mask of points that must stay (anomalies), when more than two per pixel are flagged
+         (e.g. dirty water, out of range all the time) only the min and max of the flagged points per pixel stay '''
+
+    if method == "minmax":
+        idx = minmax_indices(y, width)
+    else:
+        # min/max first keeps the cost of the LTTB loop independent of the window size
+        pre = minmax_indices(y, 2 * width)
+        idx = pre[lttb_indices(np.asarray(x)[pre], np.asarray(y)[pre], width)]
+
+    if keep is not None and keep.any():
+        flagged = np.flatnonzero(keep)
+        if len(flagged) > 2 * width:
+            flagged = flagged_extremes(np.asarray(y), flagged, width)
+        idx = np.union1d(idx, flagged)
+    return idx
+
+
+# results are cached per chart and window, the same window is shown again on every refresh until new data arrives
+_cache = OrderedDict()
+CACHE_SIZE = 64
+# every session thread uses the same cache, the downsampling itself runs outside the lock
+_cache_lock = threading.Lock()
+
+
+def downsample_frame(df, y, width, method="lttb", keep=None, key=None):
+    '''downsampled rows of df (x = timestamp) for the y column, cached on (key, window, width)'''
+
+    if df.empty:
+        return df
+
+    timestamps = df["timestamp"].to_numpy()
+    cache_key = None
+    if key is not None:
+        cache_key = (key, y, method, width, len(df), timestamps[0], timestamps[-1])
+        with _cache_lock:
+            idx = _cache.get(cache_key)
+            if idx is not None:
+                _cache.move_to_end(cache_key)
+        if idx is not None:
+            return df.iloc[idx]
+
+    idx = downsample_indices(timestamps.view(np.int64), df[y].to_numpy(), width, method, keep)
+
+    if cache_key is not None:
+        with _cache_lock:
+            _cache[cache_key] = idx
+            if len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+    return df.iloc[idx]
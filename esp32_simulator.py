@@ -0,0 +1,77 @@
+import json
+import threading
+import time
+from datetime import timedelta
+from http.client import HTTPConnection
+from urllib.parse import urlparse
+import numpy as np
+from data_utils import generate_bulk_data
+from devices import DEFAULT_DEVICE
+from ingest_service import LOCAL_UTC_OFFSET_NS
+
+
+# Simulated ESP32 device, posts batches of synthetic readings to the ingestion service
+# the same way the real devices will (epoch ms timestamps, columnar batches)
+
+def build_batch(stream, batch_size, rate, device=DEFAULT_DEVICE):
+    # batch_size samples spaced 1/rate seconds apart, ending now
+    df = generate_bulk_data(batch_size, interval=timedelta(seconds=1 / rate), clean=(stream == "clean"))
+    epoch_ns = df["timestamp"].to_numpy().astype(np.int64) - LOCAL_UTC_OFFSET_NS
+
+    batch = {"device": device, "stream": stream, "timestamp": (epoch_ns // 1_000_000).tolist()}
+    for key in ["pH", "TDS", "turbidity", "flow", "temperature"]:
+        batch[key] = df[key].tolist()
+    return batch
+
+
+def run_device(url, stream="clean", rate=0.2, batch_size=1, stop_event=None, devices=(DEFAULT_DEVICE,)):
+    '''post `rate` samples per second (per device) in batches of `batch_size` until stop_event is set
+         one connection takes turns for all the given devices '''
+
+    target = urlparse(url)
+    conn = HTTPConnection(target.hostname, target.port, timeout=10)
+    interval = batch_size / rate
+    next_send = time.monotonic()
+
+    while stop_event is None or not stop_event.is_set():
+        for device in devices:
+            body = json.dumps(build_batch(stream, batch_size, rate, device))
+            try:
+                conn.request("POST", "/readings", body=body, headers={"Content-Type": "application/json"})
+                conn.getresponse().read()
+            except OSError:
+                # server not up yet or restarted, reconnect on the next batch
+                conn.close()
+
+        next_send += interval
+        time.sleep(max(0, next_send - time.monotonic()))
+
+
+def simulated_device_ids(n_devices):
+    # the first one is the default unit so a single simulated device looks like before
+    return [DEFAULT_DEVICE] + [f"purifier-{i}" for i in range(2, n_devices + 1)]
+
+
+def start_simulated_devices(url, rate=0.2, batch_size=1, n_devices=1):
+    '''simulate n_devices units posting clean and dirty water readings from background threads
+         (one sample every 5 seconds by default) '''
+    stop_event = threading.Event()
+    devices = simulated_device_ids(n_devices)
+    for stream in ["clean", "dirty"]:
+        threading.Thread(target=run_device, args=(url, stream, rate, batch_size, stop_event, devices),
+                         name=f"esp32-{stream}", daemon=True).start()
+    return stop_event
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Simulated ESP32 posting readings to the ingestion service")
+    parser.add_argument("--url", default="http://127.0.0.1:8765")
+    parser.add_argument("--stream", choices=["clean", "dirty"], default="clean")
+    parser.add_argument("--rate", type=float, default=1.0, help="samples per second")
+    parser.add_argument("--batch-size", type=int, default=1, help="samples per request")
+    parser.add_argument("--devices", type=int, default=1, help="number of simulated units")
+    args = parser.parse_args()
+
+    run_device(args.url, args.stream, args.rate, args.batch_size, devices=simulated_device_ids(args.devices))
@@ -0,0 +1,130 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import pandas as pd
+from sensor_store import to_ns
+
+
+# Fleet overview: window statistics, AI anomaly count and WQI for every device
+# the window statistics come from each device's rollups and the anomaly labels from its score cache (the same ones
+# the device views use), so a refresh only scores the samples that arrived since the last one. When many devices
+# have a lot of new samples (first open of the view, after a retrain) the scoring is spread over a process pool,
+# only the new rows are sent to the workers
+
+FEATURES = ['pH', 'TDS', 'turbidity', 'flow', 'temperature']
+# below this many devices / new samples the pool costs more than it saves
+PARALLEL_MIN_DEVICES = 8
+PARALLEL_MIN_ROWS = 50000
+
+_pool = None
+_pool_lock = threading.Lock()
+# worker side: model file -> (modification time, model, metadata), so each worker loads a model once per version
+_worker_models = {}
+
+
+def get_pool():
+    global _pool
+    # several sessions can open the fleet view at the same time, only one of them creates the pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: forking a process that runs the streamlit server threads is not safe
+            _pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _load_model(model_path):
+    if not os.path.exists(model_path):
+        return None, None
+    mtime = os.path.getmtime(model_path)
+    if model_path not in _worker_models or _worker_models[model_path][0] != mtime:
+        import joblib
+        try:
+            model, metadata = joblib.load(model_path)
+        except Exception:
+            # broken file (the server keeps its model in memory then), the rows are scored there instead
+            return None, None
+        _worker_models[model_path] = (mtime, model, metadata)
+    return _worker_models[model_path][1:]
+
+
+def score_rows(model_path, trained_at, columns):
+    '''score_samples of the rows with the saved model (runs in a worker process)
+         None when the file does not hold the model trained at `trained_at` (not saved yet, retrained since) '''
+    model, metadata = _load_model(model_path)
+    if model is None or metadata["trained_at"] != trained_at:
+        return None
+    X = pd.DataFrame({c: columns[c] for c in model.feature_names_in_}, copy=False)
+    return model.score_samples(X)
+
+
+def summarize_device(device_id, timestamps, rollups, start):
+    '''summary of one device's window (timestamps since start, int64 ns) from its rollups'''
+    from data_utils import calculate_wqi
+
+    summary = {'device': device_id, 'samples': len(timestamps)}
+    if len(timestamps) == 0:
+        return summary
+
+    summary['last_seen'] = pd.Timestamp(timestamps[-1])
+    stats = rollups.stats(start, int(timestamps[-1]) + 1)
+    for c in FEATURES:
+        summary[c] = round(float(stats[c]['mean']), 2)
+    summary['WQI'] = calculate_wqi(summary['pH'], summary['TDS'], summary['turbidity'])
+    return summary
+
+
+def score_new_rows(jobs):
+    '''score the rows of every (cache, model, model_path, trained_at, timestamps, columns, oldest) job and add them
+         to the score cache, on the pool when there are enough of them '''
+    results = [None] * len(jobs)
+    if len(jobs) >= PARALLEL_MIN_DEVICES and sum(len(job[4]) for job in jobs) >= PARALLEL_MIN_ROWS:
+        pool = get_pool()
+        args = [(model_path, trained_at, columns) for _, _, model_path, trained_at, _, columns, _ in jobs]
+        results = list(pool.map(score_rows, *zip(*args), chunksize=max(1, len(jobs) // (4 * os.cpu_count()))))
+
+    for (cache, model, _, _, timestamps, columns, oldest), scores in zip(jobs, results):
+        if scores is None:
+            # few rows, or the worker's model file is not this model
+            scores = model.score_samples(pd.DataFrame({c: columns[c] for c in model.feature_names_in_}, copy=False))
+        cache.add(model, timestamps, scores, oldest)
+
+
+def fleet_summary(hours=1):
+    '''DataFrame with one row per device for the last `hours` of clean water'''
+    from Anomaly_Detection import ScoreCache, get_model_manager, score_caches
+    from devices import device_ids, get_device
+
+    start = to_ns(datetime.now() - timedelta(hours=hours))
+    rows, scored, jobs = [], [], []
+    for device_id in device_ids():
+        device = get_device(device_id)
+        store = device.clean_store
+        manager = get_model_manager(device_id)
+        # devices nobody opened yet still get their model trained in the background
+        if manager.needs_training(len(store)):
+            manager.request_training(store.to_frame())
+
+        timestamps, columns = store.window(start)
+        summary = summarize_device(device_id, timestamps, device.clean_rollups, start)
+        rows.append(summary)
+        # one read of the (model, metadata) tuple, a retrain can swap it any time
+        model, metadata = manager._current
+        if model is None or len(timestamps) == 0:
+            continue
+
+        # only the samples the device's score cache does not know yet are scored
+        cache = score_caches.setdefault(device_id, ScoreCache())
+        new = ~cache.lookup(model, timestamps)[0]
+        if new.any():
+            jobs.append((cache, model, manager.model_path, metadata["trained_at"], timestamps[new],
+                         {c: columns[c][new] for c in model.feature_names_in_}, int(store.timestamps()[0])))
+        scored.append((summary, cache, model, timestamps))
+
+    score_new_rows(jobs)
+    for summary, cache, model, timestamps in scored:
+        labels = cache.lookup(model, timestamps)[1]
+        summary['AI anomalies'] = int((labels == -1).sum())
+
+    return pd.DataFrame(rows)
@@ -0,0 +1,223 @@
+import json
+import os
+import re
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from devices import DEFAULT_DEVICE, get_device, device_ids
+from metrics import metrics
+from sensor_store import CHANNELS
+
+
+# Local ingestion service, the ESP32 devices (or esp32_simulator.py) post batches of readings here
+# and the dashboard only reads from the stores, so the data rate no longer depends on page reruns
+#
+# POST /readings  body (columnar batch, timestamps in epoch ms or ISO strings):
+#   {"device": "purifier-1", "stream": "clean", "timestamp": [...], "pH": [...], "TDS": [...], "turbidity": [...], "flow": [...], "temperature": [...]}
+# or row by row:
+#   {"device": "purifier-1", "stream": "clean", "readings": [{"timestamp": ..., "pH": ..., ...}, ...]}
+# "device" defaults to the default unit, a new device id gets its own stores on its first batch
+#   every unit holds 24 hr of stores, so new ids are only accepted up to WATER_MAX_DEVICES units,
+#   or set WATER_DEVICES="purifier-1,purifier-2" to accept only those ids
+# readings must be finite numbers, a batch with null / NaN / inf values is rejected (400) as a whole
+#
+# GET /health   samples held per device
+# GET /metrics  timings, buffer sizes and model age in Prometheus text format (see metrics.py)
+#
+# the stores live in the process that runs the service, the dashboard has to run in that same process:
+#   python ingest_service.py [--port 8765 --simulate --devices 3]   starts ingesting right away, then serves the
+#                                                                   dashboard (streamlit) from the same process
+#   streamlit run streamlit_dashboard.py                            starts ingesting on the first page render
+# either way start_ingestion() runs once per process. When the port is taken (another dashboard process) this
+# process can not ingest and would never see the other one's data, the dashboard says so instead of failing
+
+INGEST_HOST = os.environ.get("INGEST_HOST", "127.0.0.1")
+INGEST_PORT = int(os.environ.get("INGEST_PORT", 8765))
+
+# the dashboard works in local wall-clock time (datetime.now()), epoch timestamps are UTC
+LOCAL_UTC_OFFSET_NS = int(datetime.now().astimezone().utcoffset().total_seconds() * 1e9)
+
+MAX_DEVICES = int(os.environ.get("WATER_MAX_DEVICES", 64))
+ALLOWED_DEVICES = {d.strip() for d in os.environ.get("WATER_DEVICES", "").split(",") if d.strip()}
+# device ids end up in archive paths (archive/<device>/...)
+DEVICE_ID = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]{0,63}")
+# timestamps the stores can hold (int64 ns since the epoch)
+TIMESTAMP_RANGE = (np.datetime64("1970-01-01", "us"), np.datetime64("2262-01-01", "us"))
+
+
+def parse_timestamps(values):
+    # ESP32 firmware sends epoch milliseconds, ISO strings (local time) are accepted for manual testing
+    if len(values) and isinstance(values[0], str):
+        timestamps = np.array(values, dtype="datetime64[us]")
+    else:
+        # through float64 so huge numbers are caught by the range check below instead of overflowing int64
+        ms = np.asarray(values, dtype=np.float64)
+        if not np.isfinite(ms).all() or (np.abs(ms) > 2**53).any():
+            raise ValueError("timestamps must be epoch milliseconds")
+        timestamps = ms.astype(np.int64).astype("datetime64[ms]") + np.timedelta64(LOCAL_UTC_OFFSET_NS // 1000, "us")
+    if timestamps.ndim != 1:
+        raise ValueError("timestamp must be a list")
+    if np.isnat(timestamps).any() or (timestamps < TIMESTAMP_RANGE[0]).any() or (timestamps >= TIMESTAMP_RANGE[1]).any():
+        raise ValueError(f"timestamps must be between {TIMESTAMP_RANGE[0]} and {TIMESTAMP_RANGE[1]}")
+    return timestamps.astype("datetime64[ns]").astype(np.int64)
+
+
+def check_device_id(device_id):
+    # clients can not create devices beyond the allowlist / MAX_DEVICES (checked when the device is created)
+    if not isinstance(device_id, str) or not DEVICE_ID.fullmatch(device_id):
+        raise ValueError(f"invalid device id {device_id!r}")
+    if ALLOWED_DEVICES and device_id not in ALLOWED_DEVICES:
+        raise ValueError(f"unknown device {device_id}")
+    return device_id
+
+
+def parse_batch(payload):
+    '''turn a request body into (store, timestamps in ns, {channel: array})
+         everything is checked before the device is looked up (or created), a bad batch never touches a store '''
+    if not isinstance(payload, dict):
+        raise ValueError("expected a JSON object")
+    stream = payload.get("stream", "clean")
+    if stream not in ("clean", "dirty"):
+        raise ValueError(f"unknown stream {stream}")
+    device_id = check_device_id(payload.get("device", DEFAULT_DEVICE))
+
+    if "readings" in payload:
+        rows = payload["readings"]
+        payload = {key: [row[key] for row in rows] for key in ["timestamp"] + CHANNELS}
+
+    timestamps = parse_timestamps(payload["timestamp"])
+    columns = {c: np.asarray(payload[c], dtype=np.float64) for c in CHANNELS}
+
+    for c, values in columns.items():
+        if values.shape != timestamps.shape:
+            raise ValueError(f"{c} must be a list of {len(timestamps)} values, one per timestamp")
+        # null arrives as NaN, it would end up in the stores, rollups and the model's training data
+        if not np.isfinite(values).all():
+            raise ValueError(f"{c} has null or non-finite values")
+
+    store = get_device(device_id, max_devices=MAX_DEVICES).store(stream)
+    return store, timestamps, columns
+
+
+def ingest_batch(payload):
+    with metrics.timer("ingest_batch_seconds"):
+        store, timestamps, columns = parse_batch(payload)
+        store.extend(timestamps, columns)
+        # keep only last 24 hr to avoid memory bloating
+        store.evict()
+    return len(timestamps)
+
+
+class IngestHandler(BaseHTTPRequestHandler):
+    # keep-alive so a device can stream many batches over one connection
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, status, body, content_type="application/json"):
+        data = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+
+        if self.path != "/readings":
+            self._reply(404, {"error": "unknown path"})
+            return
+
+        try:
+            accepted = ingest_batch(json.loads(body))
+        except (ValueError, KeyError, TypeError, OverflowError) as e:
+            self._reply(400, {"error": str(e)})
+            return
+
+        self._reply(200, {"accepted": accepted})
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._reply(200, {device_id: {"clean": len(get_device(device_id).clean_store),
+                                          "dirty": len(get_device(device_id).dirty_store)}
+                              for device_id in device_ids()})
+        elif self.path == "/metrics":
+            self._reply(200, metrics.prometheus_text(), "text/plain; version=0.0.4")
+        else:
+            self._reply(404, {"error": "unknown path"})
+
+    def log_message(self, format, *args):
+        # one log line per batch is too noisy at high rates
+        pass
+
+
+_ingestion = None
+_ingestion_lock = threading.Lock()
+
+
+def start_ingestion(host=INGEST_HOST, port=INGEST_PORT, simulate=None, simulated_devices=None):
+    '''everything behind the dashboard, once per process (later calls return the same server), None = environment:
+         WATER_SIMULATOR=0 when real ESP32 devices are posting readings, WATER_SIMULATED_DEVICES units otherwise
+         WATER_BACKFILL_HOURS (e.g. 24) to start with synthetic history instead of an empty store
+           and WATER_BACKFILL_DRIFT (e.g. clogging) to give that history a slow drift (see DRIFT_PROFILES) '''
+    global _ingestion
+    with _ingestion_lock:
+        if _ingestion is not None:
+            return _ingestion
+        from devices import start_archiving
+        if simulate is None:
+            simulate = os.environ.get("WATER_SIMULATOR", "1") == "1"
+        if simulated_devices is None:
+            simulated_devices = int(os.environ.get("WATER_SIMULATED_DEVICES", 1))
+
+        # bind first, when the port is taken nothing else is started
+        server = ThreadingHTTPServer((host, port), IngestHandler)
+        if os.environ.get("WATER_BACKFILL_HOURS"):
+            from data_utils import backfill_stores
+            from esp32_simulator import simulated_device_ids
+            backfill_stores(hours=float(os.environ["WATER_BACKFILL_HOURS"]), devices=simulated_device_ids(simulated_devices),
+                            drift=os.environ.get("WATER_BACKFILL_DRIFT", "none"))
+        # archive everything that arrives from now on (synthetic backfill stays out of the history)
+        start_archiving()
+        _ingestion = start_ingest_service(server=server, simulate=simulate, simulated_devices=simulated_devices)
+        return _ingestion
+
+
+def start_ingest_service(host=INGEST_HOST, port=INGEST_PORT, simulate=False, simulated_devices=1, server=None):
+    '''start the HTTP server in a background thread
+         with simulate=True simulated ESP32s (one per device) also start posting clean and dirty readings to it '''
+
+    if server is None:
+        server = ThreadingHTTPServer((host, port), IngestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="ingest-http", daemon=True).start()
+
+    if simulate:
+        from esp32_simulator import start_simulated_devices
+        host, port = server.server_address[:2]
+        start_simulated_devices(f"http://{host}:{port}", n_devices=simulated_devices)
+
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    from streamlit.web import bootstrap
+
+    parser = argparse.ArgumentParser(description="Run the sensor ingestion service and the dashboard in one process")
+    parser.add_argument("--host", default=INGEST_HOST)
+    parser.add_argument("--port", type=int, default=INGEST_PORT)
+    parser.add_argument("--simulate", action="store_true", default=None, help="also run simulated ESP32s")
+    parser.add_argument("--devices", type=int, help="number of simulated devices")
+    parser.add_argument("--dashboard-port", type=int, default=8501)
+    args = parser.parse_args()
+
+    # through the module (not __main__) so the dashboard script finds the running service
+    import ingest_service
+    ingest_service.start_ingestion(args.host, args.port, args.simulate, args.devices)
+    print(f"Ingestion service listening on http://{args.host}:{args.port}/readings", file=sys.stderr)
+    dashboard = os.path.join(os.path.dirname(os.path.abspath(__file__)), "streamlit_dashboard.py")
+    bootstrap.load_config_options({"server_port": args.dashboard_port})
+    bootstrap.run(dashboard, False, [], {"server_port": args.dashboard_port})
@@ -0,0 +1,257 @@
+import threading
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+
+
+# Predictive maintenance from the clean water trends
+# a clogging filter lets turbidity creep up and slows the flow down, a degrading membrane lets TDS through.
+# The engine listens to the clean store like the alert engine and keeps, per channel, estimators that are
+# updated in constant time for every new sample (nothing is refit on the history):
+#   EWMA   smoothed level, readings far outside the usual noise (false readings, bursts) are left out
+#   RLS    slope of the level over time, recursive least squares with forgetting (recent days count the most)
+#          a forecast needs `min_history` of bins and a slope that stands out of its own noise (t statistic,
+#          residual variance of the fit), noise on a few hours of clean data easily looks like a trend
+#   CUSUM  one sided cumulative sum of the shift from the baseline, flags a sustained drift early
+# samples are averaged per minute first (a trend over days does not need every second), the slope then gives
+# the time left until the level leaves healthy_drinkable_water_ranges()
+
+NS = 1_000_000_000
+DAY_NS = 86400 * NS
+# forecasts further out than this are too uncertain to show
+MAX_FORECAST_DAYS = 365
+
+# component -> {channel: direction it goes when the component wears (+1 up, -1 down)}
+COMPONENTS = {
+    "Filter": {"turbidity": 1, "flow": -1},
+    "Membrane": {"TDS": 1},
+}
+
+
+class Ewma:
+    '''exponentially weighted mean of a vector, alpha from the half life in updates'''
+
+    def __init__(self, halflife, initial):
+        self.alpha = 1 - 0.5 ** (1 / halflife)
+        self.level = np.array(initial, dtype=np.float64)
+
+    def update(self, x):
+        self.level += self.alpha * (x - self.level)
+
+
+class RlsSlope:
+    '''y = intercept + slope * t for every channel, fit by recursive least squares with a forgetting factor
+         every channel sees the same times so they share the covariance matrix, one update is a few 2x2 products '''
+
+    def __init__(self, n_channels, forgetting, delta=1e3):
+        self.forgetting = forgetting
+        self.theta = np.zeros((n_channels, 2))  # (intercept, slope) per channel
+        self.P = np.eye(2) * delta
+        self.n = 0
+        # forgetting weighted sum of squared residuals and of the weights, residual variance per channel
+        self._sse = np.zeros(n_channels)
+        self._weight = 0.0
+
+    def update(self, t, y):
+        phi = np.array([1.0, t])
+        P_phi = self.P @ phi
+        gain = P_phi / (self.forgetting + phi @ P_phi)
+        self.theta += np.outer(y - self.theta @ phi, gain)
+        self.P = (self.P - np.outer(gain, P_phi)) / self.forgetting
+        # residual after the update (the one before it is huge for the first bins, theta starts at 0)
+        self._sse = self.forgetting * self._sse + (y - self.theta @ phi) ** 2
+        self._weight = self.forgetting * self._weight + 1
+        self.n += 1
+
+    @property
+    def slope(self):
+        return self.theta[:, 1]
+
+    @property
+    def slope_std(self):
+        # standard error of the slope, residual variance times the slope entry of P (needs a few bins)
+        if self.n < 3:
+            return np.full(len(self.theta), np.inf)
+        return np.sqrt(self._sse / self._weight * self.P[1, 1])
+
+
+class Cusum:
+    '''one sided CUSUM of standardized shifts, s = max(0, s + z - k), drifting once s > h'''
+
+    def __init__(self, n_channels, k=0.5, h=8.0):
+        self.k, self.h = k, h
+        self.s = np.zeros(n_channels)
+
+    def update(self, z):
+        self.s = np.maximum(0.0, self.s + z - self.k)
+
+    @property
+    def drifting(self):
+        return self.s > self.h
+
+
+class MaintenanceEngine:
+    '''Store listener tracking filter and membrane wear, status() gives the forecasts for the page
+         the baseline (median / MAD of the first `warmup` samples) is what "new" looks like, reset() after a service '''
+
+    def __init__(self, ranges=None, bin_size=timedelta(minutes=1), halflife=timedelta(minutes=30),
+                 memory=timedelta(days=1), warmup=200, clip=4.0, horizon=timedelta(days=30),
+                 min_history=timedelta(hours=12), min_t=4.0):
+        self.channels = [c for channels in COMPONENTS.values() for c in channels]
+        self.direction = np.array([d for channels in COMPONENTS.values() for d in channels.values()], dtype=np.float64)
+        self.bin_ns = int(bin_size.total_seconds() * NS)
+        self.halflife_bins = halflife / bin_size
+        # forgetting factor, the fit remembers about `memory` worth of bins
+        self.forgetting = 1 - bin_size / memory
+        self.warmup = warmup
+        self.clip = clip
+        self.horizon_days = horizon / timedelta(days=1)
+        # no forecast before min_history of bins, and only for slopes of at least min_t standard errors
+        self.min_history_ns = int(min_history.total_seconds() * NS)
+        self.min_t = min_t
+        self.ranges = ranges
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._warmup = []           # samples collected for the baseline
+        self.baseline = None        # (level, sample std) per channel
+        self._bin = None            # open bin index and its sums (see _add)
+        self._clear_bin()
+        self._t0 = None             # time of the first closed bin, RLS times are days since then
+        self._t_last = None         # time of the last closed bin
+        self.last_ns = None
+
+    def reset(self):
+        '''forget the trends and learn a new baseline from the next samples (e.g. after a filter change)'''
+        with self._lock:
+            self._reset()
+
+    def update(self, timestamps, columns):
+        '''store listener, timestamps in int64 ns (sorted batches)'''
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        if len(timestamps) == 0:
+            return
+        with self._lock:
+            if self.ranges is None:
+                # looked up with the first samples (data_utils creates the default device while it is imported)
+                from data_utils import healthy_drinkable_water_ranges
+                self.ranges = healthy_drinkable_water_ranges()
+            values = np.column_stack([np.asarray(columns[c], dtype=np.float64) for c in self.channels])
+
+            if self.baseline is None:
+                timestamps, values = self._learn_baseline(timestamps, values)
+                if len(timestamps) == 0:
+                    return
+
+            # late samples go into the open bin
+            bins = timestamps // self.bin_ns
+            if self._bin is not None:
+                bins = np.maximum(bins, self._bin)
+            if bins[0] == bins[-1]:
+                # the usual case, a few samples of the current minute
+                starts, ends = [0], [len(bins)]
+            else:
+                edges = np.flatnonzero(bins[1:] != bins[:-1]) + 1
+                starts, ends = np.concatenate(([0], edges)), np.concatenate((edges, [len(bins)]))
+            for lo, hi in zip(starts, ends):
+                if bins[lo] != self._bin:
+                    self._close_bin()
+                    self._bin = int(bins[lo])
+                self._add(values[lo:hi])
+            self.last_ns = int(timestamps[-1])
+
+    def _learn_baseline(self, timestamps, values):
+        # robust level and noise of the first samples (median / MAD, the 3% false readings do not count)
+        need = self.warmup - sum(len(v) for v in self._warmup)
+        self._warmup.append(values[:need])
+        if need > len(values):
+            return timestamps[:0], values[:0]
+        sample = np.concatenate(self._warmup)
+        level = np.median(sample, axis=0)
+        std = 1.4826 * np.median(np.abs(sample - level), axis=0)
+        self.baseline = (level, np.maximum(std, 1e-9))
+        self._band = self.clip * self.baseline[1]
+        self._warmup = []
+        self._ewma = Ewma(self.halflife_bins, level)
+        self._rls = RlsSlope(len(self.channels), self.forgetting)
+        self._cusum = Cusum(len(self.channels))
+        return timestamps[need:], values[need:]
+
+    def _add(self, values):
+        # readings more than `clip` standard deviations from the current level are false readings or bursts,
+        # left out of the minute mean (their clipped values are only used when the whole minute is outside)
+        level, band = self._ewma.level, self._band
+        clipped = np.clip(values, level - band, level + band)
+        inside = clipped == values
+        self._sum += np.where(inside, values, 0.0).sum(axis=0)
+        self._count += inside.sum(axis=0)
+        self._clipped += clipped.sum(axis=0)
+        self._n += len(values)
+
+    def _close_bin(self):
+        if self._bin is None or self._n == 0:
+            return
+        # a whole minute outside the band is a real change: follow it, by at most the band per minute
+        mean = np.where(self._count > 0, self._sum / np.maximum(self._count, 1), self._clipped / self._n)
+        t_ns = self._bin * self.bin_ns + self.bin_ns // 2
+        if self._t0 is None:
+            self._t0 = t_ns
+        self._t_last = t_ns
+        self._ewma.update(mean)
+        self._rls.update((t_ns - self._t0) / DAY_NS, mean)
+        # shift from the baseline in standard deviations of the readings, in the direction of wear
+        level, std = self.baseline
+        self._cusum.update(self.direction * (mean - level) / std)
+        self._clear_bin()
+
+    def _clear_bin(self):
+        n_channels = len(self.channels)
+        self._sum, self._count, self._clipped, self._n = np.zeros(n_channels), np.zeros(n_channels), np.zeros(n_channels), 0
+
+    def status(self):
+        '''one row per component channel: level, trend per day, drift flag and the forecast to leave the range'''
+        with self._lock:
+            if self.baseline is None or self._t0 is None or self._rls.n < 2:
+                return []
+            rows = []
+            levels, slopes, drifting = self._ewma.level, self._rls.slope, self._cusum.drifting
+            enough_history = self._t_last - self._t0 >= self.min_history_ns
+            # wear trend that stands out of the noise of the fit
+            trending = self.direction * slopes > self.min_t * self._rls.slope_std
+            for k, channel in enumerate(self.channels):
+                component = next(name for name, channels in COMPONENTS.items() if channel in channels)
+                low, high = self.ranges[channel]
+                threshold = high if self.direction[k] > 0 else low
+                # days until the level crosses the threshold at the current slope
+                # (None = not heading there, not within MAX_FORECAST_DAYS, or not enough history to tell)
+                days = None
+                if self.direction[k] * (threshold - levels[k]) <= 0:
+                    days = 0.0
+                elif enough_history and trending[k]:
+                    days = float((threshold - levels[k]) / slopes[k])
+                    days = days if days <= MAX_FORECAST_DAYS else None
+
+                if days == 0.0:
+                    state = "out of range"
+                elif not enough_history:
+                    state = "not enough history"
+                elif days is not None and days <= self.horizon_days:
+                    state = "service due"
+                elif drifting[k]:
+                    state = "drifting"
+                else:
+                    state = "ok"
+                rows.append({
+                    "component": component,
+                    "parameter": channel,
+                    "baseline": round(float(self.baseline[0][k]), 3),
+                    "level": round(float(levels[k]), 3),
+                    "trend_per_day": round(float(slopes[k]), 4),
+                    "cusum": round(float(self._cusum.s[k]), 1),
+                    "threshold": threshold,
+                    "days_left": None if days is None else round(days, 2),
+                    "expected": None if days is None else pd.Timestamp(self.last_ns + int(days * DAY_NS)).floor("min"),
+                    "state": state,
+                })
+            return rows
@@ -0,0 +1,186 @@
+import threading
+import time
+from datetime import datetime
+import numpy as np
+
+
+# Process-wide timing registry: how long each stage of a dashboard rerun (and the ingest / training work) takes,
+# plus gauges for buffer sizes and model age. Shown on the System Maintenance page and served as
+# Prometheus text by the ingest service (GET /metrics)
+
+# histogram buckets in seconds (Prometheus `le` bounds)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# percentiles are taken over the most recent observations of each series
+RECENT = 1024
+
+HELP = {
+    "dashboard_stage_seconds": "Time spent in one stage of a dashboard rerun",
+    "dashboard_rerun_seconds": "Time of a full dashboard rerun",
+    "ingest_batch_seconds": "Time to parse and store one posted batch of readings",
+    "model_training_seconds": "Time to fit one isolation forest model",
+    "store_rows": "Samples held in memory",
+    "store_capacity": "Maximum samples held in memory",
+    "archive_pending_rows": "Samples waiting for the next archive flush",
+    "score_cache_rows": "Samples with a cached anomaly score",
+    "model_age_seconds": "Seconds since the model was trained",
+    "model_version": "Version of the model in use",
+    "alerts_active": "Open or acknowledged drinkable range alerts",
+    "maintenance_days_left": "Forecast days until a wear indicator leaves the drinkable range",
+}
+
+
+class Histogram:
+    '''Bucket counts (for the export) and a ring of the latest observations (for p50 / p95 / p99)'''
+
+    def __init__(self):
+        self.buckets = np.zeros(len(BUCKETS), dtype=np.int64)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = np.empty(RECENT, dtype=np.float64)
+
+    def observe(self, value):
+        self.buckets[np.searchsorted(BUCKETS, value):] += 1
+        self.recent[self.count % RECENT] = value
+        self.count += 1
+        self.sum += value
+
+    def percentiles(self, qs=(50, 95, 99)):
+        values = self.recent[:min(self.count, RECENT)]
+        return np.percentile(values, qs) if len(values) else np.full(len(qs), np.nan)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = [(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in labels]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class MetricsRegistry:
+    '''histograms are recorded as things happen, gauges are read from the collectors when asked for'''
+
+    def __init__(self):
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds, **labels):
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            series.setdefault(_label_key(labels), Histogram()).observe(seconds)
+
+    def timer(self, name, **labels):
+        return _Timer(self, name, labels)
+
+    def add_collector(self, collector):
+        # collector() yields (name, {labels}, value) for gauges that are cheap to read on demand
+        self._collectors.append(collector)
+
+    def histograms(self):
+        '''[{name, labels..., count, mean_ms, p50_ms, p95_ms, p99_ms}] for display'''
+        rows = []
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                for labels, hist in sorted(series.items()):
+                    p50, p95, p99 = hist.percentiles() * 1000
+                    rows.append({"metric": name, **dict(labels), "count": hist.count,
+                                 "mean_ms": hist.sum / hist.count * 1000,
+                                 "p50_ms": p50, "p95_ms": p95, "p99_ms": p99})
+        return rows
+
+    def gauges(self):
+        rows = []
+        for collector in self._collectors:
+            rows.extend(collector())
+        return rows
+
+    def prometheus_text(self):
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                lines += [f"# HELP {name} {HELP.get(name, name)}", f"# TYPE {name} histogram"]
+                for labels, hist in sorted(series.items()):
+                    for bound, count in zip(BUCKETS, hist.buckets):
+                        lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {count}")
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {hist.count}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {hist.sum}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {hist.count}")
+
+        gauges = {}
+        for name, labels, value in self.gauges():
+            gauges.setdefault(name, []).append((_label_key(labels), value))
+        for name, series in sorted(gauges.items()):
+            lines += [f"# HELP {name} {HELP.get(name, name)}", f"# TYPE {name} gauge"]
+            lines += [f"{name}{_format_labels(labels)} {value}" for labels, value in series]
+        return "\n".join(lines) + "\n"
+
+
+class _Timer:
+    def __init__(self, registry, name, labels):
+        self.registry, self.name, self.labels = registry, name, labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class RerunTimer:
+    '''Times consecutive stages of one dashboard rerun without wrapping them:
+         lap("fetch") adds the time since the previous lap to stage "fetch" (a stage can come back several times),
+         done() records every stage and the whole rerun '''
+
+    def __init__(self, view, registry=None):
+        self.view = view
+        self.registry = registry or metrics
+        self.stages = {}
+        self.start = self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def done(self):
+        for stage, seconds in self.stages.items():
+            self.registry.observe("dashboard_stage_seconds", seconds, view=self.view, stage=stage)
+        self.registry.observe("dashboard_rerun_seconds", time.perf_counter() - self.start, view=self.view)
+
+
+def system_gauges():
+    '''buffer sizes, alerts and maintenance forecasts of every device and the age of every model'''
+    # imported here, this module is imported by the ones below
+    from Anomaly_Detection import model_managers, score_caches
+    from devices import device_ids, get_device
+
+    for device_id in device_ids():
+        device = get_device(device_id)
+        for stream in ["clean", "dirty"]:
+            store = device.store(stream)
+            labels = {"device": device_id, "stream": stream}
+            yield "store_rows", labels, len(store)
+            yield "store_capacity", labels, store.capacity
+            yield "archive_pending_rows", labels, getattr(device, f"{stream}_archive")._pending_rows
+        yield "alerts_active", {"device": device_id}, len(device.alerts.active_alerts())
+        for row in device.maintenance.status():
+            if row["days_left"] is not None:
+                yield "maintenance_days_left", {"device": device_id, "parameter": row["parameter"]}, row["days_left"]
+    for device_id, cache in list(score_caches.items()):
+        yield "score_cache_rows", {"device": device_id}, len(cache.timestamps)
+    for group, manager in list(model_managers.items()):
+        metadata = manager.metadata
+        if metadata is not None:
+            age = (datetime.now() - datetime.fromisoformat(metadata["trained_at"])).total_seconds()
+            yield "model_age_seconds", {"model": group}, round(age, 1)
+            yield "model_version", {"model": group}, metadata.get("version", 0)
+
+
+# the one registry of the process
+metrics = MetricsRegistry()
+metrics.add_collector(system_gauges)
@@ -0,0 +1,249 @@
+import itertools
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+from Anomaly_Detection import anomaly_detection, detect_anomalies, get_model_manager, train_isolation_forest
+from data_utils import calculate_wqi
+from devices import get_device
+from sensor_store import CHANNELS
+from streaming_detectors import DETECTOR
+
+
+# Replay of recorded sensor logs through the same pipeline as the live data
+# a CSV / Parquet log (or a range of a device archive) is read lazily in chunks, the samples go into the clean store
+# of a replay device (rollups, alerts and maintenance listen to it as usual) one tick of recorded time at a time,
+# and after every tick the dashboard's detection runs on the store: detect_anomalies, anomaly_detection (the
+# isolation forest or the WATER_DETECTOR streaming detector) and the WQI of the last minutes.
+#
+#   python replay.py logs/incident.parquet --speed 60 --output incident.jsonl
+#   python replay.py --archive purifier-1 --start 2026-10-11T08:00 --end 2026-10-11T12:00
+#   python replay.py logs/incident.csv --compare incident.jsonl
+#
+# speed 1 = real time, N = N times faster, 0 = as fast as possible (throughput ceiling)
+# everything is driven by the recorded timestamps (ticks, eviction, alert times) and the forest is trained once on the
+# start of the log (or loaded), streaming detectors only depend on the order of the samples, so the per tick output only depends on the log and can be used as a regression fixture.
+# Epoch millisecond logs are replayed in UTC, ISO timestamps as they are written.
+# Throughput and latency are reported separately, they depend on the machine
+
+REPLAY_DEVICE = "replay"
+NS = 1_000_000_000
+
+
+def _chunk(df):
+    # (timestamps in int64 ns, {channel: float64 array})
+    ts = df["timestamp"]
+    if ts.dtype.kind in "iuf":
+        # epoch milliseconds as the ESP32 sends them, kept in UTC: unlike the ingestion service (local time for the
+        # dashboard) the ticks and the "time" of the results must not depend on the timezone of the machine
+        ns = ts.to_numpy(dtype=np.int64) * 1_000_000
+    else:
+        ns = pd.to_datetime(ts).to_numpy(dtype="datetime64[ns]").view(np.int64)
+    return ns, {c: df[c].to_numpy(dtype=np.float64) for c in CHANNELS}
+
+
+def read_log(path, chunk_rows=50_000):
+    '''lazy (timestamps, columns) chunks of a CSV file, a Parquet file or a folder of Parquet files'''
+    if path.endswith(".csv"):
+        for df in pd.read_csv(path, usecols=["timestamp"] + CHANNELS, chunksize=chunk_rows):
+            yield _chunk(df)
+        return
+
+    import pyarrow.dataset as ds
+    dataset = ds.dataset(path, format="parquet", partitioning="hive")
+    # no threads so the batches always come in file order
+    for batch in dataset.to_batches(columns=["timestamp"] + CHANNELS, batch_size=chunk_rows, use_threads=False):
+        yield _chunk(batch.to_pandas())
+
+
+def read_archive(device_id, start, end):
+    '''lazy chunks of the archived clean water of a device for start <= timestamp < end'''
+    for batch in get_device(device_id).clean_archive.scan(start, end, columns=CHANNELS):
+        yield _chunk(batch.to_pandas())
+
+
+def _ticks(chunks, tick_ns):
+    '''regroup the chunks into (tick end, timestamps, columns), one per tick of recorded time with samples in it
+         the ticks do not depend on how the log was chunked '''
+    current, pending = None, []
+
+    def close():
+        ts = np.concatenate([t for t, _ in pending])
+        return (current + 1) * tick_ns, ts, {c: np.concatenate([cols[c] for _, cols in pending]) for c in CHANNELS}
+
+    for ts, columns in chunks:
+        if len(ts) == 0:
+            continue
+        order = np.argsort(ts, kind="stable")
+        ts, columns = ts[order], {c: values[order] for c, values in columns.items()}
+        ids = ts // tick_ns
+        if current is not None:
+            # samples older than the open tick arrive with it (the store puts them in place)
+            ids = np.maximum(ids, current)
+        edges = np.flatnonzero(ids[1:] != ids[:-1]) + 1
+        for lo, hi in zip(np.r_[0, edges], np.r_[edges, len(ts)]):
+            if ids[lo] != current:
+                if current is not None:
+                    yield close()
+                current, pending = int(ids[lo]), []
+            pending.append((ts[lo:hi], {c: values[lo:hi] for c, values in columns.items()}))
+    if current is not None:
+        yield close()
+
+
+class ReplayStats:
+    '''samples per second from start to end, and per tick how long the store + detection took (latency)
+         and how far behind the schedule of the chosen speed the tick was handed over (lag) '''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.samples = 0
+        self.latencies = []
+        self.max_lag = 0.0
+
+    def add(self, samples, latency, lag):
+        self.samples += samples
+        self.latencies.append(latency)
+        self.max_lag = max(self.max_lag, lag)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        latencies = np.array(self.latencies or [np.nan]) * 1000
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        return {"samples": self.samples, "ticks": len(self.latencies), "seconds": round(elapsed, 3),
+                "samples_per_s": round(self.samples / elapsed, 1) if elapsed else None,
+                "latency_p50_ms": round(p50, 3), "latency_p95_ms": round(p95, 3), "latency_p99_ms": round(p99, 3),
+                "latency_max_ms": round(float(latencies.max()), 3), "max_lag_s": round(self.max_lag, 3)}
+
+
+def tick_result(df, device, end_ns, tick_ns, window):
+    '''what the dashboard would show after this tick, only built from the recorded data'''
+    now = pd.Timestamp(end_ns)
+    range_alerts = detect_anomalies(df, time_window=int(window.total_seconds() // 60), now=now)
+
+    # AI verdicts of the samples of this tick
+    scored = anomaly_detection(df, device.device_id)
+    tick = scored["timestamp"].to_numpy().view(np.int64) >= end_ns - tick_ns
+    labels, scores = scored["anomaly"].to_numpy()[tick], scored["anomaly_score"].to_numpy()[tick]
+
+    stats = device.clean_rollups.stats(end_ns - int(window.total_seconds() * NS), end_ns)
+    wqi = calculate_wqi(stats["pH"]["mean"], stats["TDS"]["mean"], stats["turbidity"]["mean"])
+
+    return {
+        "time": now.isoformat(),
+        "rows": len(df),
+        "wqi": None if np.isnan(wqi) else wqi,
+        "range_alerts": [{"parameter": a["parameter"], "status": a["status"], "value": float(a["value"])} for a in range_alerts],
+        "ai_anomalies": int((labels == -1).sum()),
+        "ai_min_score": round(float(np.nanmin(scores)), 4) if len(scores) and not np.isnan(scores).all() else None,
+        "alerts": [f"{a['parameter']}:{a['state']}" for a in device.alerts.active_alerts()],
+    }
+
+
+def replay(chunks, device_id=REPLAY_DEVICE, speed=0.0, tick=timedelta(seconds=5), window=timedelta(minutes=5),
+           model=None, train_samples=720, stats=None):
+    '''push the chunks through the pipeline, yields one tick_result per tick in recorded time order
+         model = isolation forest to score with, by default one trained on the first train_samples of the log
+                 (not used with a streaming detector, WATER_DETECTOR)
+         stats = optional ReplayStats collecting throughput and latency '''
+
+    device = get_device(device_id)
+    if len(device.clean_store):
+        raise ValueError(f"device {device_id} already holds samples, replay into a new device id")
+
+    chunks = iter(chunks)
+    if model is None and DETECTOR == "isolation_forest":
+        # read ahead until there is enough to train on, those chunks are replayed as well
+        head = list(itertools.islice(chunks, 1))
+        while head and sum(len(ts) for ts, _ in head) < train_samples:
+            more = list(itertools.islice(chunks, 1))
+            if not more:
+                break
+            head += more
+        if not head:
+            return
+        ts = np.concatenate([t for t, _ in head])
+        order = np.argsort(ts, kind="stable")[:train_samples]
+        train = pd.DataFrame({c: np.concatenate([cols[c] for _, cols in head])[order] for c in CHANNELS})
+        model = train_isolation_forest(train)
+        chunks = itertools.chain(head, chunks)
+    if model is not None:
+        # one model for the whole replay, no background retraining that would depend on timing
+        get_model_manager(device_id).freeze(model, {"trained_at": datetime.now().isoformat(), "n_samples": train_samples})
+
+    tick_ns = int(tick.total_seconds() * NS)
+    wall_start, first_end = time.perf_counter(), None
+    for end_ns, ts, columns in _ticks(chunks, tick_ns):
+        # at speed N the samples of a tick are handed over once its end has passed (recorded time / N)
+        first_end = end_ns if first_end is None else first_end
+        due = wall_start + (end_ns - first_end) / NS / speed if speed else time.perf_counter()
+        if speed:
+            time.sleep(max(0.0, due - time.perf_counter()))
+
+        arrived = time.perf_counter()
+        store = device.clean_store
+        store.extend(ts, columns)
+        store.evict(now=pd.Timestamp(end_ns))
+        result = tick_result(store.to_frame(), device, end_ns, tick_ns, window)
+        if stats is not None:
+            stats.add(len(ts), time.perf_counter() - arrived, arrived - due)
+        yield result
+
+
+def compare(results, fixture_path):
+    '''index of the first tick that differs from the fixture (JSON lines), None when they are the same'''
+    with open(fixture_path) as f:
+        expected = [json.loads(line) for line in f if line.strip()]
+    for i, (got, want) in enumerate(itertools.zip_longest(results, expected)):
+        if got != want:
+            return i
+    return None
+
+
+if __name__ == "__main__":
+    import argparse
+    import joblib
+
+    parser = argparse.ArgumentParser(description="Replay recorded sensor logs through the detection pipeline")
+    parser.add_argument("log", nargs="?", help="CSV file, Parquet file or folder of Parquet files")
+    parser.add_argument("--archive", metavar="DEVICE", help="replay the archived clean water of this device instead")
+    parser.add_argument("--start", help="archive range start (ISO time)")
+    parser.add_argument("--end", help="archive range end (ISO time)")
+    parser.add_argument("--speed", type=float, default=0, help="1 = real time, N = N times faster, 0 = as fast as possible")
+    parser.add_argument("--tick", type=float, default=5, help="seconds of recorded time between detection runs")
+    parser.add_argument("--model", help="saved model (models/<device>/isolation_forest.joblib) instead of training one")
+    parser.add_argument("--train-samples", type=int, default=720, help="samples at the start of the log to train on")
+    parser.add_argument("--chunk-rows", type=int, default=50_000)
+    parser.add_argument("--output", help="write the per tick results (JSON lines) here")
+    parser.add_argument("--compare", metavar="FIXTURE", help="check the results against an earlier --output")
+    args = parser.parse_args()
+
+    if args.archive:
+        chunks = read_archive(args.archive, pd.Timestamp(args.start), pd.Timestamp(args.end))
+    elif args.log:
+        chunks = read_log(args.log, args.chunk_rows)
+    else:
+        parser.error("give a log file or --archive")
+
+    model = joblib.load(args.model)[0] if args.model else None
+    stats = ReplayStats()
+    results = replay(chunks, speed=args.speed, tick=timedelta(seconds=args.tick), model=model,
+                     train_samples=args.train_samples, stats=stats)
+
+    if args.compare:
+        results = list(results)
+        mismatch = compare(results, args.compare)
+    else:
+        out = open(args.output, "w") if args.output else sys.stdout
+        for result in results:
+            out.write(json.dumps(result) + "\n")
+        if args.output:
+            out.close()
+        mismatch = None
+
+    print(json.dumps(stats.summary()), file=sys.stderr)
+    if mismatch is not None:
+        print(f"tick {mismatch} differs from {args.compare}", file=sys.stderr)
+        sys.exit(1)
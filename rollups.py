@@ -0,0 +1,143 @@
+import threading
+import numpy as np
+
+
+# Pre-aggregated bins of the sensor data (1 min, 5 min and 1 hour)
+# every bin keeps count / sum / min / max / sum of squares per channel and is updated as samples arrive,
+# so the averages of any time window come from a handful of bins instead of scanning the raw samples
+
+NS = 1_000_000_000
+RESOLUTIONS = [3600, 300, 60]  # seconds, coarse to fine
+
+
+class Rollup:
+    '''Ring of bins for one resolution, slot = bin id % n_bins'''
+
+    def __init__(self, bin_seconds, n_bins, channels):
+        self.bin_ns = bin_seconds * NS
+        self.n_bins = n_bins
+        self.channels = list(channels)
+
+        # absolute bin id stored in each slot, a slot with another id holds stale data
+        self.bin_ids = np.full(n_bins, -1, dtype=np.int64)
+        self.count = np.zeros(n_bins, dtype=np.int64)
+        shape = (len(self.channels), n_bins)
+        self.sum = np.zeros(shape)
+        self.sumsq = np.zeros(shape)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+
+    def update(self, timestamps, columns):
+        ids = timestamps // self.bin_ns
+        # samples that fall before the oldest bin we can still hold are dropped
+        keep = ids > ids.max() - self.n_bins
+        ids = ids[keep]
+        slots = ids % self.n_bins
+
+        # reuse slots that still hold an older bin
+        stale = np.unique(slots[self.bin_ids[slots] < ids])
+        if len(stale):
+            self.bin_ids[stale] = -1
+            self.count[stale] = 0
+            self.sum[:, stale] = 0
+            self.sumsq[:, stale] = 0
+            self.min[:, stale] = np.inf
+            self.max[:, stale] = -np.inf
+        # ignore samples for bins that were already overwritten by newer ones
+        current = self.bin_ids[slots] <= ids
+        ids, slots = ids[current], slots[current]
+        self.bin_ids[slots] = ids
+
+        np.add.at(self.count, slots, 1)
+        for k, c in enumerate(self.channels):
+            values = np.asarray(columns[c])[keep][current]
+            np.add.at(self.sum[k], slots, values)
+            np.add.at(self.sumsq[k], slots, values * values)
+            np.minimum.at(self.min[k], slots, values)
+            np.maximum.at(self.max[k], slots, values)
+
+    def combine(self, first_bin, last_bin, acc):
+        # add the bins [first_bin, last_bin) into the accumulator
+        ids = np.arange(first_bin, last_bin)
+        slots = ids % self.n_bins
+        slots = slots[self.bin_ids[slots] == ids]
+        acc.add(self.count[slots].sum(), self.sum[:, slots].sum(axis=1), self.sumsq[:, slots].sum(axis=1),
+                self.min[:, slots].min(axis=1, initial=np.inf), self.max[:, slots].max(axis=1, initial=-np.inf))
+
+
+class _Accumulator:
+    def __init__(self, n_channels):
+        self.count = 0
+        self.sum = np.zeros(n_channels)
+        self.sumsq = np.zeros(n_channels)
+        self.min = np.full(n_channels, np.inf)
+        self.max = np.full(n_channels, -np.inf)
+
+    def add(self, count, sum_, sumsq, min_, max_):
+        self.count += count
+        self.sum += sum_
+        self.sumsq += sumsq
+        self.min = np.minimum(self.min, min_)
+        self.max = np.maximum(self.max, max_)
+
+
+class RollupSet:
+    '''1 min / 5 min / 1 hour rollups of a SensorStore
+         the store pushes every new batch here, partial minutes at the window edges are read from the raw samples '''
+
+    def __init__(self, store, retention_seconds=24 * 3600):
+        self.store = store
+        # sensor channels and derived ones (e.g. wqi)
+        self.channels = store.columns
+        # one extra bin per level for the bin that is still filling up
+        self.levels = [Rollup(seconds, retention_seconds // seconds + 1, self.channels) for seconds in RESOLUTIONS]
+        # a bin is updated in several steps (ids, count, sums, min / max), sessions must not read it half way
+        self._lock = threading.Lock()
+        store.subscribe(self.update)
+
+    def update(self, timestamps, columns):
+        if len(timestamps) == 0:
+            return
+        with self._lock:
+            for level in self.levels:
+                level.update(timestamps, columns)
+
+    def _cover(self, start, end, depth, acc, raw):
+        # use the biggest bins that fit fully in [start, end), then go one level finer for the two edges
+        if start >= end:
+            return
+        if depth == len(self.levels):
+            ts, columns = raw
+            lo, hi = np.searchsorted(ts, [start, end], side='left')
+            ts, columns = ts[lo:hi], {c: columns[c][lo:hi] for c in self.channels}
+            if len(ts):
+                values = np.stack([columns[c] for c in self.channels])
+                acc.add(len(ts), values.sum(axis=1), (values * values).sum(axis=1), values.min(axis=1), values.max(axis=1))
+            return
+
+        level = self.levels[depth]
+        first = -(-start // level.bin_ns)  # ceil
+        last = end // level.bin_ns
+        if first >= last:
+            self._cover(start, end, depth + 1, acc, raw)
+            return
+        level.combine(first, last, acc)
+        self._cover(start, first * level.bin_ns, depth + 1, acc, raw)
+        self._cover(last * level.bin_ns, end, depth + 1, acc, raw)
+
+    def stats(self, start, end):
+        '''count / mean / min / max / std per channel for samples with start <= timestamp < end (int64 ns)'''
+        acc = _Accumulator(len(self.channels))
+        # raw samples for the edges first: the store notifies us while holding its lock, so everything in the
+        # snapshot is already in the bins (taking the store lock under ours could deadlock with update)
+        raw = self.store.snapshot()
+        with self._lock:
+            self._cover(start, end, 0, acc, raw)
+
+        result = {}
+        for k, c in enumerate(self.channels):
+            n = acc.count
+            mean = acc.sum[k] / n if n else np.nan
+            var = max(acc.sumsq[k] / n - mean * mean, 0.0) if n else np.nan
+            result[c] = {'count': n, 'mean': mean, 'min': acc.min[k], 'max': acc.max[k], 'std': np.sqrt(var)}
+        return result
@@ -0,0 +1,235 @@
+import threading
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+
+
+# sensor channels we keep for every sample (same order as the dashboard uses them)
+CHANNELS = ['pH', 'TDS', 'turbidity', 'flow', 'temperature']
+
+
+def to_ns(timestamp):
+    # convert a datetime / pandas Timestamp / datetime64 into int64 nanoseconds
+    # (through pandas, np.datetime64(pd.Timestamp) would drop the nanoseconds)
+    return int(pd.Timestamp(timestamp).value)
+
+
+def _readonly(view):
+    view.flags.writeable = False
+    return view
+
+
+class SensorStore:
+    '''Fixed capacity column store for sensor samples.
+         every channel lives in its own numpy array next to an int64 timestamp array (nanoseconds)
+         appends write at the tail in O(1) and old samples are evicted by moving the head,
+         so readers get views of the live region without copying the whole buffer on every refresh
+
+         one store is shared by the ingest threads and every dashboard session: writes are serialized by the lock,
+         reads only hold it to take a snapshot. A snapshot is never written again (new samples go past its end,
+         compaction and late merges build new arrays) so it stays consistent without copying, and its views are
+         read only so a session can not change what the others see '''
+
+    def __init__(self, capacity=86400, retention=timedelta(hours=24), channels=CHANNELS, derived=None, dtype=np.float64):
+        # capacity = max number of samples kept (default is 24 hours of 1 second samples)
+        self.capacity = capacity
+        # dtype of the channels, float32 halves the memory of a store (see COMPACT_SCHEMA in devices.py)
+        self.dtype = np.dtype(dtype)
+        self.retention = retention
+        self.channels = list(channels)
+        # derived channels {name: function(columns) -> array} are computed once per incoming sample and stored
+        self.derived = dict(derived or {})
+        self.columns = self.channels + list(self.derived)
+
+        # the arrays start small and double while the store fills up (many devices -> many stores),
+        # a full store has twice the capacity allocated so we only compact once every `capacity` appends
+        self._size = min(2 * capacity, 4096)
+        self._ts = np.empty(self._size, dtype=np.int64)
+        self._cols = {c: np.empty(self._size, dtype=self.dtype) for c in self.columns}
+
+        # live samples are in [_head, _tail)
+        self._head = 0
+        self._tail = 0
+
+        # the ingestion service writes from its own threads while the dashboard reads
+        self._lock = threading.Lock()
+
+        # callbacks(timestamps, columns) run for every new batch, e.g. the rollups
+        self._listeners = []
+
+    def __len__(self):
+        return self._tail - self._head
+
+    def subscribe(self, callback):
+        self._listeners.append(callback)
+
+    def _notify(self, ts, columns):
+        # hand every new batch to the listeners (still under the write lock so they see batches in order)
+        for callback in self._listeners:
+            callback(ts, columns)
+
+    def _grow_size(self, needed):
+        size = self._size
+        while size < 2 * needed and size < 2 * self.capacity:
+            size *= 2
+        return min(size, 2 * self.capacity)
+
+    def _compact(self, extra):
+        # move the live region to the start of *new* arrays, views handed out before stay valid
+        n = len(self)
+        self._size = self._grow_size(n + extra)
+        ts = np.empty(self._size, dtype=np.int64)
+        ts[:n] = self._ts[self._head:self._tail]
+        cols = {}
+        for c in self.columns:
+            cols[c] = np.empty(self._size, dtype=self.dtype)
+            cols[c][:n] = self._cols[c][self._head:self._tail]
+
+        self._ts, self._cols = ts, cols
+        self._head, self._tail = 0, n
+
+    def _reserve(self, n):
+        # make room for n new samples, dropping the oldest ones once we are at capacity
+        overflow = len(self) + n - self.capacity
+        if overflow > 0:
+            self._head += min(overflow, len(self))
+        if self._tail + n > self._size:
+            self._compact(n)
+
+    def _merge(self, ts, columns):
+        # late samples: merge them with the samples newer than them into *new* arrays,
+        # so the buffer stays sorted by time and views handed out before stay valid
+        live_ts = self.timestamps()
+        p = int(np.searchsorted(live_ts, ts[0], side='right'))
+        merged_ts = np.concatenate([live_ts[p:], ts])
+        order = np.argsort(merged_ts, kind='stable')
+        n = p + len(merged_ts)
+        self._size = self._grow_size(n)
+
+        new_ts = np.empty(self._size, dtype=np.int64)
+        new_ts[:p] = live_ts[:p]
+        new_ts[p:n] = merged_ts[order]
+        new_cols = {}
+        for c in self.columns:
+            live = self.column(c)
+            new_cols[c] = np.empty(self._size, dtype=self.dtype)
+            new_cols[c][:p] = live[:p]
+            new_cols[c][p:n] = np.concatenate([live[p:], columns[c]])[order]
+
+        self._ts, self._cols = new_ts, new_cols
+        # same as _reserve: over capacity -> drop the oldest samples
+        self._head, self._tail = max(0, n - self.capacity), n
+
+    def append(self, timestamp, values):
+        '''add a single sample, values is a dict {channel: value}'''
+        ts = to_ns(timestamp)
+        if self.derived:
+            row = {c: np.array([values[c]], dtype=self.dtype) for c in self.channels}
+            values = {**values, **{name: fn(row)[0] for name, fn in self.derived.items()}}
+
+        with self._lock:
+            if not len(self) or ts >= self._ts[self._tail - 1]:
+                self._reserve(1)
+                i = self._tail
+                self._ts[i] = ts
+                for c in self.columns:
+                    self._cols[c][i] = values[c]
+                self._tail += 1
+                self._notify(self._ts[i:i + 1], {c: self._cols[c][i:i + 1] for c in self.columns})
+                return
+
+        # late sample, goes through the batch path that keeps the buffer sorted
+        self.extend(np.array([ts]), {c: [values[c]] for c in self.channels})
+
+    def extend(self, timestamps, columns):
+        '''add a batch of samples, timestamps as datetime64 / int64 ns and columns as {channel: array}
+             batches do not need to be sorted or newer than what is stored, the store keeps everything in time order '''
+        ts = np.asarray(timestamps)
+        ts = ts.astype('datetime64[ns]').astype(np.int64) if ts.dtype.kind == 'M' else ts.astype(np.int64)
+
+        if len(ts) == 0:
+            return
+        columns = {c: np.asarray(columns[c], dtype=self.dtype) for c in self.channels}
+
+        # ESP32 batches can arrive shuffled, sort the batch itself first
+        if len(ts) > 1 and np.any(ts[1:] < ts[:-1]):
+            order = np.argsort(ts, kind='stable')
+            ts = ts[order]
+            columns = {c: values[order] for c, values in columns.items()}
+
+        # a batch bigger than the buffer only keeps its newest samples (after sorting, so they really are the newest)
+        if len(ts) > self.capacity:
+            ts = ts[-self.capacity:]
+            columns = {c: values[-self.capacity:] for c, values in columns.items()}
+        n = len(ts)
+        for name, fn in self.derived.items():
+            columns[name] = np.asarray(fn(columns), dtype=self.dtype)
+
+        with self._lock:
+            if len(self) and ts[0] < self._ts[self._tail - 1]:
+                self._merge(ts, columns)
+            else:
+                # normal case, the batch is newer than everything stored
+                self._reserve(n)
+                i = self._tail
+                self._ts[i:i + n] = ts
+                for c in self.columns:
+                    self._cols[c][i:i + n] = columns[c]
+                self._tail += n
+            self._notify(ts, columns)
+
+    def evict(self, now=None):
+        '''drop samples older than the retention window'''
+        now = datetime.now() if now is None else now
+        cutoff = to_ns(now - self.retention)
+        # timestamps are appended in time order so the cutoff position is a binary search
+        with self._lock:
+            self._head += int(np.searchsorted(self._ts[self._head:self._tail], cutoff, side='left'))
+
+    def timestamps(self):
+        # int64 nanoseconds view of the live samples
+        return _readonly(self._ts[self._head:self._tail])
+
+    def column(self, channel):
+        # view of a single channel for the live samples
+        return _readonly(self._cols[channel][self._head:self._tail])
+
+    def snapshot(self):
+        '''consistent (timestamps, {channel: array}) views of the live samples'''
+        with self._lock:
+            return self.timestamps(), {c: self.column(c) for c in self.columns}
+
+    def window(self, start=None, end=None):
+        '''(timestamps, {channel: array}) views for start <= timestamp < end (int64 ns, None = open)
+             the buffer is sorted so both edges are a binary search and nothing is copied '''
+        ts, columns = self.snapshot()
+        lo = 0 if start is None else int(np.searchsorted(ts, start, side='left'))
+        hi = len(ts) if end is None else int(np.searchsorted(ts, end, side='left'))
+        return ts[lo:hi], {c: values[lo:hi] for c, values in columns.items()}
+
+    def to_frame(self, start=None, end=None):
+        '''DataFrame of the live samples (optionally only a time window) built on top of the buffer arrays (no copy)'''
+        ts, columns = self.window(start, end)
+        data = {'timestamp': ts.view('datetime64[ns]')}
+        data.update(columns)
+        return pd.DataFrame(data, copy=False)
+
+
+def compact_frame(df, **categories):
+    '''copy of a sample frame in the compact schema: float32 channels, timestamp as int64 epoch milliseconds
+         (datetime64[ms]) and the given metadata as categorical columns, e.g. compact_frame(df, device="purifier-1")
+         a scalar category is stored as one code per row, an array gets one category per distinct value '''
+    data = {}
+    for c, values in df.items():
+        values = values.to_numpy()
+        if values.dtype.kind == 'M':
+            values = values.astype('datetime64[ms]')
+        elif values.dtype.kind == 'f':
+            values = values.astype(np.float32, copy=False)
+        data[c] = values
+    for name, value in categories.items():
+        if np.ndim(value) == 0:
+            data[name] = pd.Categorical.from_codes(np.zeros(len(df), dtype=np.int8), [value])
+        else:
+            data[name] = pd.Categorical(value)
+    return pd.DataFrame(data, index=df.index, copy=False)
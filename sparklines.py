@@ -0,0 +1,70 @@
+import base64
+import threading
+import numpy as np
+from collections import OrderedDict
+from downsampling import minmax_indices
+
+
+# Small SVG sparklines for the metric cards
+# the path is built straight from the (downsampled) numpy array, no plotting library involved,
+# and results are memoized so a card that did not get new data costs a dict lookup
+
+SPARK_WIDTH = 200
+SPARK_HEIGHT = 60
+
+
+def sparkline_path(values, width=SPARK_WIDTH, height=SPARK_HEIGHT, pad=2):
+    '''SVG path ("M x,y L x,y ...") of the values scaled to width x height'''
+    y = np.asarray(values)
+    y = y[~np.isnan(y)]
+    if len(y) == 0:
+        return ""
+    if len(y) > width:
+        # about one min and one max per 2 pixels keeps the spikes
+        y = y[minmax_indices(y, width // 2)]
+    # only the few points left are converted to float64 for the scaling
+    y = y.astype(np.float64)
+
+    x = np.linspace(0, width, len(y)) if len(y) > 1 else np.array([0.0])
+    lo, hi = y.min(), y.max()
+    span = hi - lo if hi > lo else 1.0
+    # svg y axis points down
+    y = height - pad - (y - lo) / span * (height - 2 * pad)
+
+    points = np.char.add(np.char.add(np.round(x, 1).astype(str), ","), np.round(y, 1).astype(str))
+    return "M" + " L".join(points)
+
+
+def sparkline_svg(values, color, width=SPARK_WIDTH, height=SPARK_HEIGHT, stroke=2):
+    path = sparkline_path(values, width, height, pad=stroke)
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {width} {height}" preserveAspectRatio="none">'
+            f'<path d="{path}" fill="none" stroke="{color}" stroke-width="{stroke}" '
+            f'stroke-linejoin="round" vector-effect="non-scaling-stroke"/></svg>')
+
+
+_cache = OrderedDict()
+CACHE_SIZE = 128
+# every session thread uses the same cache
+_cache_lock = threading.Lock()
+
+
+def sparkline_data_uri(values, color, cache_key=None):
+    '''data URI of the sparkline, usable as an <img> src or a css background-image
+         cache_key should identify the data, e.g. (channel, window, last sample timestamp) '''
+
+    if cache_key is not None:
+        key = (cache_key, color)
+        with _cache_lock:
+            if key in _cache:
+                _cache.move_to_end(key)
+                return _cache[key]
+
+    svg = sparkline_svg(values, color)
+    uri = "data:image/svg+xml;base64," + base64.b64encode(svg.encode()).decode()
+
+    if cache_key is not None:
+        with _cache_lock:
+            _cache[key] = uri
+            if len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+    return uri
@@ -0,0 +1,257 @@
+import os
+import threading
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+from sensor_store import CHANNELS, SensorStore
+
+
+# Streaming anomaly detectors, a lighter alternative to the isolation forest
+# the forest is refit on the whole window every 24 hr and scores whole frames, these keep a small state per device
+# that every new sample updates (store listener, like the alerts), nothing is ever refit:
+#   ewma         robust EWMA z-score, the largest |z| over the channels
+#   mahalanobis  distance to the exponentially weighted mean / covariance, also catches odd combinations of channels
+#   hst          Half-Space Trees (Tan et al. 2011), how much recent data fell in the sample's region of random trees
+# WATER_DETECTOR picks the one a deployment uses, "isolation_forest" (the default) keeps the forest
+#
+# a sample is scored against the state before it (higher = more anomalous) and the samples that were not flagged are
+# folded into the state once every `block` samples of the stream. The blocks are counted over the whole stream so the
+# scores do not depend on how it was batched (one sample per refresh or a whole backfill), and a batch costs one numpy
+# pass per block. Flagged samples are never learned, dirty water keeps being flagged for as long as it lasts.
+# The first `warmup` samples only give the starting state (median / MAD, the false readings among them do not count)
+
+DETECTOR = os.environ.get("WATER_DETECTOR", "isolation_forest")
+
+
+def _robust_start(X):
+    # median and MAD standard deviation per channel
+    center = np.median(X, axis=0)
+    std = 1.4826 * np.median(np.abs(X - center), axis=0)
+    return center, np.maximum(std, 1e-9)
+
+
+class StreamingDetector:
+    '''base of the detectors, X is a (samples x channels) float64 array in the order of `channels`
+         subclasses implement _start(X) (state from the warmup samples), _score(X) and _learn(X) (samples of a block
+         that were not flagged, can be empty) '''
+
+    def __init__(self, threshold, block=16, warmup=200, channels=CHANNELS):
+        self.threshold = threshold
+        self.block = block
+        self.warmup = warmup
+        self.channels = list(channels)
+        self.ready = False
+        self._pending = []  # warmup samples, then the not flagged samples of the open block
+        self._seen = 0      # samples of the warmup / open block, flagged ones included
+
+    def fit_score(self, X):
+        '''score the samples in order and learn from them, NaN for the warmup samples'''
+        X = np.asarray(X, dtype=np.float64)
+        scores = np.full(len(X), np.nan)
+        i = 0
+        if not self.ready:
+            i = min(self.warmup - self._seen, len(X))
+            self._pending.append(X[:i])
+            self._seen += i
+            if self._seen < self.warmup:
+                return scores
+            self._start(np.concatenate(self._pending))
+            self.ready, self._pending, self._seen = True, [], 0
+
+        while i < len(X):
+            # up to the end of the open block
+            j = min(len(X), i + self.block - self._seen)
+            scores[i:j] = self._score(X[i:j])
+            self._pending.append(X[i:j][~(scores[i:j] > self.threshold)])
+            self._seen += j - i
+            if self._seen == self.block:
+                self._learn(np.concatenate(self._pending))
+                self._pending, self._seen = [], 0
+            i = j
+        return scores
+
+    def score(self, X):
+        '''scores without learning from the samples (NaN until the warmup is done)'''
+        X = np.asarray(X, dtype=np.float64)
+        return self._score(X) if self.ready else np.full(len(X), np.nan)
+
+    def labels(self, scores):
+        # -1 = anomaly, 1 = normal like the isolation forest (warmup samples are normal)
+        return np.where(scores > self.threshold, -1, 1)
+
+
+class EwmaZScore(StreamingDetector):
+    '''largest |x - mean| / std over the channels, mean and variance are exponentially weighted
+         halflife in samples (720 = 1 hr at 5 s), O(channels) per sample '''
+
+    def __init__(self, halflife=720, threshold=6.0, **kwargs):
+        super().__init__(threshold, **kwargs)
+        self.alpha = 1 - 0.5 ** (self.block / halflife)
+
+    def _start(self, X):
+        self.mean, std = _robust_start(X)
+        self.var = std ** 2
+
+    def _score(self, X):
+        return np.max(np.abs(X - self.mean) / np.sqrt(self.var), axis=1)
+
+    def _learn(self, X):
+        if not len(X):
+            return
+        # one block is one update, a block with flagged samples weighs less
+        a = self.alpha * len(X) / self.block
+        diff = X.mean(axis=0) - self.mean
+        self.mean = self.mean + a * diff
+        self.var = (1 - a) * (self.var + a * diff ** 2) + a * X.var(axis=0)
+
+
+class OnlineMahalanobis(StreamingDetector):
+    '''Mahalanobis distance to the exponentially weighted mean and covariance of the channels
+         O(channels^2) per sample, the covariance is inverted once per block '''
+
+    def __init__(self, halflife=720, threshold=6.0, **kwargs):
+        super().__init__(threshold, **kwargs)
+        self.alpha = 1 - 0.5 ** (self.block / halflife)
+
+    def _start(self, X):
+        center, std = _robust_start(X)
+        # covariance of the samples close to the median, the false readings would blow it up
+        inliers = X[np.all(np.abs(X - center) < 4 * std, axis=1)]
+        self.mean = inliers.mean(axis=0)
+        self._set_cov(np.cov(inliers, rowvar=False, bias=True))
+
+    def _set_cov(self, cov):
+        self.cov = cov
+        # a small ridge keeps it invertible when a channel is (nearly) constant
+        self._inv = np.linalg.inv(cov + np.eye(len(cov)) * 1e-9 * max(np.trace(cov), 1e-9))
+
+    def _score(self, X):
+        d = X - self.mean
+        return np.sqrt(np.einsum('ij,jk,ik->i', d, self._inv, d))
+
+    def _learn(self, X):
+        if not len(X):
+            return
+        a = self.alpha * len(X) / self.block
+        diff = X.mean(axis=0) - self.mean
+        self.mean = self.mean + a * diff
+        within = np.cov(X, rowvar=False, bias=True) if len(X) > 1 else 0.0
+        self._set_cov((1 - a) * (self.cov + a * np.outer(diff, diff)) + a * within)
+
+
+class HalfSpaceTrees(StreamingDetector):
+    '''Half-Space Trees: random trees that halve the (scaled) channel space at every level, the reference mass of a
+         node is the number of samples of the last block that fell in it. A sample's mass is r * 2^level at the first
+         node on its path holding fewer than size_limit samples (or the leaf), averaged over the trees
+         score = log2(reference samples / (mass + 1)), flagged (above 0) when the mass is below the number of samples
+         in the reference window, normal samples land in dense nodes deep down and score far below 0
+         O(trees * depth) per sample, the block is the reference window '''
+
+    def __init__(self, n_trees=25, depth=10, size_limit=0.1, threshold=0.0, block=256, seed=42, **kwargs):
+        super().__init__(threshold, block=block, **kwargs)
+        self.n_trees = n_trees
+        self.depth = depth
+        self.size_limit = size_limit * block
+        self.rng = np.random.default_rng(seed)
+
+    def _unit(self, X):
+        # channels scaled so +-6 robust standard deviations around the warmup median are [0, 1]
+        return (X - self.center) / (12 * self.std) + 0.5
+
+    def _start(self, X):
+        self.center, self.std = _robust_start(X)
+        T, C = self.n_trees, len(self.channels)
+
+        # random work range per tree and channel (s +- 2 max(s, 1 - s)), then every level splits a random channel
+        # of each node in the middle of the node's range. Nodes are stored as a heap: children of i are 2i+1, 2i+2
+        s = self.rng.random((T, C))
+        half = 2 * np.maximum(s, 1 - s)
+        lo, hi = (s - half)[:, None, :], (s + half)[:, None, :]  # ranges of the nodes of the current level
+        self.dims = np.empty((T, 2 ** self.depth - 1), dtype=np.intp)
+        self.splits = np.empty((T, 2 ** self.depth - 1))
+        for level in range(self.depth):
+            first, k = 2 ** level - 1, 2 ** level
+            dims = self.rng.integers(0, C, (T, k))
+            lo_d = np.take_along_axis(lo, dims[..., None], axis=2)[..., 0]
+            hi_d = np.take_along_axis(hi, dims[..., None], axis=2)[..., 0]
+            mid = (lo_d + hi_d) / 2
+            self.dims[:, first:first + k], self.splits[:, first:first + k] = dims, mid
+            left_hi, right_lo = hi.copy(), lo.copy()
+            np.put_along_axis(left_hi, dims[..., None], mid[..., None], axis=2)
+            np.put_along_axis(right_lo, dims[..., None], mid[..., None], axis=2)
+            lo = np.stack([lo, right_lo], axis=2).reshape(T, 2 * k, C)
+            hi = np.stack([left_hi, hi], axis=2).reshape(T, 2 * k, C)
+
+        self.mass = np.zeros((T, 2 ** (self.depth + 1) - 1))
+        self.n_ref = 0
+        self._learn(X)
+
+    def _paths(self, X):
+        # node of every sample in every tree at every level, (samples x trees x depth + 1)
+        U = self._unit(X)
+        rows, trees = np.arange(len(U))[:, None], np.arange(self.n_trees)
+        node = np.zeros((len(U), self.n_trees), dtype=np.intp)
+        paths = [node]
+        for _ in range(self.depth):
+            right = U[rows, self.dims[trees, node]] >= self.splits[trees, node]
+            node = 2 * node + 1 + right
+            paths.append(node)
+        return np.stack(paths, axis=2)
+
+    def _score(self, X):
+        r = self.mass[np.arange(self.n_trees)[:, None], self._paths(X)]
+        # masses only shrink along a path, so the first node under the size limit is the count of nodes above it
+        level = np.minimum((r >= self.size_limit).sum(axis=2), self.depth)
+        mass = np.take_along_axis(r, level[..., None], axis=2)[..., 0] * 2.0 ** level
+        return np.log2(self.n_ref / (mass.mean(axis=1) + 1))
+
+    def _learn(self, X):
+        # a block that was mostly flagged keeps the previous reference
+        if len(X) < self.block / 2 and self.n_ref:
+            return
+        nodes = self._paths(X) + (np.arange(self.n_trees) * self.mass.shape[1])[:, None]
+        self.mass = np.bincount(nodes.ravel(), minlength=self.mass.size).reshape(self.mass.shape).astype(np.float64)
+        self.n_ref = len(X)
+
+
+DETECTORS = {"ewma": EwmaZScore, "mahalanobis": OnlineMahalanobis, "hst": HalfSpaceTrees}
+
+
+def make_detector(name=DETECTOR, **params):
+    if name not in DETECTORS:
+        raise ValueError(f"unknown detector {name!r}, pick one of {', '.join(DETECTORS)} (or isolation_forest)")
+    return DETECTORS[name](**params)
+
+
+class DetectorScores:
+    '''store listener running a detector over the clean water of a device, the score of every sample is kept in a
+         store of its own (same capacity and retention) so the dashboard looks them up by timestamp '''
+
+    def __init__(self, detector, capacity=86400, retention=timedelta(hours=24)):
+        self.detector = detector
+        self.scores = SensorStore(capacity, retention, channels=["score"])
+        self._lock = threading.Lock()
+
+    def update(self, timestamps, columns):
+        if len(timestamps) == 0:
+            return
+        X = np.column_stack([np.asarray(columns[c], dtype=np.float64) for c in self.detector.channels])
+        with self._lock:
+            scores = self.detector.fit_score(X)
+        self.scores.extend(timestamps, {"score": scores})
+        # evicted on recorded time, replays keep the same window as live data
+        self.scores.evict(now=pd.Timestamp(int(timestamps[-1])))
+
+    def score_frame(self, df):
+        '''(labels, scores) of the rows of df, rows the detector has not seen are scored without learning from them'''
+        timestamps = df['timestamp'].to_numpy(dtype='datetime64[ns]').view(np.int64)
+        known_ts, columns = self.scores.snapshot()
+        pos = np.minimum(np.searchsorted(known_ts, timestamps), max(len(known_ts) - 1, 0))
+        hit = known_ts[pos] == timestamps if len(known_ts) else np.zeros(len(df), dtype=bool)
+
+        scores = np.empty(len(df))
+        scores[hit] = columns["score"][pos[hit]]
+        if not hit.all():
+            with self._lock:
+                scores[~hit] = self.detector.score(df.loc[~hit, self.detector.channels].to_numpy(dtype=np.float64))
+        return self.detector.labels(scores), scores
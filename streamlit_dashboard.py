@@ -1,13 +1,27 @@
 import streamlit as st
-import plotly.graph_objects as go
-import plotly.express as px
 import pandas as pd
-from streamlit_autorefresh import st_autorefresh
-from streamlit_extras.metric_cards import style_metric_cards
-from data_utils import water_clean_data, water_dirty_data, inject_anomalies, healthy_drinkable_water_ranges, calculate_wqi, create_trend_background
-from Styling import metric_color, metric_style, metric_style_
-from Anomaly_Detection import detect_anomalies, isolation_forest_detection
-import time
+from data_utils import water_clean_data, water_dirty_data, calculate_wqi, slice_by_time
+from devices import DEFAULT_DEVICE, get_device, device_ids
+from fleet import fleet_summary
+from sensor_store import to_ns
+from Styling import metric_color, metric_style_
+from charts import gauge_figure, time_series_figure
+from Anomaly_Detection import anomaly_detection, anomaly_incidents, detection_status
+from ingest_service import start_ingestion, INGEST_HOST, INGEST_PORT
+from metrics import metrics, RerunTimer
+
+# plotly, sklearn (Anomaly_Detection), pyarrow (archive) and streamlit_extras are imported where they are first
+# used, so a cold start or a view that does not need them does not pay for them (benchmarks/import_budget.py)
+
+# AI incidents shown per page in the sidebar
+INCIDENTS_PER_PAGE = 10
+
+# the live parts of a view are fragments that rerun on their own cadence, the rest of the page
+# (title, sidebar, filters, css) is only rebuilt when the user changes something
+LIVE_REFRESH = "5s"       # latest values: gauges, flow, WQI bar, metric cards, alerts
+CHART_REFRESH = "15s"     # time series charts, a few new samples barely move a 24 hr chart
+SIDEBAR_REFRESH = "10s"   # AI incident list
+FLEET_REFRESH = "10s"
 
 # set up page
 st.set_page_config(page_title="Smart Water Purification Dashboard", layout="wide")
@@ -15,415 +29,547 @@ st.set_page_config(page_title="Smart Water Purification Dashboard", layout="wide
 st.title("💧 Smart Water Quality Monitoring")
 
 
+# start the sensor ingestion service once per server process (shared by all sessions), unless the dashboard was
+# started through `python ingest_service.py`, which starts it before any page is rendered (see start_ingestion)
+@st.cache_resource
+def ingestion_service():
+    try:
+        return start_ingestion()
+    except OSError as e:
+        # the port is taken (another dashboard process), cached so every rerun does not try again
+        return e
+
+ingestion = ingestion_service()
+if isinstance(ingestion, OSError):
+    st.error(f"Ingestion service could not start on {INGEST_HOST}:{INGEST_PORT} ({ingestion.strerror}), "
+             "this dashboard does not receive any readings. Is another dashboard process running?")
+
 
 # Create a sidebar for user to choose between different view options
 st.sidebar.title("🔍 View")
+# choose which purifier unit to look at
+device_id = st.sidebar.selectbox("Device:", device_ids() or [DEFAULT_DEVICE])
+device = get_device(device_id)
 # List the view options we need (can add more anytime)
-view_options = st.sidebar.radio("Select Data to View:", ['Home', 'Clean Water', 'Dirty Water', 'System Maintenance'])
-
-# If statement to help add information to each view option
-if view_options == 'Home':
-    st.subheader("📊 Overall System Insights")
-    st.info('This section summarizes important insights')
+view_options = st.sidebar.radio("Select Data to View:", ['Home', 'Clean Water', 'Dirty Water', 'System Maintenance', 'Fleet Overview'], key="view")
 
-    st.subheader("")
-    #create time filter
-    time_filter = st.selectbox("Select time range in hours", [1,6,12,24], index=0, format_func=lambda x: f"{x} hour(s)")
-
-    st_autorefresh(interval=5000, key="clean_data_refresh")
 
-    clean_df = water_clean_data()
+def stream_data(device_id, stream):
+    return water_clean_data(device_id) if stream == "clean" else water_dirty_data(device_id)
 
-    ##############################################
 
-    clean_df_ = isolation_forest_detection(clean_df)
-
-    # Filter detected anomalies
-    ai_alerts = clean_df_[clean_df_['anomaly'] == -1] #.tail(5)  # Last 5 anomalies if any
+# hourly averages only change once an hour, every session reuses the read for a few minutes
+@st.cache_data(ttl=300, show_spinner=False)
+def archive_history(device_id, days, columns):
+    history_end = pd.Timestamp.now()
+    return get_device(device_id).clean_archive.read(history_end - pd.Timedelta(days=days), history_end,
+                                                    columns=list(columns), tier="1h")
 
-    if "ai_alerts" not in st.session_state:
-        # store ai alerts so we can show them longer
-        st.session_state.ai_alerts = []
-    expected_ranges = healthy_drinkable_water_ranges()
-    with st.sidebar:
-        if not ai_alerts.empty:
-            st.subheader("🚨 AI-Detected Anomalies")
-            for _, row in ai_alerts.iterrows():
-                issues = []
-                #for col in ["pH", "TDS", "turbidity", "conductivity", "flow", "pressure", "temperature"]:
-                #    issues.append(f"{col}: <code>{round(ai_alerts[col], 2)}</code>")
-
-                for param, (min_val, max_val) in expected_ranges.items():
-                    if param in row and (row[param] < min_val or row[param] > max_val):
-                        issues.append(f"{param}: {round(row[param], 2)} (Expected: {min_val}-{max_val})")
-                if issues:
-                    st.markdown(f"""
-                        <div style="border: 2px solid red; padding: 6px 10px; border-radius: 5px;
-                                    background-color: rgba(255, 80, 80, 0.3); margin: 5px 0;">
-                            <strong>Anomaly detected</strong> at <code>{row['timestamp'].strftime('%H:%M:%S')}</code><br/>
-                            pH: {round(row['pH'], 2)}, TDS: {round(row['TDS'], 2)}, Turbidity: {round(row['turbidity'], 2)}...
-                            </div>
-                        """, unsafe_allow_html=True)
-                else:
-                    st.success("✅ No anomalies detected by AI.")
-
-        #####################
-
-
-    if "anomalies_injected" not in st.session_state:
-        clean_df = inject_anomalies(clean_df)
-        st.session_state.anomalies_injected = True
 
+def home_window(device_id, time_filter):
+    '''clean data, the selected window of it and its statistics, None while there is no data yet'''
+    clean_df = water_clean_data(device_id)
+    if clean_df.empty:
+        return None
 
     last_timestamp = clean_df["timestamp"].iloc[-1]
     start_time = last_timestamp - pd.Timedelta(hours=time_filter)
-    filtered_data = clean_df[clean_df["timestamp"] >= start_time]
-
-    if filtered_data.empty:
-        st.warning("No data for the selected duration, please select a different time")
-    else:
-        # find average values for the selected duration
-        averages = {'pH': round(filtered_data['pH'].mean(),2),
-                    'TDS (mg/L)': round(filtered_data['TDS'].mean(),2),
-                    'Turbidity (NTU)': round(filtered_data['turbidity'].mean(),2),
-                    'Flow Rate (L/min)': round(filtered_data['flow'].mean(),2),
-                    'Temperature (°C)': round(filtered_data['temperature'].mean(),2)}
-
-        avg_ph = averages.get("pH", None)
-        bg_ph = create_trend_background(filtered_data, "pH")
-        ph_data = filtered_data['pH'].tolist()
-        tds_data = filtered_data['TDS'].tolist()
-        turb_data = filtered_data['turbidity'].tolist()
-        flow_data = filtered_data['flow'].tolist()
-        temp_data = filtered_data['temperature'].tolist()
-
-        avg_tds = averages.get("TDS (mg/L)", None)
-        bg_tds = create_trend_background(filtered_data, "TDS")
-
-        avg_turbidity = averages.get("Turbidity (NTU)", None)
-        bg_tur = create_trend_background(filtered_data, "turbidity")
-
-        bg_flow = create_trend_background(filtered_data, "flow")
-        bg_temp = create_trend_background(filtered_data, "temperature")
-
-        #if avg_ph is not None and avg_tds is not None and avg_turbidity is not None:
-        wqi_score = calculate_wqi(avg_ph, avg_tds, avg_turbidity)
-
-        # color code the % to show if quality is good or bad
-        if wqi_score >= 90:
-            bar_color = "#4CAF50"  # Green / excellent
-            wqi_comment = "💧 Excellent Performance"
-
-        elif wqi_score >= 80:
-            bar_color = "#FFEB3B"  # Yellow / check system for cleaning
-            wqi_comment = "🧹 System cleanup recommended"
-
-        else:
-            bar_color = "#F44336"  # Red / hazard perform maintenance
-            wqi_comment = "⚠️ Poor performance, perform system maintenance"
-
-        wqi_percent = max(0, min(wqi_score, 100))
-
-
-        st.markdown(f"""
-            <style>
-            .wqi-wrapper {{
-                display: flex;
-                align-items: center;
-                gap: 20px;
-            }}
-
-            .wqi-container {{
-                width: 60%;
-                min-width: 200px;
-                position: relative;
-            }}
-
-            .wqi-bar {{
-                position: relative;
-                width: 100%;
-                height: 35px;
-                background: linear-gradient(to right, 
-                    #F44336 0%, #F44336 80%, 
-                    #FFEB3B 80%, #FFEB3B 90%, 
-                    #4CAF50 90%, #4CAF50 100%);
-                border-radius: 10px;
-                margin-bottom: 10px;
-            }}
-
-            .wqi-pointer {{
-                position: absolute;
-                left: {wqi_percent}%;
-                bottom: -10px;
-                transform: translateX(-50%) rotate(180deg);
-                font-size: 25px;
-                color: white;
-                font-weight: bold;
-            }}
-
-            .wqi-ticks {{
-                position: relative;
-                top: 45px;
-                left: 0;
-                width: 100%;
-                height: 20px;
-            }}
-            .wqi-ticks span {{
-                position: absolute;
-                transform: translateX(-50%);
-                font-size: 12px;
-                color: white;
-            }}
-            
-            .wqi-comment {{
-                font-size: 16px;
-                font-weight: 600;
-                color: white;
-                padding: 2px 4px;
-                background-color: rgba(255, 193, 7, 0.15);
-                border-radius: 8px;
-                box-shadow: 0 2px 6px rgba(0,0,0,0.1);
-                max-width: 300px;
-            }}
-            </style>
-
-            <div class="wqi-wrapper">
-                <div class="wqi-container">
-                    <div style="margin-bottom: 5px; font-weight: bold;">Water Quality Index (WQI): {wqi_score:.2f}%</div>
-                    <div class="wqi-bar">
-                        <div class="wqi-pointer">▲</div>
-                        <div class="wqi-ticks">
-                        <span style="left: 0%;">0</span>
-                        <span style="left: 20%;">20</span>
-                        <span style="left: 40%;">40</span>
-                        <span style="left: 60%;">60</span>
-                        <span style="left: 80%;">80</span>
-                        <span style="left: 90%;">90</span>
-                        <span style="left: 100%;">100</span>
-                    </div>
-                    </div>
-                </div>
-                <div class="wqi-comment">{wqi_comment}</div>
-            </div>
-        """, unsafe_allow_html=True)
+    filtered_data = slice_by_time(clean_df, start_time)
 
+    # window statistics come from the pre-aggregated 1 min / 5 min / 1 hr bins instead of the raw samples
+    window_stats = get_device(device_id).clean_rollups.stats(to_ns(start_time), to_ns(last_timestamp) + 1)
+    return clean_df, filtered_data, window_stats, last_timestamp
 
 
-        #else:
-         #   st.warning("Not enough data to calculate WQI.")
+@st.fragment(run_every=SIDEBAR_REFRESH)
+def ai_incidents(device_id):
+    timer = RerunTimer("Home/incidents")
+    clean_df = water_clean_data(device_id)
+    timer.lap("fetch")
+    if clean_df.empty:
+        return
 
-        st.subheader("")
-        st.subheader("Water Quality Overview")
-        with st.container():
-            col1, col2, col3 = st.columns(3)
+    clean_df_ = anomaly_detection(clean_df, device_id)
+    timer.lap("scoring")
 
-            with col1:
-                metric_style("Average pH", averages['pH'],"",metric_color(averages["pH"],"pH"))
-                metric_style("Average Temperature", averages['Temperature (°C)'], "(°C)", metric_color(averages["Temperature (°C)"],"temperature"))
+    # Filter detected anomalies
+    ai_alerts = clean_df_[clean_df_['anomaly'] == -1] #.tail(5)  # Last 5 anomalies if any
 
-            with col2:
-                metric_style("Average TDS", averages['TDS (mg/L)'],"(mg/L)", metric_color(averages["TDS (mg/L)"],"TDS"))
-                #metric_style("Average conductivity", averages['Conductivity (µS/cm)'],"(µS/cm)", metric_color(averages["Conductivity (µS/cm)"],"conductivity"))
-                metric_style("Average Turbidity", averages['Turbidity (NTU)'],"(NTU)", metric_color(averages["Turbidity (NTU)"],"turbidity"))
+    # consecutive anomalous readings that are out of range are shown as one incident
+    incidents = anomaly_incidents(ai_alerts)
+    timer.lap("aggregation")
+    if not incidents.empty:
+        st.subheader("🚨 AI-Detected Anomalies")
+        pages = -(-len(incidents) // INCIDENTS_PER_PAGE)
+        page = st.number_input("Page", min_value=1, max_value=pages, value=1) if pages > 1 else 1
+        shown = incidents.iloc[(page - 1) * INCIDENTS_PER_PAGE: page * INCIDENTS_PER_PAGE]
+
+        html = ""
+        for row in shown.itertuples(index=False):
+            when = row.start.strftime('%H:%M:%S')
+            if row.samples > 1:
+                when += f" - {row.end.strftime('%H:%M:%S')} ({row.samples} readings)"
+            html += f"""
+                <div style="border: 2px solid red; padding: 6px 10px; border-radius: 5px;
+                            background-color: rgba(255, 80, 80, 0.3); margin: 5px 0;">
+                    <strong>Anomaly detected</strong> at <code>{when}</code><br/>
+                    pH: {round(row.pH, 2)}, TDS: {round(row.TDS, 2)}, Turbidity: {round(row.turbidity, 2)}...<br/>
+                    Out of range: {row.violations}
+                    </div>
+                """
+        st.markdown(html, unsafe_allow_html=True)
+        st.caption(f"{len(incidents)} incidents, page {page} of {pages}")
+    elif detection_status(device_id) is not None:
+        # no model yet (or the fit failed), "no anomalies" would be a false all clear
+        st.info(f"⏳ {detection_status(device_id)}")
+    else:
+        st.success("✅ No anomalies detected by AI.")
+    timer.lap("html")
+    timer.done()
 
-            with col3:
-                #metric_style("Average Pressure", averages['Pressure (bar)'],"(bar)", metric_color(averages["Pressure (bar)"],"pressure"))
-                metric_style("Average Flow", averages['Flow Rate (L/min)'],"(L/min)", metric_color(averages["Flow Rate (L/min)"],"flow"))
 
+@st.fragment(run_every=LIVE_REFRESH)
+def wqi_bar(device_id, time_filter):
+    timer = RerunTimer("Home/wqi")
+    window = home_window(device_id, time_filter)
+    timer.lap("fetch")
+    if window is None:
+        st.warning("Waiting for sensor data...")
+        return
+    clean_df, filtered_data, window_stats, last_timestamp = window
 
+    if filtered_data.empty:
+        st.warning("No data for the selected duration, please select a different time")
+        return
 
+    #if avg_ph is not None and avg_tds is not None and avg_turbidity is not None:
+    wqi_score = calculate_wqi(round(window_stats['pH']['mean'],2), round(window_stats['TDS']['mean'],2),
+                              round(window_stats['turbidity']['mean'],2))
 
-    st.subheader(' ')
+    # color code the % to show if quality is good or bad
+    if wqi_score >= 90:
+        wqi_comment = "💧 Excellent Performance"  # green / excellent
 
+    elif wqi_score >= 80:
+        wqi_comment = "🧹 System cleanup recommended"  # yellow / check system for cleaning
 
-    st.markdown("🚨 Alerts & Anomalies")
+    else:
+        wqi_comment = "⚠️ Poor performance, perform system maintenance"  # red / hazard perform maintenance
+
+    wqi_percent = max(0, min(wqi_score, 100))
+    timer.lap("aggregation")
+
+    # only the values change between refreshes, the css is sent once with the page (WQI_CSS)
+    st.markdown(f"""
+        <div class="wqi-wrapper">
+            <div class="wqi-container">
+                <div style="margin-bottom: 5px; font-weight: bold;">Water Quality Index (WQI): {wqi_score:.2f}%</div>
+                <div class="wqi-bar">
+                    <div class="wqi-pointer" style="left: {wqi_percent}%;">▲</div>
+                    <div class="wqi-ticks">
+                    <span style="left: 0%;">0</span>
+                    <span style="left: 20%;">20</span>
+                    <span style="left: 40%;">40</span>
+                    <span style="left: 60%;">60</span>
+                    <span style="left: 80%;">80</span>
+                    <span style="left: 90%;">90</span>
+                    <span style="left: 100%;">100</span>
+                </div>
+                </div>
+            </div>
+            <div class="wqi-comment">{wqi_comment}</div>
+        </div>
+    """, unsafe_allow_html=True)
+
+    # WQI of every sample is stored with the samples, so its stats cost no extra scan
+    wqi_stats = window_stats['wqi']
+    st.caption(f"Sample WQI over the last {time_filter} hour(s): average {wqi_stats['mean']:.2f}%, "
+               f"lowest {wqi_stats['min']:.2f}%, highest {wqi_stats['max']:.2f}%")
+    timer.lap("html")
+    timer.done()
+
+
+@st.fragment(run_every=CHART_REFRESH)
+def wqi_trend(device_id, time_filter):
+    timer = RerunTimer("Home/wqi trend")
+    window = home_window(device_id, time_filter)
+    timer.lap("fetch")
+    if window is None or window[1].empty:
+        return
+
+    wqi_fig = time_series_figure(window[1], "wqi", "WQI (%)", "#4CAF50", key=(device_id, "wqi"))
+    st.plotly_chart(wqi_fig, use_container_width=True)
+    timer.lap("charts")
+    timer.done()
+
+
+@st.fragment(run_every=LIVE_REFRESH)
+def overview_cards(device_id, time_filter):
+    timer = RerunTimer("Home/cards")
+    window = home_window(device_id, time_filter)
+    timer.lap("fetch")
+    if window is None or window[1].empty:
+        return
+    clean_df, filtered_data, window_stats, last_timestamp = window
+
+    # find average values for the selected duration
+    averages = {'pH': round(window_stats['pH']['mean'],2),
+                'TDS (mg/L)': round(window_stats['TDS']['mean'],2),
+                'Turbidity (NTU)': round(window_stats['turbidity']['mean'],2),
+                'Flow Rate (L/min)': round(window_stats['flow']['mean'],2),
+                'Temperature (°C)': round(window_stats['temperature']['mean'],2)}
+
+    # trend data for the card sparklines, the svg is rebuilt only when the window gets a new sample
+    trend = {param: filtered_data[param].to_numpy() for param in ['pH', 'TDS', 'turbidity', 'flow', 'temperature']}
+    trend_key = (device_id, time_filter, last_timestamp, len(filtered_data))
+    timer.lap("aggregation")
 
-    alerts = detect_anomalies(clean_df)
+    st.subheader("")
+    st.subheader("Water Quality Overview")
+    with st.container():
+        col1, col2, col3 = st.columns(3)
+
+        with col1:
+            metric_style_("Average pH", averages['pH'],"",metric_color(averages["pH"],"pH"), trend['pH'], ("pH",) + trend_key)
+            metric_style_("Average Temperature", averages['Temperature (°C)'], "(°C)", metric_color(averages["Temperature (°C)"],"temperature"), trend['temperature'], ("temperature",) + trend_key)
+
+        with col2:
+            metric_style_("Average TDS", averages['TDS (mg/L)'],"(mg/L)", metric_color(averages["TDS (mg/L)"],"TDS"), trend['TDS'], ("TDS",) + trend_key)
+            #metric_style("Average conductivity", averages['Conductivity (µS/cm)'],"(µS/cm)", metric_color(averages["Conductivity (µS/cm)"],"conductivity"))
+            metric_style_("Average Turbidity", averages['Turbidity (NTU)'],"(NTU)", metric_color(averages["Turbidity (NTU)"],"turbidity"), trend['turbidity'], ("turbidity",) + trend_key)
+
+        with col3:
+            #metric_style("Average Pressure", averages['Pressure (bar)'],"(bar)", metric_color(averages["Pressure (bar)"],"pressure"))
+            metric_style_("Average Flow", averages['Flow Rate (L/min)'],"(L/min)", metric_color(averages["Flow Rate (L/min)"],"flow"), trend['flow'], ("flow",) + trend_key)
+    timer.lap("html")
+    timer.done()
+
+
+@st.fragment(run_every=LIVE_REFRESH)
+def alert_list(device_id):
+    timer = RerunTimer("Home/alerts")
+    # the alert engine follows the samples as they arrive, here we only read its current state
+    engine = get_device(device_id).alerts
+    alerts = engine.active_alerts()
+    timer.lap("fetch")
 
     if alerts:
         for alert in alerts:
-            st.markdown(f""" 
-                        <div style= " border: 2px solid red;
-                        padding: 6px 10px;
-                        border-radius: 5px;
-                        background-color: rgba(255, 80, 80, 0.4);
-                        font-size: 0.9rem;
-                        margin: 5px 0;">
-                        <strong>{alert['parameter']}</strong>
-                        at <strong>{alert['value']}</strong><br/>
-                        Expected range: <code>{alert['range']}</code>
-                        </div>""", unsafe_allow_html=True)
+            acknowledged = alert['state'] == 'acknowledged'
+            col1, col2 = st.columns([6, 1])
+            with col1:
+                st.markdown(f"""
+                            <div style= " border: 2px solid {'gray' if acknowledged else 'red'};
+                            padding: 6px 10px;
+                            border-radius: 5px;
+                            background-color: rgba(255, 80, 80, {0.15 if acknowledged else 0.4});
+                            font-size: 0.9rem;
+                            margin: 5px 0;">
+                            <strong>{alert['parameter']}</strong> {alert['status']}
+                            at <strong>{alert['value']}</strong> ({alert['time_window']})<br/>
+                            Expected range: <code>{alert['range']}</code>,
+                            since {alert['opened_at'].strftime('%H:%M:%S')}{' (acknowledged)' if acknowledged else ''}
+                            </div>""", unsafe_allow_html=True)
+            with col2:
+                if not acknowledged:
+                    st.button("Acknowledge", key=f"ack-{device_id}-{alert['id']}", on_click=engine.acknowledge, args=(alert['id'],))
 
     else:
         st.success("All Parameters are within drinkable limits")
 
-elif view_options == 'Clean Water':
+    cleared = engine.cleared_alerts()
+    if cleared:
+        with st.expander(f"Cleared alerts ({len(cleared)})"):
+            for alert in cleared:
+                st.caption(f"{alert['parameter']} {alert['status']}: {alert['opened_at'].strftime('%H:%M:%S')} - "
+                           f"{alert['cleared_at'].strftime('%H:%M:%S')}")
+    timer.lap("html")
+    timer.done()
 
-    st.subheader("🔵 Clean Water Monitoring")
-    st.info("This section shows clean water quality monitoring data")
 
-    # Auto-refresh every 5 seconds
-    st_autorefresh(interval=5000, key="clean_data_refresh")
+def dark_metric_cards():
+    from streamlit_extras.metric_cards import style_metric_cards
+    style_metric_cards(background_color="#000000", border_left_color="#d6d6d6")
 
-    #Create a time filter for user to filter data
-    #hours = st.slider("Select duration (hours)", 1, 24, 1)
 
+@st.fragment(run_every=LIVE_REFRESH)
+def stream_gauges(device_id, stream):
+    '''latest pH, temperature and flow of the clean or dirty water'''
+    timer = RerunTimer(f"{stream.capitalize()} Water/gauges")
     # call the generated data (in actual system call sensors data)
-    df_clean = water_clean_data()
+    df = stream_data(device_id, stream)
+    timer.lap("fetch")
+
+    if df.empty:
+        st.warning("Waiting for sensor data...")
+        return
 
     #Plotting data
     # plot into 3 columns
     col1, spacer1, col2, spacer2, col3 = st.columns([1, 0.1, 1, 0.1, 1])
 
     #plotting pH level as a gauge
+    # gauges are built from cached templates (charts.GAUGES), only the value changes per refresh
     with col1:
-        ph_level = round(df_clean['pH'].iloc[-1],2)
-        gauge = go.Figure(go.Indicator(
-            mode = "gauge+number",
-            value=ph_level,
-            domain={"x": [0, 1], "y": [0,1]},
-            title = {'text':"Ph Level"},
-            gauge= {'axis': {'range': [0,14], 'tickmode': 'linear','tick0': 0,'dtick':2, 'tickfont': {'size': 14} },
-                    'bar': {'color': 'blue'},
-                    'steps': [{'range': [0, 6.5], 'color': "red"},
-                    {'range': [6.5, 9.5], 'color': "green"},
-                    {'range': [9.5, 14], 'color': "orange"},
-                    ]}
-        ))
-
-        gauge.update_layout(height=400,margin=dict(t=5, b=5, l=20, r=25))
-        st.plotly_chart(gauge, use_container_width=True)
+        ph_level = round(float(df['pH'].iloc[-1]), 2)
+        st.plotly_chart(gauge_figure("pH", ph_level), use_container_width=True)
 
     with col2:
         # Plot temperature as a gauge meter
-        temp_value = df_clean["temperature"].iloc[-1]
-        thermostat_fig = go.Figure(go.Indicator(
-            mode = "gauge+number",
-            value = temp_value,
-            domain={'x': [0, 1], 'y': [0, 1]},
-            title = {'text':"Temperature (°C)"},
-            gauge = {'axis': {'range': [0,60], 'tickmode': 'linear','tick0': 0,'dtick':10,'tickwidth': 1, 'tickcolor': 'darkgray'},
-                        'bar': {'color': 'blue'},
-                        'steps': [{'range': [0, 30], 'color': "#81D4FA"},
-                              {'range': [30, 60], 'color': "#FFB74D"}],
-                    'threshold': {'line': {'color': "black", 'width': 4},
-                                  'thickness': 0.75,'value': temp_value}},
-        ))
-
-        thermostat_fig.update_layout(height = 400,margin=dict(t=5, b=5, l=20, r=20))
-        st.plotly_chart(thermostat_fig, use_container_width=True)
+        temp_value = float(df["temperature"].iloc[-1])
+        st.plotly_chart(gauge_figure("temperature", temp_value), use_container_width=True)
 
     with col3:
         # show last flow rate and pressure data as single values
-        last_row = df_clean.iloc[-1]
+        last_row = df.iloc[-1]
         st.markdown("### ") # to add vertical space for better visual only
         #st.metric(label="Pressure (bar)", value=f"{last_row['pressure']:.2f}")
         st.metric(label="Flow Rate (L/min)", value=f"{last_row['flow']:.2f}")
-        style_metric_cards(background_color="#000000", border_left_color="#d6d6d6")
+    timer.lap("charts")
+    timer.done()
 
-    # Plot other charts
+
+@st.fragment(run_every=CHART_REFRESH)
+def stream_charts(device_id, stream):
+    '''TDS and turbidity over the last 24 hr of the clean or dirty water'''
+    timer = RerunTimer(f"{stream.capitalize()} Water/charts")
+    df = stream_data(device_id, stream)
+    timer.lap("fetch")
+    if df.empty:
+        return
 
     st.subheader("TDS")
-    tds_fig = px.area(df_clean, x="timestamp", y="TDS", title="TDS (mg/L)")
-    tds_fig.update_traces(line_color='deeppink')
+    tds_fig = time_series_figure(df, "TDS", "TDS (mg/L)", 'deeppink', area=True, key=(device_id, f"{stream}_tds"))
     st.plotly_chart(tds_fig, use_container_width=True)
 
     #st.subheader("Conductivity")
-    #st.plotly_chart(px.line(df_clean, x="timestamp", y="conductivity", title="Conductivity (µS/cm)"),
+    #st.plotly_chart(px.line(df, x="timestamp", y="conductivity", title="Conductivity (µS/cm)"),
      #                   use_container_width=True)
 
     st.subheader("Turbidity")
-    tur_fig = px.line(df_clean, x="timestamp", y="turbidity", title="Turbidity (NTU)")
-    tur_fig.update_traces(line= dict(color='mediumorchid'))
+    tur_fig = time_series_figure(df, "turbidity", "Turbidity (NTU)", 'mediumorchid', key=(device_id, f"{stream}_turbidity"))
     st.plotly_chart(tur_fig,use_container_width=True)
+    timer.lap("charts")
+    timer.done()
 
 
+@st.fragment(run_every=CHART_REFRESH)
+def maintenance_forecast(device_id):
+    timer = RerunTimer("System Maintenance/forecast")
+    # the maintenance engine updates its trends as samples arrive, here we only read the forecasts
+    engine = get_device(device_id).maintenance
+    forecast = pd.DataFrame(engine.status())
+    timer.lap("fetch")
 
+    if forecast.empty:
+        st.info("Learning the baseline of this unit, forecasts start after a few minutes of data")
+    else:
+        # one card per component, showing whichever of its indicators leaves the range first
+        cols = st.columns(forecast["component"].nunique())
+        for col, (component, rows) in zip(cols, forecast.groupby("component", sort=False)):
+            first = rows.sort_values("days_left", na_position="last").iloc[0]
+            if pd.isna(first["days_left"]) and first["state"] == "not enough history":
+                col.metric(component, "Not enough history",
+                           help=f"forecasts start after {engine.min_history_ns / 3.6e12:g} hr of data")
+            elif pd.isna(first["days_left"]):
+                col.metric(component, "No wear trend", help="none of its indicators is heading out of the range")
+            else:
+                col.metric(component, f"{first['days_left']:.1f} days",
+                           f"{first['parameter']} {first['trend_per_day']:+.3g} / day", delta_color="off",
+                           help=f"until {first['parameter']} reaches {first['threshold']}")
+                if first["state"] in ("service due", "out of range"):
+                    col.warning(f"{component} service {'overdue' if first['state'] == 'out of range' else 'due'}, "
+                                f"expected {first['expected']:%d %b %H:%M}")
+
+        st.dataframe(forecast, use_container_width=True, hide_index=True,
+                     column_config={"expected": st.column_config.DatetimeColumn(format="D MMM HH:mm")})
+    st.button("Reset baseline after service", key=f"maintenance-reset-{device_id}", on_click=engine.reset,
+              help="after a filter or membrane change the trends start again from the new readings")
+    timer.lap("html")
+    timer.done()
+
+
+@st.fragment(run_every=LIVE_REFRESH)
+def performance_tables():
+    # where the refreshes spend their time, recorded by every session of this server process
+    st.subheader("⏱️ Dashboard Performance")
+    st.caption(f"Also served in Prometheus format at http://{INGEST_HOST}:{INGEST_PORT}/metrics")
+    timings = pd.DataFrame(metrics.histograms())
+    if timings.empty:
+        st.info("No timings recorded yet, open one of the other views first")
+    else:
+        st.dataframe(timings, use_container_width=True, hide_index=True,
+                     column_config={c: st.column_config.NumberColumn(format="%.2f") for c in ["mean_ms", "p50_ms", "p95_ms", "p99_ms"]})
+
+    st.subheader("📦 Buffers & Models")
+    gauges = pd.DataFrame([{"metric": name, "labels": ", ".join(f"{k}={v}" for k, v in labels.items()), "value": value}
+                           for name, labels, value in metrics.gauges()])
+    if gauges.empty:
+        st.info("No devices yet")
+    else:
+        st.dataframe(gauges, use_container_width=True, hide_index=True)
 
-elif view_options == 'Dirty Water':
-    st.subheader("🟠 Dirty Water Monitoring")
-    st.info("This section shows dirty water quality monitoring data")
 
-    # Create a time filter for user to filter data
-    #hours = st.selectbox("Select Duration:", [1, 6, 12, 24], index=0)
-    df_dirty = water_dirty_data()
-    #filtered_dirty_df = filter_by_duration(df_dirty, hours)
+@st.fragment(run_every=FLEET_REFRESH)
+def fleet_table():
+    timer = RerunTimer("Fleet Overview")
+    fleet = fleet_summary(hours=1)
+    timer.lap("aggregation")
+    if fleet.empty:
+        st.warning("Waiting for sensor data...")
+    else:
+        st.dataframe(fleet, use_container_width=True, hide_index=True)
+    timer.lap("html")
+    timer.done()
+
+
+WQI_CSS = """
+    <style>
+    .wqi-wrapper {
+        display: flex;
+        align-items: center;
+        gap: 20px;
+    }
+
+    .wqi-container {
+        width: 60%;
+        min-width: 200px;
+        position: relative;
+    }
+
+    .wqi-bar {
+        position: relative;
+        width: 100%;
+        height: 35px;
+        background: linear-gradient(to right,
+            #F44336 0%, #F44336 80%,
+            #FFEB3B 80%, #FFEB3B 90%,
+            #4CAF50 90%, #4CAF50 100%);
+        border-radius: 10px;
+        margin-bottom: 10px;
+    }
+
+    .wqi-pointer {
+        position: absolute;
+        bottom: -10px;
+        transform: translateX(-50%) rotate(180deg);
+        font-size: 25px;
+        color: white;
+        font-weight: bold;
+    }
+
+    .wqi-ticks {
+        position: relative;
+        top: 45px;
+        left: 0;
+        width: 100%;
+        height: 20px;
+    }
+    .wqi-ticks span {
+        position: absolute;
+        transform: translateX(-50%);
+        font-size: 12px;
+        color: white;
+    }
+
+    .wqi-comment {
+        font-size: 16px;
+        font-weight: 600;
+        color: white;
+        padding: 2px 4px;
+        background-color: rgba(255, 193, 7, 0.15);
+        border-radius: 8px;
+        box-shadow: 0 2px 6px rgba(0,0,0,0.1);
+        max-width: 300px;
+    }
+    </style>
+"""
 
-    # Auto-refresh every 5 seconds
-    st_autorefresh(interval=5000, key="dirty_data_refresh")
 
+# If statement to help add information to each view option
+if view_options == 'Home':
+    st.subheader("📊 Overall System Insights")
+    st.info('This section summarizes important insights')
 
-    # Plotting data
-    # plot into 3 columns
-    col1, spacer1, col2, spacer2, col3 = st.columns([1, 0.1, 1, 0.1, 1])
+    st.subheader("")
+    #create time filter
+    time_filter = st.selectbox("Select time range in hours", [1,6,12,24], index=0, format_func=lambda x: f"{x} hour(s)")
 
-    # plotting pH level as a gauge
-    with col1:
-        ph_level = round(df_dirty['pH'].iloc[-1], 2)
-        gauge = go.Figure(go.Indicator(
-            mode="gauge+number",
-            value=ph_level,
-            domain={"x": [0, 1], "y": [0, 1]},
-            title={'text': "Ph Level"},
-            gauge={'axis': {'range': [0, 14], 'tickmode': 'linear', 'tick0': 0, 'dtick': 2, 'tickfont': {'size': 14}},
-                   'bar': {'color': 'blue'},
-                   'steps': [{'range': [0, 6.5], 'color': "red"},
-                             {'range': [6.5, 9.5], 'color': "green"},
-                             {'range': [9.5, 14], 'color': "orange"},
-                             ]}
-        ))
-
-        gauge.update_layout(height=400, margin=dict(t=5, b=5, l=20, r=25))
-        st.plotly_chart(gauge, use_container_width=True)
+    with st.sidebar:
+        ai_incidents(device_id)
 
-    with col2:
-        # Plot temperature as a gauge meter
-        temp_value = df_dirty["temperature"].iloc[-1]
-        thermostat_fig = go.Figure(go.Indicator(
-            mode="gauge+number",
-            value=temp_value,
-            domain={'x': [0, 1], 'y': [0, 1]},
-            title={'text': "Temperature (°C)"},
-            gauge={'axis': {'range': [0, 60], 'tickmode': 'linear', 'tick0': 0, 'dtick': 10, 'tickwidth': 1,
-                            'tickcolor': 'darkgray'},
-                   'bar': {'color': 'blue'},
-                   'steps': [{'range': [0, 30], 'color': "#81D4FA"},
-                             {'range': [30, 60], 'color': "#FFB74D"}],
-                   'threshold': {'line': {'color': "black", 'width': 4},
-                                 'thickness': 0.75, 'value': temp_value}},
-        ))
-
-        thermostat_fig.update_layout(height=400, margin=dict(t=5, b=5, l=20, r=20))
-        st.plotly_chart(thermostat_fig, use_container_width=True)
+    st.markdown(WQI_CSS, unsafe_allow_html=True)
+    wqi_bar(device_id, time_filter)
+    wqi_trend(device_id, time_filter)
 
-    with col3:
-        # show last flow rate and pressure data as single values
-        last_row_dirty = df_dirty.iloc[-1]
-        st.markdown("### ")  # to add vertical space for better visual only
-        #st.metric(label="Pressure (bar)", value=f"{last_row_dirty['pressure']:.2f}")
-        st.metric(label="Flow Rate (L/min)", value=f"{last_row_dirty['flow']:.2f}")
-        style_metric_cards(background_color="#000000", border_left_color="#d6d6d6")
+        #else:
+         #   st.warning("Not enough data to calculate WQI.")
+
+    overview_cards(device_id, time_filter)
+
+    st.subheader(' ')
+
+
+    st.markdown("🚨 Alerts & Anomalies")
+    alert_list(device_id)
+
+elif view_options == 'Clean Water':
+
+    st.subheader("🔵 Clean Water Monitoring")
+    st.info("This section shows clean water quality monitoring data")
+
+    #Create a time filter for user to filter data
+    #hours = st.slider("Select duration (hours)", 1, 24, 1)
+
+    stream_gauges(device_id, "clean")
+    dark_metric_cards()
 
     # Plot other charts
+    stream_charts(device_id, "clean")
 
-    st.subheader("TDS")
-    tds_fig = px.area(df_dirty, x="timestamp", y="TDS", title="TDS (mg/L)")
-    tds_fig.update_traces(line_color='deeppink')
-    st.plotly_chart(tds_fig, use_container_width=True)
+    # longer history comes from the on-disk archive (hourly averages, only the needed columns are read)
+    # the expander reruns the page when it is opened or closed, the archive is only read while it is open
+    history_expander = st.expander("📚 History", key="history", on_change="rerun")
+    if history_expander.open:
+        with history_expander:
+            days = st.selectbox("Show the last", [7, 30, 90], format_func=lambda x: f"{x} days")
+            history = archive_history(device_id, days, ("TDS", "turbidity"))
+            if history.empty:
+                st.info("No archived data yet")
+            else:
+                st.line_chart(history, x="timestamp", y=["TDS", "turbidity"])
 
-    #st.subheader("Conductivity")
-    #st.plotly_chart(px.line(df_dirty, x="timestamp", y="conductivity", title="Conductivity (µS/cm)"),
-     #               use_container_width=True)
 
-    st.subheader("Turbidity")
-    tur_fig = px.line(df_dirty, x="timestamp", y="turbidity", title="Turbidity (NTU)")
-    tur_fig.update_traces(line=dict(color='mediumorchid'))
-    st.plotly_chart(tur_fig, use_container_width=True)
+
+
+elif view_options == 'Dirty Water':
+    st.subheader("🟠 Dirty Water Monitoring")
+    st.info("This section shows dirty water quality monitoring data")
+
+    # Create a time filter for user to filter data
+    #hours = st.selectbox("Select Duration:", [1, 6, 12, 24], index=0)
+    #filtered_dirty_df = filter_by_duration(df_dirty, hours)
+
+    stream_gauges(device_id, "dirty")
+    dark_metric_cards()
+
+    # Plot other charts
+    stream_charts(device_id, "dirty")
 
 
 elif view_options == 'System Maintenance':
     st.subheader("🛠️ Predictive Maintenance")
-    st.info("This section shows predictive system maintenance data")
+    st.caption("Filter clogging (turbidity up, flow down) and membrane wear (TDS up) from the clean water trends, "
+               "forecast against the drinkable ranges")
+    maintenance_forecast(device_id)
+
+    performance_tables()
+
+elif view_options == 'Fleet Overview':
+    st.subheader("🏭 Fleet Overview")
+    st.info("Last hour of clean water for every purifier unit")
+
+    fleet_table()
 
 
 
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# the modules live at the repo root and read their folders from the environment when they are imported,
+# keep the models and archives the tests write out of the working copy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_scratch = tempfile.mkdtemp(prefix="water-tests-")
+os.environ.setdefault("WATER_MODEL_DIR", os.path.join(_scratch, "models"))
+os.environ.setdefault("WATER_ARCHIVE_DIR", os.path.join(_scratch, "archive"))
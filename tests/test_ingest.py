@@ -0,0 +1,116 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+import numpy as np
+import pytest
+import ingest_service
+from devices import device_ids, get_device
+from ingest_service import IngestHandler, parse_batch
+from sensor_store import CHANNELS
+
+# a minute ago in epoch ms, the service only keeps the last 24 hr
+T0 = int(time.time() * 1000) - 60_000
+
+
+def batch(device, n=3, **overrides):
+    payload = {"device": device, "stream": "clean", "timestamp": [T0 + 1000 * i for i in range(n)]}
+    payload.update({c: [7.0 + i for i in range(n)] for c in CHANNELS})
+    payload.update(overrides)
+    return payload
+
+
+@pytest.fixture(scope="module")
+def server():
+    # same handler as the service, on a free port
+    server = ThreadingHTTPServer(("127.0.0.1", 0), IngestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://%s:%d" % server.server_address[:2]
+    server.shutdown()
+    server.server_close()
+
+
+def post(url, body):
+    data = body if isinstance(body, bytes) else json.dumps(body).encode()
+    request = urllib.request.Request(url + "/readings", data=data, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+BAD_BATCHES = {
+    "not an object": [1, 2, 3],
+    "unknown stream": batch("bad-stream", stream="grey"),
+    "null value": batch("bad-null", pH=[7.0, None, 7.2]),
+    "string value": batch("bad-string", TDS=["a", "b", "c"]),
+    "missing channel": {k: v for k, v in batch("bad-missing").items() if k != "flow"},
+    "short channel": batch("bad-short", turbidity=[1.0, 2.0]),
+    "2-D batch": batch("bad-2d", **{c: [[1.0, 2.0, 3.0]] for c in ["timestamp"] + CHANNELS}),
+    "huge timestamp": batch("bad-huge", timestamp=[10**30, 10**30, 10**30]),
+    "timestamp past datetime64[ns]": batch("bad-2300", timestamp=["2300-01-01T00:00:00"] * 3),
+    "timestamp before the epoch": batch("bad-1960", timestamp=[-(10**12)] * 3),
+    "row is not an object": {"device": "bad-rows", "readings": [1, 2]},
+    "row without a channel": {"device": "bad-row-key", "readings": [{"timestamp": T0, "pH": 7.0}]},
+    "device id with a path": batch("../../etc"),
+    "device id not a string": batch(42),
+}
+
+
+@pytest.mark.parametrize("payload", BAD_BATCHES.values(), ids=BAD_BATCHES.keys())
+def test_bad_batch_is_rejected_without_creating_the_device(server, payload):
+    before = device_ids()
+    status, reply = post(server, payload)
+    assert status == 400
+    assert reply["error"]
+    assert device_ids() == before
+
+
+def test_invalid_json_is_rejected(server):
+    status, _ = post(server, b"{not json")
+    assert status == 400
+
+
+def test_good_batch_is_stored(server):
+    status, reply = post(server, batch("good-unit", n=5))
+    assert (status, reply) == (200, {"accepted": 5})
+    assert len(get_device("good-unit").clean_store) == 5
+
+
+def test_bad_batch_leaves_an_existing_store_alone(server):
+    post(server, batch("partial-unit", n=4))
+    status, _ = post(server, batch("partial-unit", n=4, temperature=[20.0, 21.0, float("nan"), 22.0]))
+    assert status == 400
+    assert len(get_device("partial-unit").clean_store) == 4
+
+
+def test_no_new_devices_past_max_devices(server, monkeypatch):
+    get_device("existing-unit")
+    monkeypatch.setattr(ingest_service, "MAX_DEVICES", len(device_ids()))
+    status, reply = post(server, batch("one-too-many"))
+    assert status == 400
+    assert "one-too-many" not in device_ids()
+    # devices that already exist keep reporting
+    assert post(server, batch("existing-unit"))[0] == 200
+
+
+def test_allowlist(monkeypatch):
+    monkeypatch.setattr(ingest_service, "ALLOWED_DEVICES", {"purifier-7"})
+    with pytest.raises(ValueError):
+        parse_batch(batch("purifier-8"))
+    store, timestamps, columns = parse_batch(batch("purifier-7"))
+    assert store is get_device("purifier-7").clean_store
+
+
+def test_row_batch_matches_columnar_batch():
+    columnar = batch("rows-unit", n=4)
+    rows = {"device": "rows-unit", "readings": [{k: columnar[k][i] for k in ["timestamp"] + CHANNELS} for i in range(4)]}
+    _, ts_a, cols_a = parse_batch(columnar)
+    _, ts_b, cols_b = parse_batch(rows)
+    np.testing.assert_array_equal(ts_a, ts_b)
+    for c in CHANNELS:
+        np.testing.assert_array_equal(cols_a[c], cols_b[c])
@@ -0,0 +1,56 @@
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pytest
+from data_utils import generate_bulk_data
+from replay import _chunk
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def log(tmp_path_factory):
+    # 1500 samples (~2 hours) in epoch milliseconds, as the ESP32 sends them
+    df = generate_bulk_data(1500, end=datetime(2026, 10, 11, 12), seed=1)
+    df["timestamp"] = df["timestamp"].astype("datetime64[ms]").astype("int64")
+    path = tmp_path_factory.mktemp("replay") / "log.csv"
+    df.drop(columns="is_anomaly").to_csv(path, index=False)
+    return path
+
+
+def run_replay(*args, tz="UTC"):
+    env = dict(os.environ, TZ=tz)
+    return subprocess.run([sys.executable, os.path.join(ROOT, "replay.py"), *map(str, args)],
+                          cwd=ROOT, env=env, capture_output=True, text=True, timeout=600)
+
+
+def test_compare_round_trip(log, tmp_path):
+    fixture = tmp_path / "results.jsonl"
+    done = run_replay(log, "--tick", 60, "--output", fixture)
+    assert done.returncode == 0, done.stderr
+    results = [json.loads(line) for line in fixture.read_text().splitlines()]
+    assert len(results) > 100
+    assert all(r["rows"] > 0 for r in results)
+
+    # same log, same results, and in another timezone as well
+    for tz in ["UTC", "America/New_York"]:
+        done = run_replay(log, "--tick", 60, "--compare", fixture, tz=tz)
+        assert done.returncode == 0, done.stderr
+
+    # a changed tick is reported by its index
+    results[17]["wqi"] = -1.0
+    fixture.write_text("".join(json.dumps(r) + "\n" for r in results))
+    done = run_replay(log, "--tick", 60, "--compare", fixture)
+    assert done.returncode == 1
+    assert "tick 17 differs" in done.stderr
+
+
+def test_epoch_ms_chunks_are_utc():
+    df = pd.DataFrame({"timestamp": [1_760_000_000_000], **{c: [1.0] for c in ["pH", "TDS", "turbidity", "flow", "temperature"]}})
+    ns, columns = _chunk(df)
+    assert pd.Timestamp(int(ns[0])) == pd.Timestamp("2025-10-09T08:53:20")
+    assert columns["pH"].dtype == np.float64
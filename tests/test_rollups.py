@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from rollups import NS, RollupSet
+from sensor_store import CHANNELS, SensorStore
+
+T0 = 1_760_000_000 * NS
+
+
+@pytest.fixture(scope="module")
+def filled():
+    '''6 hours of irregular samples (1-9 s apart) in batches of random size, plus a batch that arrives late'''
+    rng = np.random.default_rng(7)
+    store = SensorStore(derived={"wqi": lambda cols: cols["pH"] * 10 - cols["turbidity"]})
+    rollups = RollupSet(store)
+    ts = T0 + np.cumsum(rng.integers(1, 10, size=3500)) * NS + rng.integers(0, NS, size=3500)
+    columns = {c: rng.normal(50, 20, size=len(ts)) for c in CHANNELS}
+    late = rng.random(len(ts)) < 0.05
+    i = 0
+    while i < len(ts):
+        n = int(rng.integers(1, 200))
+        keep = ~late[i:i + n]
+        store.extend(ts[i:i + n][keep], {c: v[i:i + n][keep] for c, v in columns.items()})
+        i += n
+    store.extend(ts[late], {c: v[late] for c, v in columns.items()})
+    return store, rollups, rng
+
+
+def raw_stats(store, start, end):
+    ts, columns = store.snapshot()
+    inside = (ts >= start) & (ts < end)
+    return {c: columns[c][inside] for c in store.columns}
+
+
+def test_store_holds_every_sample(filled):
+    store, _, _ = filled
+    ts, _ = store.snapshot()
+    assert len(store) == 3500
+    assert (np.diff(ts) >= 0).all()
+
+
+def test_stats_match_a_raw_recompute(filled):
+    store, rollups, rng = filled
+    ts, _ = store.snapshot()
+    for _ in range(300):
+        start, end = np.sort(rng.integers(ts[0] - 60 * NS, ts[-1] + 60 * NS, size=2))
+        got = rollups.stats(int(start), int(end))
+        for c, values in raw_stats(store, start, end).items():
+            assert got[c]["count"] == len(values)
+            if len(values) == 0:
+                assert np.isnan(got[c]["mean"])
+                continue
+            assert got[c]["mean"] == pytest.approx(values.mean(), rel=1e-9)
+            assert got[c]["min"] == values.min()
+            assert got[c]["max"] == values.max()
+            assert got[c]["std"] == pytest.approx(values.std(), rel=1e-6, abs=1e-6)
+
+
+def test_stats_on_bin_edges(filled):
+    # windows that start and end exactly on minute / hour boundaries only use whole bins
+    store, rollups, _ = filled
+    ts, _ = store.snapshot()
+    for bin_ns in [60 * NS, 300 * NS, 3600 * NS]:
+        start = -(-int(ts[0]) // bin_ns) * bin_ns
+        end = int(ts[-1]) // bin_ns * bin_ns
+        got = rollups.stats(start, end)
+        values = raw_stats(store, start, end)
+        assert got["pH"]["count"] == len(values["pH"])
+        assert got["wqi"]["mean"] == pytest.approx(values["wqi"].mean(), rel=1e-9)
@@ -0,0 +1,174 @@
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import numpy as np
+
+
+# Offline hyperparameter search for the isolation forest
+# every combination of contamination, n_estimators, max_samples and feature subset is fit on a day of labelled
+# synthetic clean water (data_utils.generate_bulk_data: false readings + bursts, like what the dashboard trains on)
+# and scored on a second, differently seeded day. The fits run in a process pool on all cores, the training and
+# evaluation arrays are written once to .npy files that every worker memory maps (read only, shared through the page
+# cache instead of being pickled for every candidate).
+# The best candidate (F1 of the anomaly labels, then average precision, then fewer trees) is written to
+# isolation_forest_params.json in the model folder, where train_isolation_forest() and the model managers pick it up
+# (running models are retrained with it on the next refresh)
+#
+#   python tuning.py                                   # default grid on all cores
+#   python tuning.py --contamination 0.01,0.03 --n-estimators 100 --workers 4 --dry-run
+#   python tuning.py --group plant-a --drift clogging  # only for the devices of one model group
+#
+# only numpy is imported at the top, the spawned workers import this module as well
+
+FEATURES = ['pH', 'TDS', 'turbidity', 'flow', 'temperature']
+CONTAMINATION = [0.005, 0.01, 0.02, 0.03, 0.05]
+N_ESTIMATORS = [50, 100, 200]
+MAX_SAMPLES = ["auto", 512, 1024]
+
+# worker side: name -> memory mapped array
+_shared = {}
+
+
+def _attach(paths):
+    # pool initializer, maps the arrays written by share_arrays() once per worker
+    for name, path in paths.items():
+        _shared[name] = np.load(path, mmap_mode="r")
+
+
+def share_arrays(folder, **arrays):
+    '''write the arrays to .npy files in folder, {name: path} for _attach'''
+    paths = {}
+    for name, values in arrays.items():
+        paths[name] = os.path.join(folder, f"{name}.npy")
+        np.save(paths[name], np.ascontiguousarray(values))
+    return paths
+
+
+def candidates(contamination=CONTAMINATION, n_estimators=N_ESTIMATORS, max_samples=MAX_SAMPLES, min_features=4):
+    '''every combination of the grid, feature subsets with at least min_features of the FEATURES'''
+    subsets = [list(s) for k in range(len(FEATURES), min_features - 1, -1) for s in itertools.combinations(FEATURES, k)]
+    return [{"params": {"contamination": c, "n_estimators": n, "max_samples": m}, "features": features}
+            for features in subsets for c in contamination for n in n_estimators for m in max_samples]
+
+
+def evaluate(candidate):
+    '''fit one candidate on the shared training array and score it on the evaluation array (runs in a worker)'''
+    from sklearn.ensemble import IsolationForest
+    from sklearn.metrics import average_precision_score
+
+    columns = [FEATURES.index(f) for f in candidate["features"]]
+    X_train, X_eval, y = _shared["train"][:, columns], _shared["eval"][:, columns], _shared["labels"]
+
+    start = time.perf_counter()
+    model = IsolationForest(random_state=42, **candidate["params"]).fit(X_train)
+    fit_s = time.perf_counter() - start
+    scores = model.score_samples(X_eval)
+    # same rule as ScoreCache / model.predict
+    predicted = scores - model.offset_ < 0
+
+    tp = int((predicted & y).sum())
+    precision = tp / predicted.sum() if predicted.any() else 0.0
+    recall = tp / y.sum() if y.any() else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {**candidate, "precision": round(float(precision), 4), "recall": round(float(recall), 4),
+            "f1": round(float(f1), 4), "average_precision": round(float(average_precision_score(y, -scores)), 4),
+            "fit_seconds": round(fit_s, 3)}
+
+
+def rank(result):
+    # ties go to the cheaper model (sorting / max keep the earlier candidate after that)
+    return result["f1"], result["average_precision"], -result["params"]["n_estimators"]
+
+
+def best(results):
+    return max(results, key=rank)
+
+
+def search(grid, train, evaluation, workers=None):
+    '''evaluate every candidate of the grid, train / evaluation = (X, is_anomaly) arrays with FEATURES columns'''
+    with tempfile.TemporaryDirectory(prefix="water-tuning-") as folder:
+        paths = share_arrays(folder, train=train[0], eval=evaluation[0], labels=evaluation[1])
+        # spawn like the fleet pool, the workers only need numpy and sklearn
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_attach, initargs=(paths,)) as pool:
+            return list(pool.map(evaluate, grid))
+
+
+def labelled_day(hours, interval, drift, seed):
+    '''(X, is_anomaly) of synthetic clean water with false readings and bursts'''
+    from data_utils import generate_bulk_data
+    df = generate_bulk_data(int(timedelta(hours=hours) / interval), interval=interval, anomaly_rate=0.03,
+                            burst_rate=1e-3, drift=drift, seed=seed)
+    return df[FEATURES].to_numpy(), df["is_anomaly"].to_numpy()
+
+
+def write_config(path, result, search_info):
+    config = {"params": result["params"], "features": result["features"], "tuned_at": datetime.now().isoformat(),
+              "score": {k: result[k] for k in ["precision", "recall", "f1", "average_precision"]},
+              "search": search_info}
+    # temp file + rename like the models, a training thread never reads half a file
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(config, f, indent=2)
+    os.replace(path + ".tmp", path)
+    return config
+
+
+def _floats_or_auto(text):
+    return [v if v == "auto" else (int(v) if v.isdigit() else float(v)) for v in text.split(",")]
+
+
+if __name__ == "__main__":
+    import argparse
+    from Anomaly_Detection import MODEL_CONFIG_FILE, MODEL_DIR
+
+    parser = argparse.ArgumentParser(description="Grid search of the isolation forest settings on labelled synthetic data")
+    parser.add_argument("--contamination", default=",".join(map(str, CONTAMINATION)))
+    parser.add_argument("--n-estimators", default=",".join(map(str, N_ESTIMATORS)))
+    parser.add_argument("--max-samples", default=",".join(map(str, MAX_SAMPLES)), help="sample counts, fractions or auto")
+    parser.add_argument("--min-features", type=int, default=4, help="smallest feature subset to try")
+    parser.add_argument("--hours", type=float, default=24, help="hours of data to train on and to evaluate on")
+    parser.add_argument("--interval", type=float, default=5, help="seconds between samples")
+    parser.add_argument("--drift", default="none", help="drift profile of the evaluation day (data_utils.DRIFT_PROFILES)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workers", type=int, help="processes (default: all cores)")
+    parser.add_argument("--group", help="write the configuration for this model group only")
+    parser.add_argument("--report", help="write every candidate's scores here (JSON)")
+    parser.add_argument("--dry-run", action="store_true", help="print the best configuration without writing it")
+    args = parser.parse_args()
+
+    grid = candidates([float(c) for c in args.contamination.split(",")], [int(n) for n in args.n_estimators.split(",")],
+                      _floats_or_auto(args.max_samples), args.min_features)
+    interval = timedelta(seconds=args.interval)
+    train = labelled_day(args.hours, interval, "none", args.seed)
+    evaluation = labelled_day(args.hours, interval, args.drift, args.seed + 1)
+    print(f"{len(grid)} candidates, {len(train[0])} training / {len(evaluation[0])} evaluation samples", file=sys.stderr)
+
+    start = time.perf_counter()
+    results = search(grid, train, evaluation, args.workers)
+    print(f"searched in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+
+    ranked = sorted(results, key=rank, reverse=True)
+    print(f"{'f1':>7} {'AP':>7} {'prec':>7} {'recall':>7} {'fit s':>7}  params / features", file=sys.stderr)
+    for r in ranked[:10]:
+        print(f"{r['f1']:>7.4f} {r['average_precision']:>7.4f} {r['precision']:>7.4f} {r['recall']:>7.4f} "
+              f"{r['fit_seconds']:>7.3f}  {r['params']} {','.join(r['features'])}", file=sys.stderr)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(ranked, f, indent=2)
+
+    info = {"candidates": len(grid), "train_samples": len(train[0]), "eval_samples": len(evaluation[0]),
+            "drift": args.drift, "seed": args.seed}
+    result = best(results)
+    if args.dry_run:
+        print(json.dumps({"params": result["params"], "features": result["features"]}))
+    else:
+        path = os.path.join(MODEL_DIR, args.group or "", MODEL_CONFIG_FILE)
+        write_config(path, result, info)
+        print(f"wrote {path}", file=sys.stderr)